@@ -0,0 +1,112 @@
+"""
+Boarding-point arrival and departure events from live positions.
+
+Every boarding point on a trip's route gets three fences along the route,
+measured on the map-matched `progress_m` (core.map_matching):
+
+    approaching  GEOFENCE_APPROACH_M before the point
+    arrived      GEOFENCE_ARRIVE_M before the point
+    departed     GEOFENCE_DEPART_M past the point
+
+A fence fires when the trip's progress crosses it, so a bus that passes a
+stop between two fixes still produces all three events, in order. The
+fences of a route are one sorted NumPy array, built once per geometry, and
+a fix costs a binary search over it.
+
+Events go to TripEvents with `_id = "<trip_id>:<boarding_id>:<kind>"`, so
+each fires once per trip however often its fixes are re-sent. `notified`
+is left False for whoever tells the passengers boarding at that stop.
+"""
+import datetime
+import weakref
+
+import numpy as np
+from django.conf import settings
+from pymongo.errors import BulkWriteError
+
+from passenger.mongo import get_collection
+
+
+trip_events_collection = get_collection('TripEvents')
+
+APPROACHING, ARRIVED, DEPARTED = "approaching", "arrived", "departed"
+KINDS = (APPROACHING, ARRIVED, DEPARTED)
+
+_DUPLICATE_KEY = 11000
+
+# RouteGeometry -> (sorted fence positions, [(boarding_id, kind, point progress)])
+_fences = weakref.WeakKeyDictionary()
+
+
+def _route_fences(geometry):
+    fences = _fences.get(geometry)
+    if fences is None:
+        offsets = {
+            APPROACHING: -settings.GEOFENCE_APPROACH_M,
+            ARRIVED: -settings.GEOFENCE_ARRIVE_M,
+            DEPARTED: settings.GEOFENCE_DEPART_M,
+        }
+        entries = sorted((
+            (progress + offsets[kind], boarding_id, kind, progress)
+            for boarding_id, progress in geometry.point_progress.items()
+            for kind in KINDS
+        ), key=lambda e: e[0])
+        fences = (np.array([e[0] for e in entries]), [e[1:] for e in entries])
+        _fences[geometry] = fences
+    return fences
+
+
+def crossed(geometry, fixes, previous=None):
+    """
+    Events for the fences `fixes` (map-matched, sorted by time) cross after
+    `previous`, the trip's latest fix before them:
+    [(boarding_id, kind, fix), ...] in the order they happened.
+    """
+    positions, meta = _route_fences(geometry)
+    progress = (previous or {}).get('progress_m')
+
+    events = []
+    for fix in fixes:
+        current = fix.get('progress_m')
+        if current is None:
+            continue
+        if progress is None:
+            # first position of the trip: only stops at or ahead of it count
+            hi = int(np.searchsorted(positions, current, side='right'))
+            events.extend((meta[i][0], meta[i][1], fix) for i in range(hi)
+                          if meta[i][2] >= current - settings.GEOFENCE_ARRIVE_M)
+        else:
+            lo = int(np.searchsorted(positions, progress, side='right'))
+            hi = int(np.searchsorted(positions, current, side='right'))
+            events.extend((meta[i][0], meta[i][1], fix) for i in range(lo, hi))
+        progress = current
+    return events
+
+
+def detect(trip_id, fixes, geometry, previous=None):
+    """Record the events `fixes` trigger for `trip_id`; returns the new ones."""
+    events = crossed(geometry, fixes, previous)
+    if not events:
+        return []
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+    docs = [{
+        "_id": f"{trip_id}:{boarding_id}:{kind}",
+        "trip_id": trip_id,
+        "boarding_id": boarding_id,
+        "kind": kind,
+        "at": fix["timestamp"],
+        "progress_m": fix["progress_m"],
+        "notified": False,
+        "created_at": now,
+    } for boarding_id, kind, fix in events]
+
+    duplicates = set()
+    try:
+        trip_events_collection.insert_many(docs, ordered=False)
+    except BulkWriteError as e:
+        for error in e.details.get("writeErrors", []):
+            if error.get("code") != _DUPLICATE_KEY:
+                raise
+            duplicates.add(error["index"])
+    return [doc for i, doc in enumerate(docs) if i not in duplicates]
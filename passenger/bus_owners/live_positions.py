@@ -0,0 +1,133 @@
+"""
+Per-process cache of each trip's latest fix, for passengers polling
+"where is my bus".
+
+Fixes recorded in this process (the HTTP live-location upload) land here
+directly through `publish`; fixes written by other processes (mqtt_ingest,
+other gunicorn workers) are picked up from TripLatestLocation at most once
+per LIVE_POSITION_CACHE_TTL per trip, by whichever request notices first
+while the rest keep serving the cached fix. Each fix has an ETag, so a
+poller that already has it costs neither a Mongo read nor a body, and
+`wait_for_change` lets it block until there is something new instead.
+A waiter holds a gunicorn thread, so at most LIVE_POSITION_MAX_WAITERS
+requests per process wait at once; the rest are answered straight away.
+Cached fixes also carry the `progress_m` / `section_speeds` core.eta
+stores with them.
+"""
+import datetime
+import threading
+import time
+
+from django.conf import settings
+
+from passenger.mongo import get_collection
+
+
+trip_latest_location_collection = get_collection('TripLatestLocation')
+
+# entries not asked for in this long are dropped once the cache is full
+_IDLE_SECONDS = 600
+
+_FIX_FIELDS = ("latitude", "longitude", "timestamp", "progress_m", "section_speeds")
+
+
+def _aware(ts):
+    # stored timestamps come back naive (UTC)
+    return ts.replace(tzinfo=datetime.timezone.utc) if ts.tzinfo is None else ts
+
+
+def etag_for(trip_id, fix):
+    if fix is None:
+        return f'"{trip_id}-none"'
+    return f'"{trip_id}-{int(fix["timestamp"].timestamp() * 1000)}"'
+
+
+class _Entry:
+    __slots__ = ("fix", "etag", "checked_at", "used_at")
+
+    def __init__(self, trip_id, fix):
+        self.fix = fix
+        self.etag = etag_for(trip_id, fix)
+        self.checked_at = self.used_at = time.monotonic()
+
+
+class LivePositions:
+    def __init__(self):
+        self._entries = {}
+        self._changed = threading.Condition()
+        self._waiters = threading.BoundedSemaphore(settings.LIVE_POSITION_MAX_WAITERS)
+
+    def publish(self, trip_id, fix, extra=None):
+        """Take a freshly recorded fix, unless a newer one is already cached."""
+        fix = {"latitude": fix["latitude"], "longitude": fix["longitude"],
+               "timestamp": _aware(fix["timestamp"]), **(extra or {})}
+        with self._changed:
+            entry = self._entries.get(trip_id)
+            if entry and entry.fix and entry.fix["timestamp"] >= fix["timestamp"]:
+                return
+            self._store(trip_id, fix)
+            self._changed.notify_all()
+
+    def get(self, trip_id):
+        """(fix or None, etag), read through to Mongo when the entry is stale."""
+        now = time.monotonic()
+        with self._changed:
+            entry = self._entries.get(trip_id)
+            if entry and now - entry.checked_at < settings.LIVE_POSITION_CACHE_TTL:
+                entry.used_at = now
+                return entry.fix, entry.etag
+            if entry:
+                # claim the refresh; concurrent callers keep the cached fix
+                entry.checked_at = now
+                entry.used_at = now
+
+        doc = trip_latest_location_collection.find_one(
+            {"_id": trip_id}, {f: 1 for f in _FIX_FIELDS})
+        fix = None
+        if doc and doc.get("timestamp"):
+            fix = {f: doc[f] for f in _FIX_FIELDS if f in doc}
+            fix["timestamp"] = _aware(doc["timestamp"])
+
+        with self._changed:
+            entry = self._entries.get(trip_id)
+            if entry and entry.fix and (fix is None or entry.fix["timestamp"] >= fix["timestamp"]):
+                entry.checked_at = time.monotonic()
+                return entry.fix, entry.etag
+            entry = self._store(trip_id, fix)
+            if fix is not None:
+                self._changed.notify_all()
+            return entry.fix, entry.etag
+
+    def wait_for_change(self, trip_id, etag, timeout):
+        """
+        The trip's (fix, etag) as soon as its etag differs from `etag`, or
+        the unchanged pair after `timeout` seconds. None when the process
+        already has LIVE_POSITION_MAX_WAITERS requests waiting.
+        """
+        if not self._waiters.acquire(blocking=False):
+            return None
+        try:
+            deadline = time.monotonic() + timeout
+            fix, current = self.get(trip_id)
+            while current == etag:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                with self._changed:
+                    # wake on a local publish, or in time to re-check Mongo
+                    self._changed.wait(min(remaining, settings.LIVE_POSITION_CACHE_TTL))
+                fix, current = self.get(trip_id)
+            return fix, current
+        finally:
+            self._waiters.release()
+
+    def _store(self, trip_id, fix):
+        if trip_id not in self._entries and len(self._entries) >= settings.LIVE_POSITION_CACHE_SIZE:
+            idle = time.monotonic() - _IDLE_SECONDS
+            for key in [k for k, e in self._entries.items() if e.used_at < idle]:
+                del self._entries[key]
+        entry = self._entries[trip_id] = _Entry(trip_id, fix)
+        return entry
+
+
+live_positions = LivePositions()
@@ -0,0 +1,152 @@
+"""
+Bucketed GPS history and latest position per trip.
+
+TripLocation holds one document per trip per TRIP_LOCATION_BUCKET_SIZE
+fixes (`count`, `start_ts`, `end_ts`, `locations`), so appending never
+touches an unbounded array and history is read a bucket at a time.
+TripLatestLocation holds one small document per trip (`_id` = trip_id)
+that is overwritten in place, but only by a newer fix, so "where is the
+bus now" is a primary-key read.
+
+Before they are stored, fixes are map-matched (core.map_matching), so
+each carries a monotonic `progress_m` along the route that ETA, dwell and
+arrival consumers can use without redoing geometry.
+
+Trips recorded before the buckets have one TripLocation document without
+`count`; it is left as is and read as the oldest bucket.
+"""
+import datetime
+import logging
+
+from django.conf import settings
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from bus_owners import geofences
+from bus_owners.live_positions import live_positions
+from core import eta, map_matching
+from passenger.mongo import get_collection
+
+
+logger = logging.getLogger(__name__)
+
+trip_location_collection = get_collection('TripLocation')
+trip_latest_location_collection = get_collection('TripLatestLocation')
+
+
+def _append_chunk(trip_id, chunk, now):
+    """Append fixes to a bucket with room (or a new one); (bucket _id, created)."""
+    size = settings.TRIP_LOCATION_BUCKET_SIZE
+    bucket = trip_location_collection.find_one_and_update(
+        {"trip_id": trip_id, "count": {"$lte": size - len(chunk)}},
+        {
+            "$setOnInsert": {"created_at": now},
+            "$set": {"updated_at": now},
+            "$push": {"locations": {"$each": chunk}},
+            "$inc": {"count": len(chunk)},
+            "$min": {"start_ts": chunk[0]["timestamp"]},
+            "$max": {"end_ts": chunk[-1]["timestamp"]},
+        },
+        projection={"_id": 1, "count": 1},
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
+    return bucket["_id"], bucket["count"] == len(chunk)
+
+
+def update_latest(trip_id, fix, now=None, extra=None):
+    """
+    Overwrite the trip's latest position with `fix` unless a newer one is
+    already stored. Returns True if `fix` became the latest.
+    """
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    try:
+        trip_latest_location_collection.update_one(
+            {"_id": trip_id, "timestamp": {"$lt": fix["timestamp"]}},
+            {"$set": {
+                "latitude": fix["latitude"],
+                "longitude": fix["longitude"],
+                "timestamp": fix["timestamp"],
+                "updated_at": now,
+                **(extra or {}),
+            }},
+            upsert=True,
+        )
+    except DuplicateKeyError:
+        # the stored fix is as new or newer; the upsert collided with it
+        return False
+    return True
+
+
+def _route_progress(trip_id, fixes):
+    """
+    Map-match `fixes` in place (each gets `progress_m`), record the
+    boarding-point events they trigger and return the fields core.eta
+    keeps with the latest fix.
+    """
+    try:
+        previous, _ = live_positions.get(trip_id)
+        geometry = map_matching.match_fixes(trip_id, fixes, previous)
+        if geometry is None:
+            return {}
+        geofences.detect(trip_id, fixes, geometry, previous)
+        return eta.observe(fixes, geometry, previous)
+    except Exception as e:
+        # route progress is not worth losing the fixes over
+        logger.exception("Route progress failed for trip %s: %s", trip_id, e)
+        return {}
+
+
+def record_locations(trip_id, fixes):
+    """
+    Store validated fixes ({latitude, longitude, timestamp}) for a trip.
+    Returns (last bucket _id, whether a new bucket was started).
+    """
+    fixes = sorted(fixes, key=lambda f: f["timestamp"])
+    size = settings.TRIP_LOCATION_BUCKET_SIZE
+    now = datetime.datetime.now(datetime.timezone.utc)
+    extra = _route_progress(trip_id, fixes)
+
+    bucket_id, created = None, False
+    for start in range(0, len(fixes), size):
+        bucket_id, new_bucket = _append_chunk(trip_id, fixes[start:start + size], now)
+        created = created or new_bucket
+
+    update_latest(trip_id, fixes[-1], now, extra)
+    live_positions.publish(trip_id, fixes[-1], extra)
+    return bucket_id, created
+
+
+def latest_location(trip_id):
+    return trip_latest_location_collection.find_one({"_id": trip_id})
+
+
+def location_history(trip_id, since=None, max_buckets=4):
+    """
+    Fixes of at most `max_buckets` buckets, oldest first, starting with the
+    first bucket that ends at or after `since`. Returns (fixes, next_since):
+    pass `next_since` back to continue, None when there is nothing more.
+    """
+    if since is not None and since.tzinfo is not None:
+        # stored timestamps come back naive (UTC)
+        since = since.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
+    query = {"trip_id": trip_id}
+    if since is not None:
+        query["$or"] = [{"end_ts": {"$gte": since}}, {"end_ts": {"$exists": False}}]
+
+    cursor = trip_location_collection.find(
+        query, {"locations": 1, "end_ts": 1, "_id": 0}
+    ).sort("start_ts", 1).limit(max_buckets + 1)
+    buckets = list(cursor)
+
+    fixes = []
+    for bucket in buckets[:max_buckets]:
+        fixes.extend(
+            f for f in bucket.get("locations", [])
+            if since is None or f["timestamp"] >= since)
+
+    next_since = None
+    if len(buckets) > max_buckets and fixes:
+        next_since = fixes[-1]["timestamp"] + datetime.timedelta(microseconds=1)
+    return fixes, next_since
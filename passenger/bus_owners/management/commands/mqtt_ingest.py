@@ -0,0 +1,229 @@
+"""
+Long-running consumer for the `lat,lon` positions buses publish to
+`vehicle/<bus_id>` on Mosquitto.
+
+Messages only get parsed and buffered per bus on the paho network thread;
+the main thread flushes a bus's buffer once MQTT_FLUSH_SIZE fixes are
+waiting or the oldest has waited MQTT_FLUSH_SECONDS, resolving the bus to
+its running trip (cached for MQTT_TRIP_CACHE_TTL, or MQTT_NO_TRIP_CACHE_TTL
+when it has none) and writing the whole batch with one bucket append via
+bus_owners.locations.record_locations.
+
+Benchmark: run a local Mosquitto, `manage.py mqtt_ingest --host localhost`
+and `staticfiles/mqtt_publish1.py` (MQTT_BROKER=localhost) replaying
+path500.json, then watch mqtt_vehicle_* on the metrics port.
+"""
+import datetime
+import logging
+import signal
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+from bson import ObjectId
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from prometheus_client import start_http_server
+
+from bus_owners.locations import record_locations
+from passenger.metrics import (
+    MQTT_BUFFERED, MQTT_FLUSH_BATCH, MQTT_FLUSHES, MQTT_INGEST_LAG, MQTT_MESSAGES,
+)
+from passenger.mongo import close_client, get_collection
+
+
+logger = logging.getLogger(__name__)
+
+bus_trip_collection = get_collection('BusTrips')
+
+# a bus whose writes keep failing must not grow without bound
+MAX_BUFFERED_PER_BUS = 5000
+
+
+def parse_position(payload):
+    """`b"lat,lon"` -> (lat, lon), or None if it is not a usable position."""
+    try:
+        lat, lon = (float(v) for v in payload.decode().split(","))
+    except (UnicodeDecodeError, ValueError):
+        return None
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        return None
+    return lat, lon
+
+
+class TripResolver:
+    """bus_id -> trip_id of the bus's running trip (None if there is none), cached."""
+
+    def __init__(self, ttl, no_trip_ttl):
+        self.ttl = ttl
+        self.no_trip_ttl = no_trip_ttl
+        self._cache = {}
+
+    def active_trip(self, bus_id):
+        hit = self._cache.get(bus_id)
+        if hit and hit[1] > time.monotonic():
+            return hit[0]
+
+        now = datetime.datetime.now(datetime.timezone.utc)
+        # the trip get_started_bus_trip would report, unless it has finished
+        trip = bus_trip_collection.find_one(
+            {"bus_id": bus_id, "trip_start_time": {"$lte": now}},
+            {"_id": 1, "completed": 1},
+            sort=[("trip_start_time", -1)],
+        )
+        trip_id = str(trip["_id"]) if trip and not trip.get("completed") else None
+        # a miss is only trusted briefly: the bus may be about to start its trip
+        ttl = self.ttl if trip_id else self.no_trip_ttl
+        self._cache[bus_id] = (trip_id, time.monotonic() + ttl)
+        return trip_id
+
+
+class Command(BaseCommand):
+    help = "Subscribe to vehicle/<bus_id> positions and batch them into TripLocation."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default=settings.MQTT_HOST)
+        parser.add_argument("--port", type=int, default=settings.MQTT_PORT)
+        parser.add_argument("--topic", default=settings.MQTT_VEHICLE_TOPIC)
+        parser.add_argument("--flush-size", type=int, default=settings.MQTT_FLUSH_SIZE)
+        parser.add_argument("--flush-seconds", type=float, default=settings.MQTT_FLUSH_SECONDS)
+        parser.add_argument("--metrics-port", type=int, default=settings.MQTT_METRICS_PORT)
+
+    def handle(self, *args, **options):
+        self.flush_size = options["flush_size"]
+        self.flush_seconds = options["flush_seconds"]
+        self.trips = TripResolver(settings.MQTT_TRIP_CACHE_TTL, settings.MQTT_NO_TRIP_CACHE_TTL)
+
+        self.lock = threading.Lock()
+        self.buffers = {}        # bus_id -> [fix, ...]
+        self.oldest = {}         # bus_id -> monotonic time its first buffered fix arrived
+        self.wake = threading.Event()
+        self.stopping = threading.Event()
+
+        if options["metrics_port"]:
+            start_http_server(options["metrics_port"])
+
+        client = mqtt.Client(callback_api_version=mqtt.CallbackAPIVersion.VERSION2)
+        if settings.MQTT_USER:
+            client.username_pw_set(settings.MQTT_USER, settings.MQTT_PASS)
+        client.on_connect = lambda c, userdata, flags, reason_code, props: self.on_connect(
+            c, reason_code, options["topic"])
+        client.on_message = self.on_message
+        client.reconnect_delay_set(min_delay=1, max_delay=30)
+
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, lambda *_: self.stop())
+
+        client.connect_async(options["host"], options["port"])
+        client.loop_start()
+        try:
+            self.flush_loop()
+        finally:
+            client.disconnect()
+            client.loop_stop()
+            # whatever is still buffered goes out before exiting
+            self.flush(force="shutdown")
+            close_client()
+
+    def stop(self):
+        self.stopping.set()
+        self.wake.set()
+
+    def on_connect(self, client, reason_code, topic):
+        if reason_code.is_failure:
+            logger.error("mqtt_ingest: connect failed: %s", reason_code)
+            return
+        # (re)subscribe on every connect; the broker forgets us on reconnect
+        client.subscribe(topic, qos=0)
+        logger.info("mqtt_ingest: subscribed to %s", topic)
+
+    def on_message(self, client, userdata, msg):
+        bus_id = msg.topic.rsplit("/", 1)[-1]
+        position = parse_position(msg.payload)
+        if position is None or not ObjectId.is_valid(bus_id):
+            MQTT_MESSAGES.labels("invalid").inc()
+            return
+
+        fix = {
+            "latitude": position[0],
+            "longitude": position[1],
+            # buses do not send a clock; the receive time is the fix time
+            "timestamp": datetime.datetime.now(datetime.timezone.utc),
+        }
+        with self.lock:
+            buffer = self.buffers.setdefault(bus_id, [])
+            if not buffer:
+                self.oldest[bus_id] = time.monotonic()
+            if len(buffer) >= MAX_BUFFERED_PER_BUS:
+                buffer.pop(0)
+                MQTT_MESSAGES.labels("dropped").inc()
+            else:
+                MQTT_BUFFERED.inc()
+            buffer.append(fix)
+            full = len(buffer) >= self.flush_size
+        MQTT_MESSAGES.labels("accepted").inc()
+        if full:
+            self.wake.set()
+
+    def flush_loop(self):
+        # wake at least a few times per flush interval so time-based flushes are on time
+        tick = max(min(self.flush_seconds / 4, 1.0), 0.05)
+        while not self.stopping.is_set():
+            self.wake.wait(tick)
+            self.wake.clear()
+            self.flush()
+
+    def due(self, force):
+        """Buses whose buffer should be written now, with the trigger."""
+        cutoff = time.monotonic() - self.flush_seconds
+        with self.lock:
+            out = []
+            for bus_id, buffer in self.buffers.items():
+                if not buffer:
+                    continue
+                if force:
+                    out.append((bus_id, force))
+                elif len(buffer) >= self.flush_size:
+                    out.append((bus_id, "size"))
+                elif self.oldest[bus_id] <= cutoff:
+                    out.append((bus_id, "time"))
+            return out
+
+    def flush(self, force=None):
+        for bus_id, trigger in self.due(force):
+            with self.lock:
+                fixes = self.buffers.pop(bus_id, [])
+                self.oldest.pop(bus_id, None)
+            if not fixes:
+                continue
+            MQTT_BUFFERED.dec(len(fixes))
+
+            try:
+                trip_id = self.trips.active_trip(bus_id)
+                if trip_id is None:
+                    # bus is on the air between trips; nothing to attach the fixes to
+                    MQTT_FLUSHES.labels(trigger, "no_trip").inc()
+                    continue
+                record_locations(trip_id, fixes)
+            except Exception:
+                logger.exception("mqtt_ingest: writing %s fixes of bus %s failed", len(fixes), bus_id)
+                MQTT_FLUSHES.labels(trigger, "error").inc()
+                self.requeue(bus_id, fixes)
+                continue
+
+            stored = time.time()
+            for fix in fixes:
+                MQTT_INGEST_LAG.observe(stored - fix["timestamp"].timestamp())
+            MQTT_FLUSH_BATCH.observe(len(fixes))
+            MQTT_FLUSHES.labels(trigger, "ok").inc()
+
+    def requeue(self, bus_id, fixes):
+        """Put a failed batch back in front of anything newer, for the next flush."""
+        with self.lock:
+            buffer = fixes + self.buffers.get(bus_id, [])
+            dropped = max(len(buffer) - MAX_BUFFERED_PER_BUS, 0)
+            self.buffers[bus_id] = buffer[dropped:]
+            self.oldest[bus_id] = time.monotonic()
+        MQTT_BUFFERED.inc(len(fixes) - dropped)
+        if dropped:
+            MQTT_MESSAGES.labels("dropped").inc(dropped)
@@ -0,0 +1,230 @@
+"""
+Idempotent ingestion of paper tickets uploaded by conductor machines.
+
+Every ticket carries a machine-generated `ticket_id`. Uploads first insert
+one TicketReceipts document per ticket, `_id = "<bus_id>:<ticket_id>"`, in a
+single unordered insert_many: the unique `_id` is what turns a retried
+upload into duplicates instead of double revenue. The receipts that were
+new are then applied in one bucket append per TICKET_BUCKET_SIZE tickets
+plus one trip update, and marked applied, so sync cost does not grow per
+ticket.
+
+Receipts are written with the upload's `batch` token and a `claimed_at`
+lease before the trip is touched. A retried ticket whose receipt is still
+`applied: False` is not a duplicate: if the upload that wrote it failed
+(its claim is released) or died (its lease of TICKET_APPLY_LEASE_SECONDS
+ran out), the retry claims the receipt and applies the ticket itself;
+while the lease is live it is reported `pending` so the machine retries
+it later. Tickets are therefore applied once even when an upload fails
+between the receipt insert and the trip update.
+
+Tickets themselves no longer live in the trip document. They are appended
+to TicketBuckets, one document per trip per TICKET_BUCKET_SIZE tickets
+with `first_at` / `last_at` receive times, while the trip only keeps the
+running `tickets_revenue` / `number_of_tickets` totals. Trips written
+before the move still carry a `tickets` array, which `trip_ticket_list`
+reads first; hot trip reads use TRIP_WITHOUT_TICKETS to leave it behind.
+"""
+import datetime
+import hashlib
+import uuid
+
+from bson import ObjectId
+from django.conf import settings
+from pymongo.errors import BulkWriteError
+
+from passenger.mongo import get_collection
+
+
+bus_trip_collection = get_collection('BusTrips')
+ticket_receipts_collection = get_collection('TicketReceipts')
+ticket_buckets_collection = get_collection('TicketBuckets')
+
+# projection for trip reads that should not drag legacy tickets along
+TRIP_WITHOUT_TICKETS = {"tickets": 0}
+
+REQUIRED_FIELDS = ("start_point", "end_point", "ticket_price", "issued_at")
+
+ACCEPTED, DUPLICATE, REJECTED, PENDING = "accepted", "duplicate", "rejected", "pending"
+
+_DUPLICATE_KEY = 11000
+
+
+def ticket_id_for(ticket):
+    """
+    The machine's ticket_id; older machines that do not send one get a
+    stable id derived from the ticket itself so their retries dedup too.
+    """
+    if ticket.get("ticket_id"):
+        return str(ticket["ticket_id"])
+    raw = "|".join(str(ticket.get(f)) for f in REQUIRED_FIELDS)
+    return "sha1-" + hashlib.sha1(raw.encode()).hexdigest()
+
+
+def _validate(ticket, trip_id):
+    missing = [f for f in REQUIRED_FIELDS if ticket.get(f) in (None, "")]
+    if missing:
+        return None, f"Missing fields: {', '.join(missing)}"
+    if ticket.get("trip_id") != trip_id:
+        return None, "Mismatched trip_id"
+    try:
+        price = float(ticket["ticket_price"])
+    except (TypeError, ValueError):
+        return None, "ticket_price must be a number"
+    if price < 0:
+        return None, "ticket_price must not be negative"
+
+    return {
+        "start_point": ticket["start_point"],
+        "end_point": ticket["end_point"],
+        "ticket_price": price,
+        "ticket_date_time": ticket["issued_at"],
+    }, None
+
+
+def append_tickets(trip_id, tickets):
+    """
+    Append ticket documents to the trip's buckets and bump the trip totals.
+    Each chunk goes into a bucket that still has room, or a new one (upsert).
+    """
+    size = settings.TICKET_BUCKET_SIZE
+    now = datetime.datetime.now(datetime.timezone.utc)
+
+    for start in range(0, len(tickets), size):
+        chunk = tickets[start:start + size]
+        ticket_buckets_collection.update_one(
+            {"trip_id": trip_id, "count": {"$lte": size - len(chunk)}},
+            {
+                "$push": {"tickets": {"$each": chunk}},
+                "$inc": {"count": len(chunk)},
+                "$min": {"first_at": now},
+                "$max": {"last_at": now},
+            },
+            upsert=True,
+        )
+
+    return bus_trip_collection.update_one(
+        {"_id": ObjectId(trip_id)},
+        {"$inc": {
+            "tickets_revenue": sum(t["ticket_price"] for t in tickets),
+            "number_of_tickets": len(tickets),
+        }},
+    )
+
+
+def trip_ticket_list(trip_id, legacy_tickets=()):
+    """All tickets of a trip: those still embedded in it, then the buckets'."""
+    out = list(legacy_tickets)
+    cursor = ticket_buckets_collection.find(
+        {"trip_id": trip_id}, {"tickets": 1, "_id": 0}).sort("first_at", 1)
+    for bucket in cursor:
+        out.extend(bucket.get("tickets", []))
+    return out
+
+
+def _release_claims(batch):
+    # give the upload's unapplied receipts up so the machine's retry
+    # applies them at once instead of waiting out the lease
+    ticket_receipts_collection.update_many(
+        {"batch": batch, "applied": False}, {"$set": {"claimed_at": None}})
+
+
+def ingest_tickets(bus_id, trip_id, tickets):
+    """
+    Record `tickets` for `trip_id` exactly once each.
+
+    Returns (report, accepted_tickets): one {"ticket_id", "status"[, "reason"]}
+    entry per uploaded ticket, in upload order, and the ticket documents that
+    were newly added to the trip.
+    """
+    batch = uuid.uuid4().hex
+    now = datetime.datetime.now(datetime.timezone.utc)
+
+    report = []
+    receipts = []       # receipts to insert, parallel to `pending`
+    pending = []        # (report index, ticket document)
+    seen = set()
+
+    for ticket in tickets:
+        ticket_id = ticket_id_for(ticket)
+        doc, reason = _validate(ticket, trip_id)
+        if reason:
+            report.append({"ticket_id": ticket_id, "status": REJECTED, "reason": reason})
+            continue
+        if ticket_id in seen:
+            # the same ticket twice inside one upload
+            report.append({"ticket_id": ticket_id, "status": DUPLICATE})
+            continue
+        seen.add(ticket_id)
+
+        receipts.append({
+            "_id": f"{bus_id}:{ticket_id}",
+            "bus_id": bus_id,
+            "trip_id": trip_id,
+            "ticket": doc,
+            "batch": batch,
+            "applied": False,
+            "claimed_at": now,
+            "received_at": now,
+        })
+        pending.append((len(report), doc))
+        report.append({"ticket_id": ticket_id, "status": ACCEPTED})
+
+    if not receipts:
+        return report, []
+
+    # 1) one unordered insert; duplicate _ids are the retried tickets
+    duplicate_positions = set()
+    try:
+        ticket_receipts_collection.insert_many(receipts, ordered=False)
+    except BulkWriteError as e:
+        for error in e.details.get("writeErrors", []):
+            if error.get("code") != _DUPLICATE_KEY:
+                _release_claims(batch)
+                raise
+            duplicate_positions.add(error["index"])
+
+    # a duplicate whose receipt never got applied is ours to apply if its
+    # upload gave it up or its lease ran out, and pending while it is live
+    unapplied = set()
+    if duplicate_positions:
+        unapplied = {r["_id"] for r in ticket_receipts_collection.find(
+            {"_id": {"$in": [receipts[i]["_id"] for i in duplicate_positions]},
+             "applied": False}, {"_id": 1})}
+    stale = now - datetime.timedelta(seconds=settings.TICKET_APPLY_LEASE_SECONDS)
+
+    accepted = []
+    for position, (report_index, doc) in enumerate(pending):
+        receipt_id = receipts[position]["_id"]
+        if position in duplicate_positions:
+            if receipt_id not in unapplied:
+                report[report_index]["status"] = DUPLICATE
+                continue
+            claimed = ticket_receipts_collection.find_one_and_update(
+                {"_id": receipt_id, "applied": False,
+                 "$or": [{"claimed_at": None}, {"claimed_at": {"$lt": stale}}]},
+                {"$set": {"batch": batch, "claimed_at": now}},
+                projection={"ticket": 1},
+            )
+            if claimed is None:
+                report[report_index]["status"] = PENDING
+                continue
+            # apply the ticket as first recorded
+            doc = claimed["ticket"]
+        accepted.append(doc)
+
+    if not accepted:
+        return report, []
+
+    # 2) append everything claimed to the buckets, totals to the trip
+    try:
+        append_tickets(trip_id, accepted)
+    except Exception:
+        _release_claims(batch)
+        raise
+
+    # 3) mark this upload's receipts as applied
+    ticket_receipts_collection.update_many(
+        {"batch": batch}, {"$set": {"applied": True}})
+
+    return report, accepted
@@ -25,6 +25,8 @@ urlpatterns = [
     path('verify-booking/', views.verify_booking, name='verify_booking'),
     path('complete-trip/', views.complete_bookings, name='complete-bookings'),
     path('live-location/', views.record_trip_locations),
+    path('live-location/latest/', views.trip_location_latest),
+    path('live-location/history/', views.trip_location_history),
     path('off-machine/', views.turn_machine_off, name='turn_machine_off'),
 
 
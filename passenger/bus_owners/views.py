@@ -11,33 +11,27 @@ from rest_framework.parsers import MultiPartParser, FormParser
 from django.conf import settings
 from django.shortcuts import render
 from django.core.files.storage import FileSystemStorage
-from pymongo import MongoClient
 from pymongo.errors import PyMongoError
-from passenger.settings import create_access_token, create_refresh_token, get_access_token_from_request, validate_token
+from passenger.mongo import get_client, get_collection
+from bus_owners.locations import latest_location, location_history, record_locations
+from bus_owners.tickets import TRIP_WITHOUT_TICKETS, append_tickets, ingest_tickets, trip_ticket_list
+from core.trip_lifecycle import UNUSED_STATUSES
+from passenger.auth import invalidate_token_version, validate_machine_token
+from passenger.settings import create_access_token, create_refresh_token, get_access_token_from_request, get_request_principal, validate_token
 
 
 tz = pytz.timezone("Asia/Colombo")
 utc_timezone = pytz.utc
 
-
-# Access MongoDB URI from settings
-# Access the URI from settings
-mongodb_uri = settings.DATABASE
 SECRET_KEY = settings.SECRET_KEY
 
-# MongoDB client setup using the URI
-client = MongoClient(mongodb_uri)
-# Access your database (assuming the name is 'Passenger')
-db = client['Passenger']
-# Access the 'users' collection (or your actual collection name)
-bus_owner_collection = db['BusOwners']
-bus_collection = db['Buses']
-bus_trip_collection = db['BusTrips']
-routes_collection = db['Routes']
-bus_fare_collection = db["BusFare"]
-bookings_collection = db['Bookings']
-fare_types_collection = db['BusFare']
-trip_location_collection = db['TripLocation']
+bus_owner_collection = get_collection('BusOwners')
+bus_collection = get_collection('Buses')
+bus_trip_collection = get_collection('BusTrips')
+routes_collection = get_collection('Routes')
+bus_fare_collection = get_collection("BusFare")
+bookings_collection = get_collection('Bookings')
+fare_types_collection = get_collection('BusFare')
 
 
 @api_view(['POST'])
@@ -223,7 +217,7 @@ Example POST request
     if now.replace(tzinfo=None) > user.get('otp_expires_at').replace(tzinfo=None):
         return Response({"error": "OTP expired."}, status=status.HTTP_400_BAD_REQUEST)
 
-    with client.start_session() as session:
+    with get_client().start_session() as session:
         try:
             with session.start_transaction():
                 # Mark user as verified
@@ -275,11 +269,12 @@ def owner_details(request):
     if not access_token:
         return Response({"error": "Access token required"}, status=status.HTTP_401_UNAUTHORIZED)
 
-    owner_id = validate_token(access_token)
-    if not owner_id:
+    principal = get_request_principal(request)
+    if not principal:
         return Response({"error": "Invalid or expired access token"}, status=status.HTTP_401_UNAUTHORIZED)
+    owner_id = principal.user_id
 
-    owner = bus_owner_collection.find_one({"_id": ObjectId(owner_id)})
+    owner = principal.document_as("OWNER")
     if not owner:
         return Response({"error": "Owner not found"}, status=status.HTTP_404_NOT_FOUND)
 
@@ -352,12 +347,13 @@ def create_bus(request):
     if not access_token:
         return Response({"error": "Access token required"}, status=status.HTTP_401_UNAUTHORIZED)
 
-    owner_id = validate_token(access_token)
-    if owner_id is None:
+    principal = get_request_principal(request)
+    if principal is None:
         return Response({"error": "Invalid or expired token"}, status=status.HTTP_401_UNAUTHORIZED)
+    owner_id = principal.user_id
 
     # 2) Verify owner exists
-    owner = bus_owner_collection.find_one({"_id": ObjectId(owner_id)})
+    owner = principal.document_as("OWNER")
     if not owner:
         return Response({"error": "Owner not found"}, status=status.HTTP_404_NOT_FOUND)
 
@@ -446,12 +442,13 @@ def update_bus(request):
         return Response({"error": "Access token required"}, status=status.HTTP_401_UNAUTHORIZED)
 
     # validate the token and extract the user id from the access token
-    owner_id = validate_token(access_token)
-    if owner_id is None:
+    principal = get_request_principal(request)
+    if principal is None:
         return Response({"error": "Invalid or expired access token"}, status=status.HTTP_401_UNAUTHORIZED)
+    owner_id = principal.user_id
 
     # Check owner exists in DB
-    owner = bus_owner_collection.find_one({"_id": ObjectId(owner_id)})
+    owner = principal.document_as("OWNER")
     if not owner:
         return Response({"error": "User not found"}, status=status.HTTP_404_NOT_FOUND)
 
@@ -616,7 +613,7 @@ def get_trips_by_bus(request):
     bus["_id"] = str(bus["_id"])
 
     # Fetch bus trips sorted by the `trip_start_time` in ascending order (oldest to newest)
-    trips_cursor = bus_trip_collection.find({"bus_id": bus_id}).sort(
+    trips_cursor = bus_trip_collection.find({"bus_id": bus_id}, TRIP_WITHOUT_TICKETS).sort(
         "trip_start_time", 1)  # 1 for ascending order
     trips = []
     for doc in trips_cursor:
@@ -659,26 +656,17 @@ def add_ticket(request):
         "ticket_price":      data["ticket_price"],
     }
 
-    # Update the document by pushing ticket into tickets array
     try:
         obj_id = ObjectId(trip_id)
     except Exception:
         return Response({"error": "Invalid trip_id"}, status=status.HTTP_400_BAD_REQUEST)
 
-    result = bus_trip_collection.update_one(
-        {"_id": obj_id},
-        {
-            "$push": {"tickets": ticket},
-            "$inc": {
-                "tickets_revenue": data.get('ticket_price'),
-                "number_of_tickets": 1
-            }
-        }
-    )
-
-    if result.matched_count == 0:
+    if not bus_trip_collection.find_one({"_id": obj_id}, {"_id": 1}):
         return Response({"error": "Trip not found"}, status=status.HTTP_404_NOT_FOUND)
 
+    # Append the ticket to the trip's ticket buckets and bump the totals
+    append_tickets(trip_id, [ticket])
+
     return Response({"message": "Ticket added successfully"}, status=status.HTTP_200_OK)
 
 
@@ -829,12 +817,13 @@ def toggle_machine_button(request):
         return Response({"error": "Access token required"}, status=status.HTTP_401_UNAUTHORIZED)
 
     # Validate the token and extract the user id from the access token
-    owner_id = validate_token(access_token)
-    if owner_id is None:
+    principal = get_request_principal(request)
+    if principal is None:
         return Response({"error": "Invalid or expired access token"}, status=status.HTTP_401_UNAUTHORIZED)
+    owner_id = principal.user_id
 
     # Check if the owner exists in DB
-    owner = bus_owner_collection.find_one({"_id": ObjectId(owner_id)})
+    owner = principal.document_as("OWNER")
     if not owner:
         return Response({"error": "User not found"}, status=status.HTTP_404_NOT_FOUND)
 
@@ -877,6 +866,9 @@ def toggle_machine_button(request):
     else:
         return Response({"error": "Invalid status value"}, status=status.HTTP_400_BAD_REQUEST)
 
+    if status_value == 'off':
+        invalidate_token_version("MACHINE", bus_id)
+
     if result.modified_count == 1:
         return Response({"message": "Bus machine status updated successfully"})
     else:
@@ -974,7 +966,8 @@ def trip_tickets(request):
     except Exception:
         return Response({'detail': 'Invalid trip ID.'}, status=status.HTTP_400_BAD_REQUEST)
 
-    # Fetch tickets + trip-level route_id and booking_price
+    # Fetch trip-level route_id and booking_price (plus tickets still
+    # embedded in trips from before the ticket buckets)
     trip = bus_trip_collection.find_one(
         {'_id': _id},
         {'_id': 0, 'tickets': 1, 'route_id': 1, 'booking_price': 1}
@@ -990,7 +983,7 @@ def trip_tickets(request):
 
     # Build response with new attributes appended at the end
     out = []
-    for t in trip.get('tickets', []):
+    for t in trip_ticket_list(trip_id, trip.get('tickets', [])):
         item = {
             'start_point': t.get('start_point'),
             'end_point': t.get('end_point'),
@@ -1039,12 +1032,14 @@ def get_started_bus_trip(request):
     # 1) fetch the “just-started” (most recent past) trip
     just_started = bus_trip_collection.find_one(
         {"bus_id": bus_id, "trip_start_time": {"$lte": now}},
+        TRIP_WITHOUT_TICKETS,
         sort=[("trip_start_time", -1)]
     )
 
     # 2) fetch all future trips, sorted descending
     upcoming_cursor = bus_trip_collection.find(
-        {"bus_id": bus_id, "trip_start_time": {"$gt": now}}
+        {"bus_id": bus_id, "trip_start_time": {"$gt": now}},
+        TRIP_WITHOUT_TICKETS
     ).sort("trip_start_time", -1)
 
     # build a single list
@@ -1071,9 +1066,6 @@ def get_started_bus_trip(request):
     }, status=status.HTTP_200_OK)
 
 
-VALIDATE_URL = "https://www.passenger.lk/validate-machine/"
-
-
 @api_view(['POST'])
 def add_all_tickets(request):
     # Step 1: Get JWT token from request headers
@@ -1082,31 +1074,15 @@ def add_all_tickets(request):
     if not jwt_token:
         return Response({"error": "JWT token missing in header"}, status=status.HTTP_400_BAD_REQUEST)
 
-    # Authenticate and get bus_id
-
-    try:
-        auth_response = requests.post(
-            # 10 seconds timeout
-            VALIDATE_URL, json={"token": jwt_token}, timeout=10)
-        auth_response.raise_for_status()
-
-        # Printing the full response in the terminal
-        print(f"Response Status Code: {auth_response.status_code}")
-        print("Response JSON:")
-        print(auth_response.json())
-
-        auth_data = auth_response.json()
-        bus_id = auth_data.get("bus_id")
-    except requests.exceptions.RequestException as e:
-        print(f"Authentication failed: {str(e)}")
-
-    if not bus_id:
-        return Response({"error": "No bus_id found in authentication response"}, status=status.HTTP_400_BAD_REQUEST)
+    # Authenticate and get bus_id (checked in-process, no HTTP hop)
+    bus_id, auth_error, auth_status = validate_machine_token(jwt_token)
+    if auth_error:
+        return Response({"error": auth_error}, status=auth_status)
 
     # Step 2: Validate ticket data from the request
     tickets = request.data.get("tickets", [])
 
-    if not tickets:
+    if not tickets or not isinstance(tickets, list):
         return Response({"error": "No tickets provided"}, status=status.HTTP_400_BAD_REQUEST)
 
     trip_id = tickets[0].get("trip_id")
@@ -1116,54 +1092,32 @@ def add_all_tickets(request):
     except Exception:
         return Response({'detail': 'Invalid trip ID.'}, status=status.HTTP_400_BAD_REQUEST)
 
-    # Ensure all trip_ids are the same
-    if any(ticket.get("trip_id") != trip_id for ticket in tickets):
-        return Response({"error": "Mismatched trip_id across tickets"}, status=status.HTTP_400_BAD_REQUEST)
-
     # Step 3: Check that bus_id and trip_id match the MongoDB trip document
     # Use find_one to search in the MongoDB collection
     trip = bus_trip_collection.find_one({
         "_id": _id,
         "bus_id": bus_id,
 
-    })
+    }, {"_id": 1})
 
     if not trip:
         return Response({"error": "Bus ID and Trip ID mismatch or no trip found"}, status=status.HTTP_400_BAD_REQUEST)
 
-    # Step 4: Update the trip with new ticket information (push new tickets into the tickets array)
-    for ticket in tickets:
-        ticket_data = {
-            "start_point": ticket["start_point"],
-            "end_point": ticket["end_point"],
-            "ticket_price": ticket["ticket_price"],
-            "ticket_date_time": ticket["issued_at"]
-        }
-
-        # Update the trip document by pushing the new ticket into the tickets array and incrementing ticket counts
-        result = bus_trip_collection.update_one(
-            {"_id": ObjectId(trip["_id"])},
-            {
-                "$push": {"tickets": ticket_data},
-                "$inc": {
-                    "tickets_revenue": ticket["ticket_price"],
-                    "number_of_tickets": 1
-                }
-            }
-        )
-
-        if result.matched_count == 0:
-            return Response({"error": "Failed to update the trip document"}, status=status.HTTP_400_BAD_REQUEST)
+    # Step 4: Record the tickets once each (receipts dedup on bus_id + ticket_id)
+    # and apply the new ones to the trip in a single update.
+    # Tickets for another trip_id are rejected individually.
+    try:
+        report, accepted = ingest_tickets(bus_id, trip_id, tickets)
+    except PyMongoError as e:
+        return Response({"error": f"Failed to record tickets: {e}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-    # Step 5: Filter out and return only the necessary ticket details
-    filtered_tickets = [{
-        "start_point": ticket["start_point"],
-        "end_point": ticket["end_point"],
-        "ticket_price": ticket["ticket_price"],
-        "ticket_date_time": ticket["issued_at"]
-    } for ticket in tickets]
+    counts = {"accepted": 0, "duplicate": 0, "rejected": 0, "pending": 0}
+    for entry in report:
+        counts[entry["status"]] += 1
 
-    return Response({"tickets": filtered_tickets})
+    # Step 5: Return the newly added tickets plus a per-ticket report so the
+    # machine can retry safely
+    return Response({"tickets": accepted, "report": report, **counts})
 
 
 @api_view(['POST'])
@@ -1181,24 +1135,12 @@ def complete_bookings(request):
             status=status.HTTP_401_UNAUTHORIZED
         )
 
-    # --- 2) call auth service to get bus_id ---
-    try:
-        auth_resp = requests.post(
-            VALIDATE_URL,
-            json={"token": jwt_token},
-            timeout=10
-        )
-        auth_resp.raise_for_status()
-        bus_id = auth_resp.json().get("bus_id")
-        if not bus_id:
-            return Response(
-                {"error": "bus_id not returned by auth service."},
-                status=status.HTTP_403_FORBIDDEN
-            )
-    except requests.RequestException as exc:
+    # --- 2) validate the machine token in-process to get bus_id ---
+    bus_id, auth_error, auth_status = validate_machine_token(jwt_token)
+    if auth_error:
         return Response(
-            {"error": f"Authentication failed: {exc}"},
-            status=status.HTTP_401_UNAUTHORIZED
+            {"error": f"Authentication failed: {auth_error}"},
+            status=status.HTTP_401_UNAUTHORIZED if auth_status == 400 else auth_status
         )
 
     # --- 3) validate payload ---
@@ -1226,19 +1168,22 @@ def complete_bookings(request):
             {'$set': {'status': 'Completed'}}
         )
 
-        # 2) Fail all BOOKED bookings
+        # 2) Fail all bookings nobody boarded with
         result_booked = bookings_collection.update_many(
             {
                 'trip_id': trip_id,
                 'bus_id':   bus_id,
-                'status':  'Booked'
+                'status':  {'$in': list(UNUSED_STATUSES)}
             },
             {'$set': {'status': 'Failed'}}
         )
 
+        # the same `completed` flag the sweeper and the schedulers use
         result_trip = bus_trip_collection.update_one(
             {'_id': trip_obj_id, 'bus_id': bus_id},
-            {'$set': {'Completed': True}}
+            {'$set': {'completed': True,
+                      'completed_at': datetime.datetime.now(datetime.timezone.utc)},
+             '$unset': {'Completed': ''}}
         )
 
         # Optionally combine counts for your response
@@ -1266,26 +1211,10 @@ def turn_machine_off(request):
     if not jwt_token:
         return Response({"error": "JWT token missing in header"}, status=status.HTTP_400_BAD_REQUEST)
 
-    # Authenticate and get bus_id
-
-    try:
-        auth_response = requests.post(
-            # 10 seconds timeout
-            VALIDATE_URL, json={"token": jwt_token}, timeout=10)
-        auth_response.raise_for_status()
-
-        # Printing the full response in the terminal
-        print(f"Response Status Code: {auth_response.status_code}")
-        print("Response JSON:")
-        print(auth_response.json())
-
-        auth_data = auth_response.json()
-        bus_id = auth_data.get("bus_id")
-    except requests.exceptions.RequestException as e:
-        print(f"Authentication failed: {str(e)}")
-
-    if not bus_id:
-        return Response({"error": "No bus_id found in authentication response"}, status=status.HTTP_400_BAD_REQUEST)
+    # Authenticate and get bus_id (checked in-process, no HTTP hop)
+    bus_id, auth_error, auth_status = validate_machine_token(jwt_token)
+    if auth_error:
+        return Response({"error": auth_error}, status=auth_status)
 
     # 3) Perform the “off” update
     try:
@@ -1306,6 +1235,8 @@ def turn_machine_off(request):
         }
     )
 
+    invalidate_token_version("MACHINE", bus_id)
+
     if result.modified_count == 1:
         return Response({"message": "Bus machine turned off successfully"})
     else:
@@ -1383,27 +1314,60 @@ def record_trip_locations(request):
         return Response({"error": "No valid location entries to record", "invalid_items": invalid},
                         status=status.HTTP_400_BAD_REQUEST)
 
-    now = datetime.datetime.now(tz).astimezone(utc_timezone)
-
-    # Upsert TripLocation doc and append to the bottom
-    result = trip_location_collection.update_one(
-        # we store trip_id as a string to match your other references-by-string pattern
-        {"trip_id": trip_id},
-        {
-            "$setOnInsert": {"trip_id": trip_id, "created_at": now},
-            "$set": {"updated_at": now},
-            "$push": {"locations": {"$each": cleaned}}
-        },
-        upsert=True
-    )
-
-    created = result.upserted_id is not None
-    doc = trip_location_collection.find_one({"trip_id": trip_id}, {"_id": 1})
+    # Append to the trip's current TripLocation bucket (a new one once it is
+    # full) and move the trip's latest position forward
+    bucket_id, created = record_locations(trip_id, cleaned)
 
     return Response({
         "message": "created TripLocation document" if created else "appended locations to existing TripLocation",
-        "trip_location_id": str(doc["_id"]) if doc else None,
+        "trip_location_id": str(bucket_id),
         "trip_id": trip_id,
         "added_count": len(cleaned),
         "invalid_items": invalid
     }, status=status.HTTP_201_CREATED if created else status.HTTP_200_OK)
+
+
+@api_view(['GET'])
+def trip_location_latest(request):
+    """
+    GET /bus-owners/live-location/latest/?trip_id=<trip_id>
+    Most recent fix of the trip (one primary-key read).
+    """
+    trip_id = request.GET.get('trip_id')
+    if not trip_id:
+        return Response({"error": "trip_id is required"}, status=status.HTTP_400_BAD_REQUEST)
+
+    latest = latest_location(trip_id)
+    if not latest:
+        return Response({"error": "No location recorded for this trip"}, status=status.HTTP_404_NOT_FOUND)
+
+    latest["trip_id"] = latest.pop("_id")
+    return Response(latest)
+
+
+@api_view(['GET'])
+def trip_location_history(request):
+    """
+    GET /bus-owners/live-location/history/?trip_id=<trip_id>&since=<iso>
+    Fixes from at most a few TripLocation buckets, oldest first. Pass the
+    returned `next_since` as `since` to read the next page.
+    """
+    trip_id = request.GET.get('trip_id')
+    if not trip_id:
+        return Response({"error": "trip_id is required"}, status=status.HTTP_400_BAD_REQUEST)
+
+    since = request.GET.get('since')
+    if since:
+        try:
+            since = datetime.datetime.fromisoformat(since.replace('Z', '+00:00'))
+        except ValueError:
+            return Response({"error": "since must be an ISO 8601 timestamp"}, status=status.HTTP_400_BAD_REQUEST)
+    else:
+        since = None
+
+    fixes, next_since = location_history(trip_id, since)
+    return Response({
+        "trip_id": trip_id,
+        "locations": fixes,
+        "next_since": next_since,
+    })
@@ -0,0 +1,145 @@
+"""
+In-memory autocomplete over BoardingPoints.
+
+Every point is indexed under its `name`, `si_name` and `ta_name`
+(casefolded, NFC-normalised). Prefix matches come from a sorted key list
+via bisect and substring matches from n-gram postings, so one lookup
+answers both without scanning the collection. Prefix hits rank before
+substring hits and results are capped. The index is rebuilt every
+BOARDING_SEARCH_TTL seconds, or on the next search after
+create_edit_boarding_point calls `invalidate()`.
+"""
+import bisect
+import threading
+import time
+import unicodedata
+
+from django.conf import settings
+
+from passenger.mongo import get_collection
+
+
+boarding_points_collection = get_collection('BoardingPoints')
+
+NAME_FIELDS = ('name', 'si_name', 'ta_name')
+RESULT_FIELDS = ('name', 'si_name', 'ta_name', 'city', 'province')
+
+# grams up to this length are posted; longer queries intersect trigram
+# postings and then confirm with a plain substring test
+GRAM_SIZE = 3
+
+
+def normalize(text):
+    return unicodedata.normalize('NFC', str(text)).casefold().strip()
+
+
+def _grams(key, n):
+    return {key[i:i + n] for i in range(len(key) - n + 1)}
+
+
+class BoardingPointIndex:
+
+    def __init__(self):
+        # (points, keys, sorted_keys, postings), swapped as one object:
+        #   points      slim result dicts, position = point index
+        #   keys        per point: tuple of normalized names
+        #   sorted_keys sorted (key, point index) for prefix search
+        #   postings    gram -> set of point indexes
+        self._snapshot = ([], [], [], {})
+        self._built_at = None
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        self._built_at = None
+
+    def _ensure_fresh(self):
+        built_at = self._built_at
+        if built_at is None or time.monotonic() - built_at > settings.BOARDING_SEARCH_TTL:
+            with self._lock:
+                if self._built_at is built_at:
+                    self._rebuild()
+
+    def _rebuild(self):
+        points, keys, sorted_keys, postings = [], [], [], {}
+        projection = {field: 1 for field in RESULT_FIELDS}
+
+        for doc in boarding_points_collection.find({}, projection):
+            names = tuple(dict.fromkeys(
+                normalize(doc[f]) for f in NAME_FIELDS if doc.get(f)))
+            if not names:
+                continue
+
+            idx = len(points)
+            point = {'_id': str(doc['_id'])}
+            point.update({f: doc[f] for f in RESULT_FIELDS if f in doc})
+            points.append(point)
+            keys.append(names)
+
+            for key in names:
+                sorted_keys.append((key, idx))
+                for n in range(1, GRAM_SIZE + 1):
+                    for gram in _grams(key, n):
+                        postings.setdefault(gram, set()).add(idx)
+
+        sorted_keys.sort()
+        self._snapshot = (points, keys, sorted_keys, postings)
+        self._built_at = time.monotonic()
+
+    def _prefix_hits(self, q, sorted_keys):
+        pos = bisect.bisect_left(sorted_keys, (q, -1))
+        while pos < len(sorted_keys) and sorted_keys[pos][0].startswith(q):
+            yield sorted_keys[pos][1]
+            pos += 1
+
+    def _substring_candidates(self, q, postings):
+        if len(q) <= GRAM_SIZE:
+            return postings.get(q, set())
+
+        grams = sorted(_grams(q, GRAM_SIZE),
+                       key=lambda g: len(postings.get(g, ())))
+        candidates = set(postings.get(grams[0], ()))
+        for gram in grams[1:]:
+            if not candidates:
+                break
+            candidates &= postings.get(gram, set())
+        return candidates
+
+    def search(self, query, limit):
+        q = normalize(query)
+        if not q:
+            return []
+
+        self._ensure_fresh()
+        points, keys, sorted_keys, postings = self._snapshot
+
+        results, seen = [], set()
+        for idx in self._prefix_hits(q, sorted_keys):
+            if idx not in seen:
+                seen.add(idx)
+                results.append(points[idx])
+                if len(results) >= limit:
+                    return results
+
+        substring_hits = []
+        for idx in self._substring_candidates(q, postings):
+            if idx in seen:
+                continue
+            positions = [key.find(q) for key in keys[idx] if q in key]
+            if positions:
+                substring_hits.append((min(positions), keys[idx][0], idx))
+
+        substring_hits.sort()
+        for _, _, idx in substring_hits[:limit - len(results)]:
+            results.append(points[idx])
+        return results
+
+
+boarding_index = BoardingPointIndex()
+
+
+def search_boarding_points(query, limit):
+    return boarding_index.search(query, limit)
+
+
+def invalidate():
+    boarding_index.invalidate()
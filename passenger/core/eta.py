@@ -0,0 +1,91 @@
+"""
+Arrival estimates from route progress and live positions.
+
+At ingest, core.map_matching gives every fix its `progress_m` along the
+route's geometry (core.route_geometry); consecutive fixes then give the
+speed driven in each section (`observe`). The trip's progress and
+per-section speeds ride along on TripLatestLocation and in the live
+position cache, so an estimate (`eta_for`) is one overlap sum of the
+remaining segments divided by their section speeds, with
+ETA_DEFAULT_SPEED_KMH for sections nobody has driven yet.
+"""
+import datetime
+
+import numpy as np
+
+from bus_owners.live_positions import live_positions
+from core.route_geometry import geometries
+
+
+# a fresh observation's weight against the section speed already known
+SPEED_SMOOTHING = 0.5
+# consecutive fixes further apart than this say nothing about speed
+MAX_FIX_GAP_SECONDS = 300
+
+
+def observe(fixes, geometry, previous):
+    """
+    Fields to store with the trip's latest fix: `progress_m` of the last of
+    `fixes` (sorted by time, already map-matched) and `section_speeds` (m/s,
+    keyed by section number) updated with the speeds driven since
+    `previous`, the latest fix stored before them. {} when none of the
+    fixes could be placed on the route.
+    """
+    matched = [f for f in fixes if f.get('progress_m') is not None]
+    if not matched:
+        return {}
+    progress = np.array([f['progress_m'] for f in matched])
+    seconds = np.array([f['timestamp'].timestamp() for f in matched])
+
+    speeds = dict((previous or {}).get('section_speeds') or {})
+    if previous and previous.get('progress_m') is not None:
+        # carry on from the fix stored before this batch
+        progress = np.concatenate(([previous['progress_m']], progress))
+        seconds = np.concatenate(([previous['timestamp'].timestamp()], seconds))
+
+    dp, dt = np.diff(progress), np.diff(seconds)
+    # progress never goes back; standing still counts, long gaps do not
+    usable = (dt > 0) & (dt <= MAX_FIX_GAP_SECONDS)
+    if usable.any():
+        sections = np.array([geometry.section_at(p) for p in progress[:-1]])[usable]
+        dp, dt = dp[usable], dt[usable]
+        for sec in np.unique(sections):
+            mask = sections == sec
+            observed = float(dp[mask].sum() / dt[mask].sum())
+            key = str(int(sec))
+            old = speeds.get(key)
+            speeds[key] = observed if old is None else (
+                SPEED_SMOOTHING * observed + (1 - SPEED_SMOOTHING) * old)
+
+    return {'progress_m': float(progress[-1]), 'section_speeds': speeds}
+
+
+def eta_for(trip_id, route_id, point_id, route=None):
+    """
+    Estimated arrival of the trip's bus at boarding point `point_id`:
+    {"seconds", "arrival_time", "distance_m", "position_time"}, or None
+    when there is no live position or the point is not on the route.
+    """
+    fix, _ = live_positions.get(str(trip_id))
+    if fix is None or not route_id:
+        return None
+    geometry = geometries.for_route(route_id, route)
+    if geometry is None or point_id not in geometry.point_progress:
+        return None
+
+    progress = fix.get('progress_m')
+    if progress is None:
+        # stored before map matching, or off the route
+        progress, _ = geometry.project(fix['latitude'], fix['longitude'])
+    target = geometry.point_progress[point_id]
+    distance = max(target - progress, 0.0)
+
+    arrival = fix['timestamp'] + datetime.timedelta(
+        seconds=geometry.travel_seconds(progress, target, fix.get('section_speeds') or {}))
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return {
+        'seconds': max(int((arrival - now).total_seconds()), 0),
+        'arrival_time': max(arrival, now).isoformat(),
+        'distance_m': round(distance),
+        'position_time': fix['timestamp'].isoformat(),
+    }
@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand
+
+from core.route_geometry import build_route_geometry, directions_client
+from passenger.mongo import close_client, get_collection
+
+
+routes_collection = get_collection('Routes')
+
+
+class Command(BaseCommand):
+    help = (
+        "Fetch, resample and store the road polyline of every route (or the "
+        "given ones). Routes whose boarding points have not moved since their "
+        "polyline was built are skipped unless --force is given."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("route_ids", nargs="*")
+        parser.add_argument("--force", action="store_true",
+                            help="Rebuild even when the boarding points are unchanged.")
+
+    def handle(self, *args, **options):
+        route_ids = options["route_ids"] or [
+            str(r["_id"]) for r in routes_collection.find({}, {"_id": 1})]
+        client = directions_client()
+
+        built = failed = 0
+        try:
+            for route_id in route_ids:
+                try:
+                    geometry = build_route_geometry(route_id, client=client, force=options["force"])
+                except Exception as e:
+                    failed += 1
+                    self.stderr.write(f"{route_id}: {e}")
+                    continue
+                if geometry is None:
+                    self.stdout.write(f"{route_id}: fewer than two placed boarding points, skipped")
+                    continue
+                built += 1
+                self.stdout.write(
+                    f"{route_id}: {geometry['points']} points, {geometry['length_m'] / 1000:.1f} km")
+        finally:
+            close_client()
+
+        self.stdout.write(self.style.SUCCESS(f"{built} routes with geometry, {failed} failed"))
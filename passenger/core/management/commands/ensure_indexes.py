@@ -0,0 +1,125 @@
+from django.core.management.base import BaseCommand, CommandError
+from pymongo import IndexModel
+
+from passenger.indexes import INDEXES, CANONICAL_QUERIES
+from passenger.mongo import get_db, close_client
+
+
+# options that change what an index does; an existing index with the same
+# keys but different values here is not the index that was declared
+_COMPARED_OPTIONS = {
+    "unique": False,
+    "sparse": False,
+    "expireAfterSeconds": None,
+    "partialFilterExpression": None,
+}
+
+
+def _index_options(spec):
+    """The _COMPARED_OPTIONS of an index_information() entry or declared opts."""
+    return {name: spec.get(name, default) for name, default in _COMPARED_OPTIONS.items()}
+
+
+def _plan_stages(node):
+    """Yield every `stage` name found anywhere in an explain() plan."""
+    if isinstance(node, dict):
+        stage = node.get("stage")
+        if stage:
+            yield stage
+        for value in node.values():
+            yield from _plan_stages(value)
+    elif isinstance(node, list):
+        for item in node:
+            yield from _plan_stages(item)
+
+
+class Command(BaseCommand):
+    help = (
+        "Create the indexes declared in passenger/indexes.py, bring their TTLs "
+        "in line, fail on any other option mismatch, and verify that no "
+        "canonical view query is planned as a COLLSCAN."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--check-only", action="store_true",
+            help="Do not create anything, only run the explain() checks.")
+        parser.add_argument(
+            "--skip-explain", action="store_true",
+            help="Create the indexes but skip the explain() checks.")
+
+    def handle(self, *args, **options):
+        db = get_db()
+        try:
+            if not options["check_only"]:
+                self._ensure_indexes(db)
+            if not options["skip_explain"]:
+                self._verify_plans(db)
+        finally:
+            close_client()
+
+    def _ensure_indexes(self, db):
+        existing = {}
+        mismatched = []
+        for coll_name, keys, opts in INDEXES:
+            if coll_name not in existing:
+                info = db[coll_name].index_information()
+                existing[coll_name] = {tuple(ix["key"]): _index_options(ix) for ix in info.values()}
+
+            key_spec = tuple((field, direction) for field, direction in keys)
+            wanted = _index_options(opts)
+            current = existing[coll_name].get(key_spec)
+            if current is None:
+                db[coll_name].create_indexes([IndexModel(list(keys), **opts)])
+                existing[coll_name][key_spec] = wanted
+                self.stdout.write(self.style.SUCCESS(
+                    f"  created {coll_name} {list(key_spec)}"))
+                continue
+
+            if current == wanted:
+                self.stdout.write(f"  ok      {coll_name} {list(key_spec)}")
+                continue
+
+            differs = {name for name in wanted if current[name] != wanted[name]}
+            if differs == {"expireAfterSeconds"} and wanted["expireAfterSeconds"] is not None:
+                # a TTL can be changed in place; anything else needs a rebuild
+                db.command("collMod", coll_name, index={
+                    "keyPattern": dict(key_spec),
+                    "expireAfterSeconds": wanted["expireAfterSeconds"],
+                })
+                existing[coll_name][key_spec] = wanted
+                self.stdout.write(self.style.SUCCESS(
+                    f"  ttl     {coll_name} {list(key_spec)} -> {wanted['expireAfterSeconds']}s"))
+                continue
+
+            mismatched.append(f"{coll_name} {list(key_spec)}")
+            self.stdout.write(self.style.ERROR(
+                f"  differs {coll_name} {list(key_spec)}: " + ", ".join(
+                    f"{name} is {current[name]!r}, declared {wanted[name]!r}"
+                    for name in sorted(differs))))
+
+        if mismatched:
+            raise CommandError(
+                f"{len(mismatched)} existing index(es) differ from passenger/indexes.py "
+                f"and must be dropped and recreated by hand: {', '.join(mismatched)}")
+
+    def _verify_plans(self, db):
+        failures = []
+        for name, (coll_name, query, sort) in CANONICAL_QUERIES.items():
+            cursor = db[coll_name].find(query)
+            if sort:
+                cursor = cursor.sort(sort)
+            plan = cursor.explain().get("queryPlanner", {})
+            stages = list(_plan_stages(plan.get("winningPlan", {})))
+
+            if "COLLSCAN" in stages:
+                failures.append(name)
+                self.stdout.write(self.style.ERROR(
+                    f"  COLLSCAN {name} ({coll_name})"))
+            else:
+                self.stdout.write(f"  ok      {name}: {' <- '.join(stages)}")
+
+        if failures:
+            raise CommandError(
+                f"{len(failures)} canonical quer{'y' if len(failures) == 1 else 'ies'} "
+                f"fell back to COLLSCAN: {', '.join(failures)}")
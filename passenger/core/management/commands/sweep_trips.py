@@ -0,0 +1,40 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from core.trip_lifecycle import archive_old_trips, sweep_finished_trips
+from members.booking_engine import recover_transitions
+from passenger.mongo import close_client
+
+
+class Command(BaseCommand):
+    help = (
+        "Settle interrupted booking cancels/reschedules, close trips past "
+        "their end window (their bookings become Completed or Failed) and "
+        "move completed trips older than TRIP_ARCHIVE_AFTER_DAYS to "
+        "BusTripsArchive. Safe to re-run."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=settings.TRIP_SWEEP_BATCH_SIZE,
+                            help="Trips per update/archive batch.")
+        parser.add_argument("--archive-after-days", type=int,
+                            default=settings.TRIP_ARCHIVE_AFTER_DAYS)
+        parser.add_argument("--no-archive", action="store_true",
+                            help="Only close finished trips.")
+
+    def handle(self, *args, **options):
+        try:
+            # settle interrupted cancels/reschedules before closing their trips
+            recovered = recover_transitions()
+            self.stdout.write(f"{recovered} interrupted booking changes settled")
+            swept = sweep_finished_trips(batch_size=options["batch_size"])
+            self.stdout.write(
+                f"{swept['trips']} trips closed, {swept['bookings_completed']} bookings "
+                f"completed, {swept['bookings_failed']} failed")
+            if not options["no_archive"]:
+                moved = archive_old_trips(days=options["archive_after_days"],
+                                          batch_size=options["batch_size"])
+                self.stdout.write(f"{moved} trips archived")
+        finally:
+            close_client()
+        self.stdout.write(self.style.SUCCESS("Trip sweep done"))
@@ -0,0 +1,50 @@
+"""
+Ingest-time map matching: every fix gets `progress_m`, the metres along
+its trip's route geometry (core.route_geometry) that it snaps to.
+
+Progress only moves forward. A fix snaps to the nearest segment within
+SNAP_RADIUS_M, preferring positions between the previous progress (less
+BACKTRACK_M of GPS jitter) and what the bus could have driven since at
+MAX_BUS_SPEED_MPS; a fix behind the previous progress keeps the previous
+value. Fixes further than SNAP_RADIUS_M from the line get `off_route` and
+carry the last progress on. Snapping looks only at the segments in the
+grid cells around the fix, so a batch costs a few small NumPy operations
+per fix whatever the route length.
+"""
+from core.route_geometry import SNAP_RADIUS_M, geometries
+
+
+BACKTRACK_M = 50
+# faster than any bus on our roads; bounds how far one fix can jump ahead
+MAX_BUS_SPEED_MPS = 30
+
+
+def match_fixes(trip_id, fixes, previous=None):
+    """
+    Set `progress_m` (or `off_route`) on `fixes`, sorted by time, carrying
+    on from `previous`, the trip's latest stored fix. Returns the route
+    geometry, or None when the trip's route has none (fixes left as is).
+    """
+    geometry = geometries.for_trip(trip_id)
+    if geometry is None:
+        return None
+
+    progress = (previous or {}).get('progress_m')
+    last_at = previous['timestamp'] if progress is not None else None
+
+    for fix in fixes:
+        after = before = None
+        if progress is not None:
+            after = progress - BACKTRACK_M
+            elapsed = max((fix['timestamp'] - last_at).total_seconds(), 0)
+            before = progress + elapsed * MAX_BUS_SPEED_MPS + SNAP_RADIUS_M
+
+        snapped = geometry.snap(fix['latitude'], fix['longitude'], after, before)
+        if snapped is None:
+            fix['off_route'] = True
+        else:
+            progress = snapped if progress is None else max(progress, snapped)
+            last_at = fix['timestamp']
+        if progress is not None:
+            fix['progress_m'] = round(progress, 1)
+    return geometry
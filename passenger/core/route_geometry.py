@@ -0,0 +1,356 @@
+"""
+Road geometry of a route, fetched once per edit and stored on the route.
+
+The route's boarding points, in section order, are sent to the Directions
+API (in order, at most DIRECTIONS_MAX_WAYPOINTS per request). The returned
+road polylines are joined, resampled to ROUTE_POLYLINE_POINTS evenly spaced
+points with NumPy cumulative-distance interpolation, and saved as
+
+    geometry: {polyline, points, length_m, source, built_at}
+
+where `polyline` is a Google encoded polyline and `source` fingerprints
+the boarding points it was built from, so an edit that does not move a
+point does not cost a new Directions call.
+
+The Directions client comes from settings.ROUTE_DIRECTIONS_CLIENT, a
+dotted path to a factory returning an object with googlemaps'
+`directions(origin, destination, waypoints=..., mode=...)`, so a local
+stub can stand in for Google.
+
+`geometries` keeps a RouteGeometry per route in memory for map matching
+and arrival estimates.
+"""
+import datetime
+import hashlib
+import logging
+import threading
+import time
+
+import numpy as np
+import polyline
+from bson import ObjectId
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from core.route_index import section_number
+from passenger.mongo import get_collection
+
+
+logger = logging.getLogger(__name__)
+
+routes_collection = get_collection('Routes')
+bustrips_collection = get_collection('BusTrips')
+
+EARTH_RADIUS_M = 6371008.8
+
+# Directions API limit on waypoints between origin and destination
+DIRECTIONS_MAX_WAYPOINTS = 25
+
+
+def haversine_m(lat1, lon1, lat2, lon2):
+    """Great-circle distance in metres; works element-wise on arrays (degrees)."""
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = (np.sin((lat2 - lat1) / 2) ** 2
+         + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(a))
+
+
+def ordered_points(route):
+    """[(boarding_id, section_number, lat, lon), ...] in route order, placeholders dropped."""
+    sections = sorted(
+        ((section_number(s), s) for s in route.get('sections', [])),
+        key=lambda item: (item[0] is None, item[0] or 0))
+    points = []
+    for sec_num, section in sections:
+        for bp in section.get('boarding_points', []):
+            lat, lon = bp.get('latitude'), bp.get('longitude')
+            if lat is None or lon is None or (lat == 1 and lon == 1):
+                continue
+            points.append((bp.get('boarding_id'), sec_num or 0, float(lat), float(lon)))
+    return points
+
+
+def source_fingerprint(points):
+    raw = "|".join(f"{lat:.6f},{lon:.6f}" for _, _, lat, lon in points)
+    return hashlib.sha1(raw.encode()).hexdigest()
+
+
+def googlemaps_client():
+    import googlemaps
+    return googlemaps.Client(key=settings.GOOGLE_MAPS_API_KEY)
+
+
+def directions_client():
+    return import_string(settings.ROUTE_DIRECTIONS_CLIENT)()
+
+
+def fetch_road_path(coords, client):
+    """
+    Road path through `coords` [(lat, lon), ...] in the given order, as
+    [(lat, lon), ...]. Stops are never reordered: a bus route is not a
+    travelling-salesman problem.
+    """
+    path = []
+    step = DIRECTIONS_MAX_WAYPOINTS + 1
+    for start in range(0, len(coords) - 1, step):
+        leg = coords[start:start + step + 1]
+        resp = client.directions(leg[0], leg[-1], waypoints=leg[1:-1], mode='driving')
+        if not resp:
+            raise RuntimeError(f"No road found between {leg[0]} and {leg[-1]}.")
+        decoded = polyline.decode(resp[0]['overview_polyline']['points'])
+        # consecutive requests share their joining stop
+        path.extend(decoded[1:] if path else decoded)
+    return path
+
+
+def resample(path, num_points):
+    """`num_points` evenly spaced (lat, lon) along `path`, plus its length in metres."""
+    lat = np.array([p[0] for p in path], dtype=float)
+    lon = np.array([p[1] for p in path], dtype=float)
+    cum = np.concatenate(([0.0], np.cumsum(haversine_m(lat[:-1], lon[:-1], lat[1:], lon[1:]))))
+    if cum[-1] == 0:
+        raise RuntimeError("Route length is zero.")
+    targets = np.linspace(0.0, cum[-1], num_points)
+    return np.column_stack((np.interp(targets, cum, lat), np.interp(targets, cum, lon))), float(cum[-1])
+
+
+def decode(encoded):
+    """Encoded polyline -> (lat array, lon array)."""
+    coords = np.array(polyline.decode(encoded), dtype=float)
+    return coords[:, 0], coords[:, 1]
+
+
+def build_route_geometry(route_id, client=None, force=False):
+    """
+    Fetch, resample and store the road geometry of a route. Returns the
+    stored `geometry`, the existing one when the boarding points have not
+    moved (unless `force`), or None when the route has fewer than two
+    placed points.
+    """
+    route = routes_collection.find_one({'_id': ObjectId(route_id)}, {'sections': 1, 'geometry': 1})
+    if not route:
+        return None
+    points = ordered_points(route)
+    if len(points) < 2:
+        return None
+
+    source = source_fingerprint(points)
+    current = route.get('geometry')
+    if current and current.get('source') == source and not force:
+        return current
+
+    path = fetch_road_path([(lat, lon) for _, _, lat, lon in points], client or directions_client())
+    sampled, length = resample(path, settings.ROUTE_POLYLINE_POINTS)
+    geometry = {
+        'polyline': polyline.encode([tuple(p) for p in sampled.tolist()]),
+        'points': len(sampled),
+        'length_m': round(length),
+        'source': source,
+        'built_at': datetime.datetime.now(datetime.timezone.utc),
+    }
+    # only store it if the points did not move again while we were fetching
+    routes_collection.update_one(
+        {'_id': route['_id'], 'sections': route['sections']},
+        {'$set': {'geometry': geometry}})
+    return geometry
+
+
+def refresh_route_geometry(route_id):
+    """Rebuild after a route edit; a failed fetch must not fail the edit."""
+    try:
+        build_route_geometry(route_id)
+    except Exception:
+        logger.exception("Route geometry for %s not rebuilt", route_id)
+
+
+# edge of a spatial grid cell, and how far off the line a fix may be and
+# still be snapped to it
+GRID_CELL_M = 250
+SNAP_RADIUS_M = 300
+# segments spanning more cells than this (long straight stretches between
+# far-apart boarding points) are checked for every fix instead
+_MAX_CELLS_PER_SEGMENT = 64
+
+_GEOMETRY_PROJECTION = {
+    'sections.section_name': 1,
+    'sections.boarding_points.boarding_id': 1,
+    'sections.boarding_points.latitude': 1,
+    'sections.boarding_points.longitude': 1,
+    'geometry.polyline': 1,
+}
+
+
+class RouteGeometry:
+    """
+    A route as NumPy arrays: planar vertex coordinates for projecting a
+    position onto the line, haversine segment lengths and their running
+    sum (metres from the start), the section each segment belongs to, and
+    a grid of the segments passing through each GRID_CELL_M cell, so
+    snapping a fix only looks at the segments around it.
+    """
+
+    def __init__(self, lat, lon, points):
+        """
+        `lat` / `lon`: the line's vertices; `points`: the route's
+        [(boarding_id, section_number, lat, lon), ...] in route order.
+        """
+        # local equirectangular plane, good to well under a metre per segment
+        k_lon = np.radians(1) * EARTH_RADIUS_M * np.cos(np.radians(lat.mean()))
+        k_lat = np.radians(1) * EARTH_RADIUS_M
+        self._k = (k_lat, k_lon)
+        self._x0 = lon[:-1] * k_lon
+        self._y0 = lat[:-1] * k_lat
+        self._dx = lon[1:] * k_lon - self._x0
+        self._dy = lat[1:] * k_lat - self._y0
+        self._len2 = np.maximum(self._dx ** 2 + self._dy ** 2, 1e-9)
+        self._build_grid()
+
+        self.seg_len = haversine_m(lat[:-1], lon[:-1], lat[1:], lon[1:])
+        self.cum = np.concatenate(([0.0], np.cumsum(self.seg_len)))
+
+        # a point listed twice keeps its first position along the route
+        self.point_progress = {}
+        for boarding_id, _, p_lat, p_lon in points:
+            self.point_progress.setdefault(boarding_id, self.project(p_lat, p_lon)[0])
+        # a segment belongs to the section of the last point at or before its start
+        starts = np.array([self.point_progress[p[0]] for p in points])
+        sections = np.array([p[1] for p in points], dtype=int)
+        order = np.argsort(starts, kind='stable')
+        at = np.searchsorted(starts[order], self.cum[:-1], side='right') - 1
+        self.seg_section = sections[order][np.maximum(at, 0)]
+
+    @classmethod
+    def from_route(cls, route):
+        points = ordered_points(route)
+        if len(points) < 2:
+            return None
+        encoded = (route.get('geometry') or {}).get('polyline')
+        if encoded:
+            lat, lon = decode(encoded)
+        else:
+            lat = np.array([p[2] for p in points])
+            lon = np.array([p[3] for p in points])
+        return cls(lat, lon, points)
+
+    def _build_grid(self):
+        x1, y1 = self._x0 + self._dx, self._y0 + self._dy
+        lo_x = np.floor(np.minimum(self._x0, x1) / GRID_CELL_M).astype(int)
+        hi_x = np.floor(np.maximum(self._x0, x1) / GRID_CELL_M).astype(int)
+        lo_y = np.floor(np.minimum(self._y0, y1) / GRID_CELL_M).astype(int)
+        hi_y = np.floor(np.maximum(self._y0, y1) / GRID_CELL_M).astype(int)
+
+        grid, wide = {}, []
+        for i in range(len(self._x0)):
+            if (hi_x[i] - lo_x[i] + 1) * (hi_y[i] - lo_y[i] + 1) > _MAX_CELLS_PER_SEGMENT:
+                wide.append(i)
+                continue
+            for cx in range(lo_x[i], hi_x[i] + 1):
+                for cy in range(lo_y[i], hi_y[i] + 1):
+                    grid.setdefault((cx, cy), []).append(i)
+        self._grid = {cell: np.array(segs) for cell, segs in grid.items()}
+        self._wide = np.array(wide, dtype=int)
+
+    def _candidates(self, px, py):
+        """Segments that can lie within SNAP_RADIUS_M of the planar point."""
+        cx, cy = int(px // GRID_CELL_M), int(py // GRID_CELL_M)
+        reach = int(np.ceil(SNAP_RADIUS_M / GRID_CELL_M))
+        parts = [self._wide]
+        for gx in range(cx - reach, cx + reach + 1):
+            for gy in range(cy - reach, cy + reach + 1):
+                segs = self._grid.get((gx, gy))
+                if segs is not None:
+                    parts.append(segs)
+        return np.unique(np.concatenate(parts))
+
+    def _onto(self, segs, px, py):
+        """(progress, distance) arrays of the point's projection onto each of `segs`."""
+        t = np.clip(((px - self._x0[segs]) * self._dx[segs]
+                     + (py - self._y0[segs]) * self._dy[segs]) / self._len2[segs], 0, 1)
+        d2 = ((self._x0[segs] + t * self._dx[segs] - px) ** 2
+              + (self._y0[segs] + t * self._dy[segs] - py) ** 2)
+        return self.cum[segs] + t * self.seg_len[segs], np.sqrt(d2)
+
+    def project(self, lat, lon):
+        """(metres along the route, metres off it) of the nearest point of the whole line."""
+        progress, dist = self._onto(np.arange(len(self._x0)), lon * self._k[1], lat * self._k[0])
+        i = int(np.argmin(dist))
+        return float(progress[i]), float(dist[i])
+
+    def snap(self, lat, lon, after=None, before=None):
+        """
+        Metres along the route of the segment nearest to a fix, preferring
+        positions between `after` and `before` when one is in reach (so a
+        route that passes the same road twice snaps to the right pass).
+        None when no segment is within SNAP_RADIUS_M.
+        """
+        segs = self._candidates(lon * self._k[1], lat * self._k[0])
+        if not len(segs):
+            return None
+        progress, dist = self._onto(segs, lon * self._k[1], lat * self._k[0])
+        near = dist <= SNAP_RADIUS_M
+        if not near.any():
+            return None
+        window = near.copy()
+        if after is not None:
+            window &= progress >= after
+        if before is not None:
+            window &= progress <= before
+        pick = window if window.any() else near
+        i = np.flatnonzero(pick)[np.argmin(dist[pick])]
+        return float(progress[i])
+
+    def section_at(self, progress):
+        i = int(np.searchsorted(self.cum, progress, side='right')) - 1
+        return int(self.seg_section[min(max(i, 0), len(self.seg_section) - 1)])
+
+    def travel_seconds(self, from_m, to_m, section_speeds):
+        """Seconds to drive from `from_m` to `to_m` at the per-section speeds (m/s)."""
+        default = settings.ETA_DEFAULT_SPEED_KMH / 3.6
+        floor = settings.ETA_MIN_SPEED_KMH / 3.6
+        speeds = np.array([section_speeds.get(str(s), default) for s in self.seg_section])
+        overlap = np.clip(np.minimum(self.cum[1:], to_m) - np.maximum(self.cum[:-1], from_m), 0, None)
+        return float(np.sum(overlap / np.maximum(speeds, floor)))
+
+
+class _GeometryCache:
+    """RouteGeometry per route, built on first use and again after ROUTE_INDEX_TTL."""
+
+    def __init__(self):
+        self._routes = {}     # route_id -> (RouteGeometry or None, built_at)
+        self._trips = {}      # trip_id -> route_id; a trip never changes route
+        self._lock = threading.Lock()
+
+    def for_route(self, route_id, route=None):
+        route_id = str(route_id)
+        hit = self._routes.get(route_id)
+        if hit and time.monotonic() - hit[1] < settings.ROUTE_INDEX_TTL:
+            return hit[0]
+        if route is None:
+            route = routes_collection.find_one({'_id': ObjectId(route_id)}, _GEOMETRY_PROJECTION)
+        geometry = RouteGeometry.from_route(route) if route else None
+        with self._lock:
+            self._routes[route_id] = (geometry, time.monotonic())
+        return geometry
+
+    def for_trip(self, trip_id):
+        route_id = self.route_of_trip(trip_id)
+        return self.for_route(route_id) if route_id else None
+
+    def route_of_trip(self, trip_id):
+        route_id = self._trips.get(trip_id)
+        if route_id is None:
+            trip = bustrips_collection.find_one({'_id': ObjectId(trip_id)}, {'route_id': 1})
+            route_id = trip and trip.get('route_id')
+            if route_id:
+                with self._lock:
+                    if len(self._trips) > 10000:
+                        self._trips.clear()
+                    self._trips[trip_id] = route_id
+        return route_id
+
+    def forget_route(self, route_id):
+        with self._lock:
+            self._routes.pop(str(route_id), None)
+
+
+geometries = _GeometryCache()
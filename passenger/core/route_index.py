@@ -0,0 +1,133 @@
+"""
+In-memory boarding point -> route index used by trip search.
+
+Maps every boarding_id to the routes it sits on and the section number it
+belongs to, so matching an origin/destination pair is a dict intersection
+instead of a scan over every Routes document. The index is built lazily,
+patched in place when core.views edits a route, and rebuilt every
+ROUTE_INDEX_TTL seconds so edits made through other workers show up too.
+"""
+import threading
+import time
+
+from bson import ObjectId
+from django.conf import settings
+
+from passenger.mongo import get_collection
+
+
+routes_collection = get_collection('Routes')
+
+_PROJECTION = {
+    'sections.section_name': 1,
+    'sections.boarding_points.boarding_id': 1,
+}
+
+
+def section_number(section):
+    """'section 03' -> 3; None for names that do not end in a number."""
+    try:
+        return int(section.get('section_name', '').split()[-1])
+    except (ValueError, IndexError):
+        return None
+
+
+def _route_sections(route):
+    """{boarding_id: section_number} for one route document."""
+    sections = {}
+    for section in route.get('sections', []):
+        sec_num = section_number(section)
+        if sec_num is None:
+            continue
+        for bp in section.get('boarding_points', []):
+            boarding_id = bp.get('boarding_id')
+            if boarding_id is not None:
+                # a point listed twice keeps its last section, as the old scan did
+                sections[boarding_id] = sec_num
+    return sections
+
+
+class RouteIndex:
+
+    def __init__(self):
+        self._by_point = {}   # boarding_id -> {route_id: section_number}
+        self._by_route = {}   # route_id -> {boarding_id: section_number}
+        self._built_at = None
+        self._lock = threading.Lock()
+        # one thread rebuilds an expired index; the others wait and reuse it
+        self._build_lock = threading.Lock()
+
+    def _ensure_fresh(self):
+        built_at = self._built_at
+        if built_at is None or time.monotonic() - built_at > settings.ROUTE_INDEX_TTL:
+            with self._build_lock:
+                if self._built_at is built_at:
+                    self.rebuild()
+
+    def rebuild(self):
+        by_route = {
+            str(route['_id']): _route_sections(route)
+            for route in routes_collection.find({}, _PROJECTION)
+        }
+        by_point = {}
+        for route_id, sections in by_route.items():
+            for boarding_id, sec_num in sections.items():
+                by_point.setdefault(boarding_id, {})[route_id] = sec_num
+
+        with self._lock:
+            self._by_route = by_route
+            self._by_point = by_point
+            self._built_at = time.monotonic()
+
+    def patch_route(self, route_id):
+        """Re-read one route and swap its entries in (or drop it if deleted)."""
+        if self._built_at is None:
+            return  # nothing built yet; the first lookup will load everything
+
+        route_id = str(route_id)
+        route = routes_collection.find_one({'_id': ObjectId(route_id)}, _PROJECTION)
+        new_sections = _route_sections(route) if route else {}
+
+        with self._lock:
+            old_sections = self._by_route.get(route_id, {})
+            # inner dicts are replaced, never mutated, so readers iterating
+            # an older copy are not disturbed
+            for boarding_id in set(old_sections) | set(new_sections):
+                routes = dict(self._by_point.get(boarding_id, {}))
+                routes.pop(route_id, None)
+                if boarding_id in new_sections:
+                    routes[route_id] = new_sections[boarding_id]
+                if routes:
+                    self._by_point[boarding_id] = routes
+                else:
+                    self._by_point.pop(boarding_id, None)
+
+            if route:
+                self._by_route[route_id] = new_sections
+            else:
+                self._by_route.pop(route_id, None)
+
+    def routes_for_point(self, boarding_id):
+        self._ensure_fresh()
+        return self._by_point.get(boarding_id, {})
+
+    def matching_routes(self, start_point_id, end_point_id):
+        """Route ids where the start point comes in an earlier section than the end."""
+        self._ensure_fresh()
+        start_routes = self._by_point.get(start_point_id, {})
+        end_routes = self._by_point.get(end_point_id, {})
+        return [
+            route_id for route_id, start_sec in start_routes.items()
+            if route_id in end_routes and start_sec < end_routes[route_id]
+        ]
+
+
+route_index = RouteIndex()
+
+
+def matching_route_ids(start_point_id, end_point_id):
+    return route_index.matching_routes(start_point_id, end_point_id)
+
+
+def refresh_route(route_id):
+    route_index.patch_route(route_id)
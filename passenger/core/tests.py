@@ -1,3 +1,38 @@
-from django.test import TestCase
+import numpy as np
+from django.test import SimpleTestCase
 
-# Create your tests here.
+from core.route_geometry import RouteGeometry
+
+
+class RouteGeometryTests(SimpleTestCase):
+
+    def setUp(self):
+        self.points = [
+            ("a", 1, 6.900, 79.850),
+            ("b", 2, 6.910, 79.860),
+            ("c", 2, 6.920, 79.870),
+        ]
+        self.geometry = RouteGeometry(
+            np.array([p[2] for p in self.points]),
+            np.array([p[3] for p in self.points]),
+            self.points,
+        )
+
+    def test_boarding_points_get_increasing_progress(self):
+        progress = self.geometry.point_progress
+        self.assertEqual(progress["a"], 0.0)
+        self.assertLess(progress["a"], progress["b"])
+        self.assertLess(progress["b"], progress["c"])
+        self.assertAlmostEqual(progress["c"], self.geometry.cum[-1])
+
+    def test_project_point_on_the_line(self):
+        progress, distance = self.geometry.project(6.905, 79.855)
+        self.assertAlmostEqual(progress, self.geometry.point_progress["b"] / 2, delta=1)
+        self.assertLess(distance, 1)
+
+    def test_snap_and_section(self):
+        progress = self.geometry.snap(6.915, 79.865)
+        self.assertGreater(progress, self.geometry.point_progress["b"])
+        self.assertEqual(self.geometry.section_at(progress), 2)
+        self.assertEqual(self.geometry.section_at(10.0), 1)
+        self.assertIsNone(self.geometry.snap(7.5, 80.5))
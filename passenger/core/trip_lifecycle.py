@@ -0,0 +1,110 @@
+"""
+Closing out finished trips and moving old ones out of BusTrips.
+
+`sweep_finished_trips` takes unfinished trips that started more than
+TRIP_END_WINDOW_HOURS ago, a bounded batch at a time through the
+(completed, trip_start_time) index, moves their bookings to a terminal
+status (Verified -> Completed; still Booked, rescheduled or Pending ->
+Failed) and marks the trips `completed`. Bookings go first, so a sweep
+that dies half way just does the batch again next time.
+
+`archive_old_trips` copies completed trips older than TRIP_ARCHIVE_AFTER_DAYS
+into BusTripsArchive with only their summary fields, then deletes them from
+BusTrips, so the hot collection only holds recent trips and stays in RAM.
+"""
+import datetime
+
+from django.conf import settings
+from pymongo import ReplaceOne
+
+from passenger.mongo import get_collection
+
+
+bus_trip_collection = get_collection('BusTrips')
+bus_trip_archive_collection = get_collection('BusTripsArchive')
+bookings_collection = get_collection('Bookings')
+
+# still-open booking statuses a finished trip turns into Failed (no-shows)
+UNUSED_STATUSES = ("Pending", "Booked", "Rescedule_1", "Rescheduled_1")
+
+# what an archived trip keeps; seats, occupancy and legacy tickets are dropped
+ARCHIVE_FIELDS = (
+    "route_id", "route_name", "bus_id", "bus_number", "bus_name", "seat_type",
+    "fare_type_id", "fare_type_name", "trip_start_time", "booking_price",
+    "seat_count", "booked_seats", "booked_revenue", "company_3_percent_cut",
+    "is_revenue_released", "tickets_revenue", "number_of_tickets",
+    "is_bus_trip_cancelled", "cancellation_fee_resolved", "completed_at",
+)
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def close_bookings(trip_ids):
+    """Move the bookings of finished trips to a terminal status; returns (completed, failed)."""
+    completed = bookings_collection.update_many(
+        {"trip_id": {"$in": trip_ids}, "status": "Verified"},
+        {"$set": {"status": "Completed"}})
+    failed = bookings_collection.update_many(
+        {"trip_id": {"$in": trip_ids}, "status": {"$in": list(UNUSED_STATUSES)}},
+        {"$set": {"status": "Failed"}})
+    return completed.modified_count, failed.modified_count
+
+
+def sweep_finished_trips(now=None, batch_size=None):
+    """Close every trip past its end window; returns counts of what changed."""
+    now = now or _now()
+    batch_size = batch_size or settings.TRIP_SWEEP_BATCH_SIZE
+    cutoff = now - datetime.timedelta(hours=settings.TRIP_END_WINDOW_HOURS)
+    totals = {"trips": 0, "bookings_completed": 0, "bookings_failed": 0}
+
+    while True:
+        ids = [t["_id"] for t in bus_trip_collection.find(
+            {"completed": False, "trip_start_time": {"$lt": cutoff}}, {"_id": 1}
+        ).sort("trip_start_time", 1).limit(batch_size)]
+        if not ids:
+            return totals
+
+        done, failed = close_bookings([str(i) for i in ids])
+        result = bus_trip_collection.update_many(
+            {"_id": {"$in": ids}, "completed": False},
+            {"$set": {"completed": True, "completed_at": now},
+             # the flag complete_bookings used to write; nothing reads it
+             "$unset": {"Completed": ""}})
+
+        totals["trips"] += result.modified_count
+        totals["bookings_completed"] += done
+        totals["bookings_failed"] += failed
+
+
+def archive_document(trip, now):
+    doc = {f: trip[f] for f in ARCHIVE_FIELDS if f in trip}
+    doc["_id"] = trip["_id"]
+    doc["archived_at"] = now
+    return doc
+
+
+def archive_old_trips(now=None, days=None, batch_size=None):
+    """Move completed trips older than `days` to BusTripsArchive; returns how many moved."""
+    now = now or _now()
+    days = settings.TRIP_ARCHIVE_AFTER_DAYS if days is None else days
+    batch_size = batch_size or settings.TRIP_SWEEP_BATCH_SIZE
+    cutoff = now - datetime.timedelta(days=days)
+    projection = {f: 1 for f in ARCHIVE_FIELDS}
+    moved = 0
+
+    while True:
+        trips = list(bus_trip_collection.find(
+            {"completed": True, "trip_start_time": {"$lt": cutoff}}, projection
+        ).sort("trip_start_time", 1).limit(batch_size))
+        if not trips:
+            return moved
+
+        # upserts make a re-run after a crash between the two steps harmless
+        bus_trip_archive_collection.bulk_write(
+            [ReplaceOne({"_id": t["_id"]}, archive_document(t, now), upsert=True) for t in trips],
+            ordered=False)
+        result = bus_trip_collection.delete_many(
+            {"_id": {"$in": [t["_id"] for t in trips]}, "completed": True})
+        moved += result.deleted_count
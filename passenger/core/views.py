@@ -4,30 +4,25 @@ from datetime import timezone
 from dateutil import parser
 import bcrypt
 from django.shortcuts import render, redirect
-from django.conf import settings
 from bson import ObjectId
 from rest_framework import status
 from rest_framework.response import Response
 from rest_framework.decorators import api_view
-from pymongo import MongoClient
-from passenger.settings import get_access_token_from_request, validate_token, create_admin_access_token, create_admin_refresh_token, validate_admin_token
+from passenger.mongo import get_collection
+from core import boarding_search
+from core.route_geometry import geometries, refresh_route_geometry
+from core.route_index import refresh_route
+from members import search_cache, seat_inventory
+from passenger.settings import get_access_token_from_request, get_request_principal, create_admin_access_token, create_admin_refresh_token, validate_admin_token
 
 
-mongodb_uri = settings.DATABASE
-
-# MongoDB client setup using the URI
-client = MongoClient(mongodb_uri)
-# Access your database (assuming the name is 'Passenger')
-db = client['Passenger']
-# Access the 'users' collection (or your actual collection name)
-user_collection = db['Users']
-bus_collection = db['Buses']
-bus_owner_collection = db['BusOwners']
-bus_trip_collection = db['BusTrips']
-routes_collection = db['Routes']
-# Adjust collection name if needed
-boarding_points_collection = db['BoardingPoints']
-admin_collection = db['Admin']
+user_collection = get_collection('Users')
+bus_collection = get_collection('Buses')
+bus_owner_collection = get_collection('BusOwners')
+bus_trip_collection = get_collection('BusTrips')
+routes_collection = get_collection('Routes')
+boarding_points_collection = get_collection('BoardingPoints')
+admin_collection = get_collection('Admin')
 
 
 def edit_bp_form(request):
@@ -189,6 +184,11 @@ def create_edit_route(request):
         if result.matched_count == 0:
             return Response({"error": "Route not found."}, status=status.HTTP_404_NOT_FOUND)
 
+        if "sections" in payload:
+            refresh_route(oid)
+            refresh_route_geometry(oid)
+            geometries.forget_route(oid)
+
         return Response({"status": "updated", "modified_count": result.modified_count}, status=status.HTTP_200_OK)
 
     # 3. CREATE new route
@@ -226,6 +226,8 @@ def create_edit_route(request):
     }
 
     inserted = routes_collection.insert_one(new_doc)
+    refresh_route(inserted.inserted_id)
+    refresh_route_geometry(inserted.inserted_id)
     return Response(
         {"status": "created", "_id": str(inserted.inserted_id)},
         status=status.HTTP_201_CREATED
@@ -336,6 +338,10 @@ def add_boarding_point_to_route(request):
             status=status.HTTP_404_NOT_FOUND
         )
 
+    refresh_route(rid)
+    refresh_route_geometry(rid)
+    geometries.forget_route(rid)
+
     return Response(
         {
             "status": "success",
@@ -396,6 +402,7 @@ def create_edit_boarding_point(request):
         if result.matched_count == 0:
             return Response({"error": "Boarding point not found"}, status=status.HTTP_404_NOT_FOUND)
 
+        boarding_search.invalidate()
         return Response(
             {"status": "updated", "modified_count": result.modified_count},
             status=status.HTTP_200_OK
@@ -403,6 +410,7 @@ def create_edit_boarding_point(request):
 
     # CREATE new document
     inserted = boarding_points_collection.insert_one(payload)
+    boarding_search.invalidate()
     return Response(
         {"status": "created", "_id": str(inserted.inserted_id)},
         status=status.HTTP_201_CREATED
@@ -437,13 +445,13 @@ def create_bus_trip_api(request):
     if not access_token:
         return Response({"error": "Access token required"}, status=status.HTTP_401_UNAUTHORIZED)
 
-    owner_id = validate_token(access_token)
-    # owner_id = "682ded79908b017a067fe9a9"
-    if owner_id is None:
+    principal = get_request_principal(request)
+    if principal is None:
         return Response({"error": "Invalid or expired access token"}, status=status.HTTP_401_UNAUTHORIZED)
+    owner_id = principal.user_id
 
     ### 2) Load owner and verify they exist ###
-    owner = bus_owner_collection.find_one({"_id": ObjectId(owner_id)})
+    owner = principal.document_as("OWNER")
     if not owner:
         return Response({"error": "Bus owner not found"}, status=status.HTTP_404_NOT_FOUND)
 
@@ -529,10 +537,14 @@ def create_bus_trip_api(request):
         "cancellation_fee_resolved": False,
         "completed": False,
         "bookings": seats,
+        "seat_count": number_of_seats,
+        "occupancy": seat_inventory.empty_occupancy(number_of_seats),
     }
 
     result = bus_trip_collection.insert_one(bus_trip_doc)
     bus_trip_doc["_id"] = str(result.inserted_id)
+    # searches cached before this trip existed would not show it
+    search_cache.invalidate_route(data["route_id"])
 
     return Response(bus_trip_doc, status=status.HTTP_201_CREATED)
 
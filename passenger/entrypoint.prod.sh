@@ -1,9 +1,11 @@
 #!/bin/bash
+# cron jobs do not inherit the container environment
+printenv | grep -v '^no_proxy' > /etc/environment
 cron 
 python manage.py collectstatic --noinput
 crontab -l
 
 exec su -s /bin/bash passengeradmin -c "\
     python manage.py collectstatic --noinput && \
-    exec gunicorn --bind 0.0.0.0:8000 --workers 3 passenger.wsgi:application\
+    exec gunicorn --bind 0.0.0.0:8000 --workers 3 --worker-class gthread --threads 32 passenger.wsgi:application\
 "
\ No newline at end of file
@@ -0,0 +1,162 @@
+"""
+Departure alerts at fixed offsets before each trip starts.
+
+Instead of walking every unfinished trip, the scheduler asks the
+trip_start_time index only for trips starting within the largest offset
+(plus one scan interval), and queues one (fire_at, trip, offset) entry per
+offset in an in-process heap. Each entry fires at exactly
+trip_start_time - offset: the trip's booked passengers are read then and
+alerted, each at most once per offset thanks to the AlertLedger, whose
+`_id = "<booking_id>:<offset>"` is claimed before sending. The ledger also
+makes it safe to run more than one scheduler or to re-run a pass. The
+alerts themselves go through the notification outbox (members/outbox.py).
+"""
+import datetime
+import heapq
+import time
+
+from bson import ObjectId
+from django.conf import settings
+from pymongo.errors import BulkWriteError
+
+from members.booking_engine import BOOKED_STATUSES
+from members.outbox import enqueue_departure_alert
+from passenger.mongo import get_collection
+
+
+bustrips_collection = get_collection('BusTrips')
+bookings_collection = get_collection('Bookings')
+alert_ledger_collection = get_collection('AlertLedger')
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def _aware(ts):
+    # stored datetimes come back naive (UTC)
+    return ts.replace(tzinfo=datetime.timezone.utc) if ts.tzinfo is None else ts
+
+
+def upcoming_trips(now, horizon):
+    """{trip_id: start time} of unfinished trips starting in (now, now + horizon]."""
+    cursor = bustrips_collection.find(
+        {"trip_start_time": {"$gt": now, "$lte": now + horizon}, "completed": False},
+        {"trip_start_time": 1},
+    )
+    return {str(t["_id"]): _aware(t["trip_start_time"]) for t in cursor}
+
+
+_DUPLICATE_KEY = 11000
+
+
+def claim(bookings, offset, trip_id):
+    """The bookings whose alert for `offset` had not been claimed yet (now claimed)."""
+    if not bookings:
+        return []
+    now = _now()
+    duplicates = set()
+    try:
+        alert_ledger_collection.insert_many([{
+            "_id": f"{booking['_id']}:{offset}",
+            "trip_id": trip_id,
+            "offset": offset,
+            "created_at": now,
+        } for booking in bookings], ordered=False)
+    except BulkWriteError as e:
+        for error in e.details.get("writeErrors", []):
+            if error.get("code") != _DUPLICATE_KEY:
+                raise
+            duplicates.add(error["index"])
+    return [b for i, b in enumerate(bookings) if i not in duplicates]
+
+
+def alert_trip(trip_id, offset):
+    """Queue the alert for one offset to every booked passenger of a trip not alerted yet; returns how many."""
+    bookings = list(bookings_collection.find(
+        {"trip_id": trip_id, "status": {"$in": list(BOOKED_STATUSES)}},
+        {"user_id": 1},
+    ))
+    claimed = claim(bookings, offset, trip_id)
+    if not claimed:
+        return 0
+    enqueue_departure_alert([b["user_id"] for b in claimed], offset)
+    return len(claimed)
+
+
+class DepartureAlertScheduler:
+
+    def __init__(self, offsets=None, scan_seconds=None, grace_seconds=None):
+        self.offsets = sorted(offsets or settings.DEPARTURE_ALERT_OFFSETS, reverse=True)
+        self.scan_seconds = scan_seconds or settings.DEPARTURE_ALERT_SCAN_SECONDS
+        # an alert found this late (e.g. after a restart) is still worth sending
+        self.grace = datetime.timedelta(
+            seconds=grace_seconds or settings.DEPARTURE_ALERT_GRACE_SECONDS)
+        self._heap = []         # (fire_at, trip_id, offset, trip_start)
+        self._queued = set()    # (trip_id, offset, trip_start) in the heap
+
+    def scan(self, now=None):
+        """Queue the alerts of trips starting soon; returns how many were added."""
+        now = now or _now()
+        horizon = datetime.timedelta(minutes=self.offsets[0], seconds=self.scan_seconds)
+        added = 0
+        for trip_id, start in upcoming_trips(now, horizon).items():
+            for offset in self.offsets:
+                fire_at = start - datetime.timedelta(minutes=offset)
+                key = (trip_id, offset, start)
+                if key in self._queued or fire_at + self.grace < now:
+                    continue
+                heapq.heappush(self._heap, (fire_at, trip_id, offset, start))
+                self._queued.add(key)
+                added += 1
+        return added
+
+    def next_fire_at(self):
+        return self._heap[0][0] if self._heap else None
+
+    def fire_due(self, now=None):
+        """Fire every queued alert whose time has come; returns the passengers queued."""
+        now = now or _now()
+        sent = 0
+        while self._heap and self._heap[0][0] <= now:
+            fire_at, trip_id, offset, start = heapq.heappop(self._heap)
+            self._queued.discard((trip_id, offset, start))
+            if fire_at + self.grace < now:
+                continue
+            trip = bustrips_collection.find_one(
+                {"_id": ObjectId(trip_id)}, {"trip_start_time": 1, "completed": 1})
+            if not trip or trip.get("completed") or _aware(trip["trip_start_time"]) != start:
+                # finished or rescheduled since it was queued; a scan queues the new time
+                continue
+            sent += alert_trip(trip_id, offset)
+        return sent
+
+    def run_once(self, now=None):
+        """One scan plus whatever is due right now (cron, or catching up)."""
+        now = now or _now()
+        self.scan(now)
+        return self.fire_due(now)
+
+    def run_forever(self, stop=None):
+        next_scan = 0.0
+        while not (stop and stop.is_set()):
+            if time.monotonic() >= next_scan:
+                try:
+                    self.scan()
+                except Exception as e:
+                    print(f"Departure alert scan failed: {e}")
+                next_scan = time.monotonic() + self.scan_seconds
+            try:
+                self.fire_due()
+            except Exception as e:
+                print(f"Sending departure alerts failed: {e}")
+
+            wait = next_scan - time.monotonic()
+            fire_at = self.next_fire_at()
+            if fire_at is not None:
+                wait = min(wait, (fire_at - _now()).total_seconds())
+            wait = max(wait, 0.05)
+            if stop:
+                stop.wait(wait)
+            else:
+                time.sleep(wait)
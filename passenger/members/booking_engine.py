@@ -0,0 +1,452 @@
+"""
+Seat reservation engine shared by initialize/create/reschedule/cancel.
+
+A seat taken at checkout is held in the SeatHolds collection, one document
+per (trip_id, seat_number) with an `expires_at` the TTL index removes once
+the payment window (SEAT_HOLD_SECONDS) has passed. Abandoned checkouts
+therefore free their seat without any sweep. Live holds also count as
+expired as soon as `expires_at` passes, so the TTL monitor's lag does not
+matter.
+
+Booking a seat is a single conditional update on the BusTrips document:
+the filter only matches while none of the journey's legs are sold on the
+seat, so two passengers racing for it cannot both win, and the seat's
+legs and segments, its occupancy bit (see members/seat_inventory.py) and
+the `booked_seats` / `booked_revenue` counters change together.
+`booked_seats` is the number of seats with any leg sold (so
+seat_count - booked_seats seats are entirely free), not the number of
+sales: only a seat's first sale and last release move it. Holds are
+per seat, so two checkouts for disjoint legs of one seat still wait for
+each other during the payment window.
+Booking documents get their `_id` and QR code before they are inserted, so
+creating one is one write.
+
+Cancelling and rescheduling change the booking and one or two seats, which
+cannot be one write. The booking is first moved to a transition status
+(Canceling / Rescheduling) recording what is being done, the seats are
+changed, and only then is the booking finalised; a failure reverts it. A
+process that dies half way leaves the transition status behind, and
+`recover_transitions` (run by `manage.py sweep_trips`) finishes or rolls
+back bookings left in it longer than BOOKING_TRANSITION_TIMEOUT_SECONDS.
+"""
+import datetime
+import json
+import logging
+
+from bson import Int64, ObjectId
+from django.conf import settings
+from pymongo.errors import DuplicateKeyError
+
+from members import search_cache, seat_inventory
+from passenger.metrics import SEAT_OPERATIONS
+from passenger.mongo import get_collection
+from passenger.settings import generate_qr_code_base64
+
+
+logger = logging.getLogger(__name__)
+
+bookings_collection = get_collection('Bookings')
+bustrips_collection = get_collection('BusTrips')
+seat_holds_collection = get_collection('SeatHolds')
+users_collection = get_collection('Users')
+
+# booking statuses whose seat is marked booked on the trip
+BOOKED_STATUSES = ("Booked", "Rescedule_1", "Rescheduled_1", "Verified")
+# booking statuses that no longer own a seat
+CLOSED_STATUSES = ("Completed", "Failed", "Canceled_by_user")
+# a cancel or reschedule in progress; `transition` says how to finish it
+CANCELING, RESCHEDULING = "Canceling", "Rescheduling"
+TRANSITION_STATUSES = (CANCELING, RESCHEDULING)
+
+_TRANSITION_FIELDS = {"previous_status": "", "transition": "", "transition_at": ""}
+
+
+class SeatUnavailable(Exception):
+    """The seat is missing, held by another checkout or already booked."""
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def _hold_key(trip_id, seat_number):
+    return f"{trip_id}:{int(seat_number)}"
+
+
+def _seat_filter(trip_id, seat_number, **seat_state):
+    return {
+        "_id": ObjectId(trip_id),
+        "bookings": {"$elemMatch": {"seat_number": int(seat_number), **seat_state}},
+    }
+
+
+def _try_apply(operation, trip_filter, update):
+    try:
+        result = bustrips_collection.update_one(trip_filter, update)
+    except Exception:
+        SEAT_OPERATIONS.labels(operation, "error").inc()
+        raise
+    if result.matched_count == 0:
+        return False
+    SEAT_OPERATIONS.labels(operation, "ok").inc()
+    return True
+
+
+def _apply(operation, trip_filter, update):
+    if not _try_apply(operation, trip_filter, update):
+        SEAT_OPERATIONS.labels(operation, "conflict").inc()
+        raise SeatUnavailable(operation)
+
+
+def _take_hold(trip_id, seat_number, booking_id):
+    """
+    Create or extend the hold for `booking_id`. The upsert can only match an
+    expired hold or our own, so a live hold of another checkout makes the
+    insert collide on `_id` and raises SeatUnavailable.
+    """
+    now = _now()
+    try:
+        seat_holds_collection.update_one(
+            {
+                "_id": _hold_key(trip_id, seat_number),
+                "$or": [{"expires_at": {"$lte": now}},
+                        {"booking_id": str(booking_id)}],
+            },
+            {"$set": {
+                "trip_id": str(trip_id),
+                "seat_number": int(seat_number),
+                "booking_id": str(booking_id),
+                "expires_at": now + datetime.timedelta(seconds=settings.SEAT_HOLD_SECONDS),
+            }},
+            upsert=True,
+        )
+    except DuplicateKeyError:
+        SEAT_OPERATIONS.labels("hold", "conflict").inc()
+        raise SeatUnavailable("hold")
+
+
+def _drop_hold(trip_id, seat_number, booking_id):
+    seat_holds_collection.delete_one(
+        {"_id": _hold_key(trip_id, seat_number), "booking_id": str(booking_id)})
+
+
+def hold_seat(trip_id, seat_number, booking_id, legs=seat_inventory.FULL_TRIP):
+    """Hold a seat free for `legs` for the length of the payment window."""
+    _take_hold(trip_id, seat_number, booking_id)
+
+    trip = bustrips_collection.find_one(
+        {"_id": ObjectId(trip_id)},
+        {"bookings": {"$elemMatch": {"seat_number": int(seat_number)}}})
+    seats = (trip or {}).get("bookings") or []
+    if not seats or not seat_inventory.seat_free_for(seats[0], legs):
+        _drop_hold(trip_id, seat_number, booking_id)
+        SEAT_OPERATIONS.labels("hold", "conflict").inc()
+        raise SeatUnavailable("hold")
+    SEAT_OPERATIONS.labels("hold", "ok").inc()
+
+
+def book_seat(trip_id, seat_number, booking_id, start_point, end_point, fee,
+              legs=seat_inventory.FULL_TRIP, operation="confirm"):
+    """
+    Sell `legs` of a seat held by us (or free) to `booking_id`, counting
+    revenue. Used to confirm a paid checkout and, with operation="reserve",
+    to book a reschedule directly.
+    """
+    free = seat_inventory.free_seat_filter(legs)
+    sale = {
+        "$inc": {"booked_revenue": fee},
+        "$bit": {
+            "bookings.$.legs": {"or": Int64(legs)},
+            **seat_inventory.mark_booked(seat_number),
+        },
+        "$push": {"bookings.$.segments": {
+            "booking_id": str(booking_id),
+            "start_point": start_point,
+            "end_point": end_point,
+            "legs": Int64(legs),
+        }},
+        # latest sale, kept for the conductor app's seat view
+        "$set": {
+            "bookings.$.booked": True,
+            "bookings.$.start_point": start_point,
+            "bookings.$.end_point": end_point,
+            "bookings.$.booking_id": str(booking_id),
+        },
+    }
+    # re-taking the hold fails if another checkout owns the seat right now
+    _take_hold(trip_id, seat_number, booking_id)
+    try:
+        # booked_seats counts seats with any leg sold, not sales, so only
+        # the first sale on a seat adds to it; a seat whose state flips
+        # between the two attempts reports a conflict like any other race
+        first_sale = _try_apply(
+            operation,
+            _seat_filter(trip_id, seat_number, booked=False, **free),
+            {**sale, "$inc": {"booked_seats": 1, "booked_revenue": fee}},
+        )
+        if not first_sale:
+            _apply(operation, _seat_filter(trip_id, seat_number, booked=True, **free), sale)
+    finally:
+        _drop_hold(trip_id, seat_number, booking_id)
+    # cached searches show the trip's seats
+    search_cache.invalidate_trip(trip_id)
+
+
+def release_seat(trip_id, seat_number, booking_id, fee, booked, legs=None):
+    """
+    Give back what `booking_id` owns on the seat: its legs and the trip
+    counters when `booked`, otherwise just the checkout hold. `legs` is the
+    booking's mask; None for bookings made before seats were sold per leg.
+    """
+    if not booked:
+        _drop_hold(trip_id, seat_number, booking_id)
+        SEAT_OPERATIONS.labels("release", "ok").inc()
+        return
+
+    if legs is None:
+        _apply(
+            "release",
+            # seats booked before `booking_id` was recorded carry no owner
+            _seat_filter(trip_id, seat_number, booked=True, legs={"$exists": False},
+                         booking_id={"$in": [str(booking_id), None]}),
+            {
+                "$inc": {"booked_seats": -1, "booked_revenue": -fee},
+                "$bit": seat_inventory.mark_free(seat_number),
+                "$set": {
+                    "bookings.$.booked": False,
+                    "bookings.$.start_point": "",
+                    "bookings.$.end_point": "",
+                    "bookings.$.booking_id": None,
+                },
+            },
+        )
+        search_cache.invalidate_trip(trip_id)
+        return
+
+    _apply(
+        "release",
+        _seat_filter(trip_id, seat_number,
+                     **{"segments.booking_id": str(booking_id)}),
+        {
+            "$inc": {"booked_revenue": -fee},
+            "$bit": {"bookings.$.legs": {"and": Int64(~int(legs))}},
+            "$pull": {"bookings.$.segments": {"booking_id": str(booking_id)}},
+        },
+    )
+    # the seat only becomes free (and leaves booked_seats) once no leg is
+    # sold any more; a sale that lands in between leaves `legs` non-zero
+    # and this matches nothing
+    bustrips_collection.update_one(
+        _seat_filter(trip_id, seat_number, booked=True, legs=0),
+        {
+            "$inc": {"booked_seats": -1},
+            "$bit": seat_inventory.mark_free(seat_number),
+            "$set": {
+                "bookings.$.booked": False,
+                "bookings.$.start_point": "",
+                "bookings.$.end_point": "",
+                "bookings.$.booking_id": None,
+            },
+        },
+    )
+    search_cache.invalidate_trip(trip_id)
+
+
+def restore_seat(booking):
+    """Put a booking's seat back the way it was (undo of release_seat)."""
+    legs = booking.get("legs", seat_inventory.FULL_TRIP)
+    if booking.get("status") in BOOKED_STATUSES:
+        book_seat(booking["trip_id"], booking["seat_number"], booking["_id"],
+                  booking.get("start_point"), booking.get("end_point"),
+                  float(booking.get("fee", 0)), legs=legs, operation="reserve")
+    else:
+        hold_seat(booking["trip_id"], booking["seat_number"], booking["_id"], legs)
+
+
+def held_seats(trip_id):
+    """Seat numbers on `trip_id` under a live checkout hold."""
+    return {
+        hold["seat_number"]
+        for hold in seat_holds_collection.find(
+            {"trip_id": str(trip_id), "expires_at": {"$gt": _now()}},
+            {"seat_number": 1, "_id": 0})
+    }
+
+
+def build_booking(booking_doc):
+    """Give a booking document its `_id` and QR code before it is inserted."""
+    booking_id = ObjectId()
+    qr_payload = json.dumps({
+        "booking_id": str(booking_id),
+        "user_id": booking_doc["user_id"],
+    })
+    booking_doc["_id"] = booking_id
+    booking_doc["qr_code_base64"] = generate_qr_code_base64(qr_payload)
+    return booking_doc
+
+
+def start_booking(booking_doc):
+    """
+    Hold the seat and insert the pending booking (initialize_booking).
+    Raises SeatUnavailable; the hold is given back if the insert fails.
+    """
+    booking_doc = build_booking(booking_doc)
+    trip_id, seat = booking_doc["trip_id"], booking_doc["seat_number"]
+
+    hold_seat(trip_id, seat, booking_doc["_id"], booking_doc["legs"])
+    booking_doc["hold_expires_at"] = _now() + datetime.timedelta(
+        seconds=settings.SEAT_HOLD_SECONDS)
+    try:
+        bookings_collection.insert_one(booking_doc)
+    except Exception:
+        _drop_hold(trip_id, seat, booking_doc["_id"])
+        raise
+    return booking_doc
+
+
+def claim_pending_booking(txn_id):
+    """
+    Atomically move a Pending booking to Booked so a repeated payment
+    callback cannot confirm it twice. Returns the booking or None.
+    """
+    return bookings_collection.find_one_and_update(
+        {"transaction_id": txn_id, "status": "Pending"},
+        {"$set": {"status": "Booked"}},
+    )
+
+
+def fail_booking(booking):
+    """Drop the hold and mark a claimed booking as failed."""
+    bookings_collection.update_one(
+        {"_id": booking["_id"]}, {"$set": {"status": "Failed"}})
+    _drop_hold(booking["trip_id"], booking["seat_number"], booking["_id"])
+
+
+def can_change(booking):
+    """Whether a booking may still be cancelled or rescheduled."""
+    return booking.get("status") not in CLOSED_STATUSES + TRANSITION_STATUSES
+
+
+def _begin_transition(booking, state, transition):
+    """Move `booking` from its current status to `state`; False if it changed meanwhile."""
+    result = bookings_collection.update_one(
+        {"_id": booking["_id"], "status": booking.get("status")},
+        {"$set": {
+            "status": state,
+            "previous_status": booking.get("status"),
+            "transition": transition,
+            "transition_at": _now(),
+        }},
+    )
+    return result.matched_count == 1
+
+
+def abort_transition(booking):
+    """Put a booking in transition back to the status it had before."""
+    bookings_collection.update_one(
+        {"_id": booking["_id"], "status": {"$in": list(TRANSITION_STATUSES)}},
+        {"$set": {"status": booking.get("status")}, "$unset": _TRANSITION_FIELDS},
+    )
+
+
+def _release_booking_seat(booking):
+    try:
+        release_seat(booking["trip_id"], booking["seat_number"], booking["_id"],
+                     float(booking.get("fee", 0)),
+                     booked=booking.get("status") in BOOKED_STATUSES,
+                     legs=booking.get("legs"))
+    except SeatUnavailable:
+        # seat was already given back
+        pass
+
+
+def _finish_cancel(booking_id, new_status, fields):
+    bookings_collection.update_one(
+        {"_id": booking_id, "status": CANCELING},
+        {"$set": {"status": new_status, **fields}, "$unset": _TRANSITION_FIELDS},
+    )
+
+
+def cancel_booking(booking, new_status, extra_fields=None):
+    """
+    Move `booking` to `new_status` (only if nobody changed it meanwhile)
+    and free its seat. Raises SeatUnavailable if it was already moved on.
+    """
+    if not can_change(booking):
+        SEAT_OPERATIONS.labels("cancel", "conflict").inc()
+        raise SeatUnavailable("cancel")
+
+    fields = extra_fields or {}
+    if not _begin_transition(booking, CANCELING, {"to": new_status, "fields": fields}):
+        SEAT_OPERATIONS.labels("cancel", "conflict").inc()
+        raise SeatUnavailable("cancel")
+
+    try:
+        _release_booking_seat(booking)
+    except Exception:
+        abort_transition(booking)
+        raise
+    _finish_cancel(booking["_id"], new_status, fields)
+
+
+def begin_reschedule(old_booking, new_booking):
+    """
+    Claim `old_booking` for a reschedule into `new_booking` (not inserted
+    yet); False if it was changed meanwhile. Follow with release_seat /
+    book_seat, then finish_reschedule, or abort_transition on failure.
+    """
+    return _begin_transition(old_booking, RESCHEDULING, {
+        "new_booking_id": new_booking["_id"],
+        "trip_id": new_booking["trip_id"],
+        "seat_number": new_booking["seat_number"],
+        "fee": float(new_booking["fee"]),
+        "legs": new_booking.get("legs"),
+    })
+
+
+def finish_reschedule(old_booking, new_booking_id):
+    """Drop the rescheduled booking and point its user at the new one."""
+    bookings_collection.delete_one({"_id": old_booking["_id"], "status": RESCHEDULING})
+    user_id = ObjectId(old_booking["user_id"])
+    users_collection.update_one({"_id": user_id}, {"$pull": {"bookings": old_booking["_id"]}})
+    users_collection.update_one({"_id": user_id}, {"$addToSet": {"bookings": new_booking_id}})
+
+
+def recover_transitions(now=None):
+    """
+    Finish or roll back cancels and reschedules whose process died half
+    way; returns how many bookings were settled.
+    """
+    now = now or _now()
+    cutoff = now - datetime.timedelta(seconds=settings.BOOKING_TRANSITION_TIMEOUT_SECONDS)
+    settled = 0
+    for stuck in bookings_collection.find(
+            {"status": {"$in": list(TRANSITION_STATUSES)}, "transition_at": {"$lt": cutoff}}):
+        # the booking as it was before the transition started
+        booking = {**stuck, "status": stuck.get("previous_status")}
+        transition = stuck.get("transition") or {}
+        try:
+            if stuck["status"] == CANCELING:
+                _release_booking_seat(booking)
+                _finish_cancel(stuck["_id"], transition["to"], transition.get("fields") or {})
+            elif bookings_collection.find_one({"_id": transition["new_booking_id"]}, {"_id": 1}):
+                # the new booking was written: only the clean-up was missed
+                finish_reschedule(booking, transition["new_booking_id"])
+            else:
+                try:
+                    release_seat(transition["trip_id"], transition["seat_number"],
+                                 transition["new_booking_id"], transition["fee"],
+                                 booked=True, legs=transition.get("legs"))
+                except SeatUnavailable:
+                    pass  # the new seat was never taken
+                try:
+                    restore_seat(booking)
+                except SeatUnavailable:
+                    # never released, or sold again since; either way
+                    # there is nothing more to give back
+                    pass
+                abort_transition(booking)
+            settled += 1
+        except Exception:
+            logger.exception("Could not recover booking %s", stuck["_id"])
+    return settled
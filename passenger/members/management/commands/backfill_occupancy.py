@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand
+from pymongo import UpdateOne
+
+from members import seat_inventory
+from passenger.mongo import close_client, get_collection
+
+
+bustrips_collection = get_collection('BusTrips')
+
+
+class Command(BaseCommand):
+    help = (
+        "Give trips created before the occupancy bitmap their `seat_count` "
+        "and `occupancy` fields, derived from the bookings array. Run it "
+        "outside booking peaks: a seat booked between the read and the write "
+        "of a batch would be missing from that trip's bitmap."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500)
+
+    def handle(self, *args, **options):
+        try:
+            updated = 0
+            ops = []
+            cursor = bustrips_collection.find(
+                {"seat_count": {"$exists": False}}, {"bookings": 1})
+            for trip in cursor:
+                bookings = trip.get("bookings", [])
+                ops.append(UpdateOne(
+                    {"_id": trip["_id"], "seat_count": {"$exists": False}},
+                    {"$set": {
+                        "seat_count": len(bookings),
+                        "occupancy": seat_inventory.occupancy_from_bookings(bookings),
+                    }},
+                ))
+                if len(ops) >= options["batch_size"]:
+                    updated += bustrips_collection.bulk_write(ops, ordered=False).modified_count
+                    ops = []
+            if ops:
+                updated += bustrips_collection.bulk_write(ops, ordered=False).modified_count
+        finally:
+            close_client()
+
+        self.stdout.write(self.style.SUCCESS(f"backfilled {updated} trip(s)"))
@@ -0,0 +1,120 @@
+import random
+import threading
+import time
+
+from bson import ObjectId
+from django.core.management.base import BaseCommand, CommandError
+
+from members import booking_engine, seat_inventory
+from members.booking_engine import SeatUnavailable
+from passenger.mongo import close_client, get_collection
+
+
+bustrips_collection = get_collection('BusTrips')
+
+
+class Command(BaseCommand):
+    help = (
+        "Hammer members.booking_engine with concurrent hold/confirm/release "
+        "cycles on a scratch trip and report throughput, conflict rate and "
+        "whether any seat was ever won by two bookings at once."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--threads", type=int, default=16)
+        parser.add_argument("--seconds", type=float, default=10.0)
+        parser.add_argument("--seats", type=int, default=10,
+                            help="Fewer seats means more contention.")
+        parser.add_argument("--release-ratio", type=float, default=0.8,
+                            help="Share of won seats given back to keep the trip churning.")
+
+    def handle(self, *args, **options):
+        trip_id = bustrips_collection.insert_one({
+            "benchmark": True,
+            "completed": True,   # keeps process_trips and alerts away from it
+            "booked_seats": 0,
+            "booked_revenue": 0,
+            "bookings": [
+                {"seat_number": i, "booked": False, "start_point": None, "end_point": None}
+                for i in range(1, options["seats"] + 1)
+            ],
+            "seat_count": options["seats"],
+            "occupancy": seat_inventory.empty_occupancy(options["seats"]),
+        }).inserted_id
+
+        owners = {}
+        owners_lock = threading.Lock()
+        stats = {"ok": 0, "conflict": 0, "error": 0, "double": 0}
+        stats_lock = threading.Lock()
+        deadline = time.monotonic() + options["seconds"]
+
+        def count(key):
+            with stats_lock:
+                stats[key] += 1
+
+        def worker():
+            rng = random.Random()
+            while time.monotonic() < deadline:
+                seat = rng.randint(1, options["seats"])
+                booking_id = ObjectId()
+                try:
+                    booking_engine.hold_seat(trip_id, seat, booking_id)
+                except SeatUnavailable:
+                    count("conflict")
+                    continue
+                except Exception:
+                    count("error")
+                    continue
+
+                with owners_lock:
+                    if seat in owners:
+                        stats["double"] += 1
+                    owners[seat] = booking_id
+
+                try:
+                    booking_engine.book_seat(trip_id, seat, booking_id, "A", "B", 100.0)
+                except SeatUnavailable:
+                    with owners_lock:
+                        owners.pop(seat, None)
+                    count("conflict")
+                    continue
+                count("ok")
+
+                if rng.random() < options["release_ratio"]:
+                    with owners_lock:
+                        owners.pop(seat, None)
+                    booking_engine.release_seat(trip_id, seat, booking_id, 100.0, booked=True)
+
+        threads = [threading.Thread(target=worker) for _ in range(options["threads"])]
+        started = time.monotonic()
+        try:
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            elapsed = time.monotonic() - started
+
+            trip = bustrips_collection.find_one({"_id": trip_id})
+        finally:
+            bustrips_collection.delete_one({"_id": trip_id})
+            close_client()
+
+        attempts = stats["ok"] + stats["conflict"] + stats["error"]
+        booked = sum(1 for b in trip["bookings"] if b.get("booked"))
+        bitmap_booked = len(seat_inventory.booked_seat_numbers(trip))
+        self.stdout.write(
+            f"attempts={attempts} ok={stats['ok']} conflicts={stats['conflict']} "
+            f"errors={stats['error']} in {elapsed:.2f}s")
+        self.stdout.write(
+            f"throughput={attempts / elapsed:.0f} attempts/s, "
+            f"conflict rate={stats['conflict'] / max(attempts, 1):.1%}")
+        self.stdout.write(
+            f"seats booked={booked}, trip counter booked_seats={trip['booked_seats']}, "
+            f"occupancy bitmap={bitmap_booked}")
+
+        if stats["double"] or not booked == trip["booked_seats"] == bitmap_booked:
+            raise CommandError(
+                f"inconsistent inventory: {stats['double']} double wins, "
+                f"{booked} booked seats vs counter {trip['booked_seats']} "
+                f"vs bitmap {bitmap_booked}")
+        self.stdout.write(self.style.SUCCESS("no seat was won twice"))
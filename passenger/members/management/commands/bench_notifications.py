@@ -0,0 +1,63 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from members import notifications
+from members.notifications import RecordingTransport, send_to_tokens
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare one-call-per-token delivery with multicast batching against a "
+        "fake FCM backend that charges a fixed latency per call, and check that "
+        "unregistered tokens are reported for pruning. Touches no database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--recipients", type=int, default=10000)
+        parser.add_argument("--latency-ms", type=float, default=40.0,
+                            help="Simulated round trip of one FCM call.")
+        parser.add_argument("--unregistered", type=float, default=0.02,
+                            help="Share of tokens the fake backend reports as UNREGISTERED.")
+        parser.add_argument("--serial-sample", type=int, default=100,
+                            help="Per-token sends actually made; the rest is extrapolated.")
+
+    def handle(self, *args, **options):
+        n = options["recipients"]
+        tokens = [f"token-{i}" for i in range(n)]
+        dead = set(random.sample(tokens, int(n * options["unregistered"])))
+        latency = options["latency_ms"] / 1000
+
+        try:
+            serial = RecordingTransport(unregistered=dead, latency=latency)
+            notifications.set_transport(serial)
+            sample = tokens[:min(options["serial_sample"], n)]
+            started = time.perf_counter()
+            for token in sample:
+                try:
+                    serial.send(token, "Bench", "Serial")
+                except RuntimeError:
+                    pass
+            serial_elapsed = (time.perf_counter() - started) * n / len(sample)
+
+            batched = RecordingTransport(unregistered=dead, latency=latency)
+            notifications.set_transport(batched)
+            started = time.perf_counter()
+            results, unregistered = send_to_tokens(tokens, "Bench", "Batched")
+            batched_elapsed = time.perf_counter() - started
+        finally:
+            notifications.set_transport(None)
+
+        delivered = sum(1 for r in results.values() if r["success"])
+        self.stdout.write(
+            f"per-token: ~{serial_elapsed:.1f}s for {n} recipients "
+            f"({n} calls, extrapolated from {len(sample)})")
+        self.stdout.write(
+            f"batched:   {batched_elapsed:.2f}s for {n} recipients ({batched.calls} calls), "
+            f"{n / batched_elapsed:.0f} recipients/s, {delivered} delivered, "
+            f"{len(unregistered)} to prune")
+
+        if set(unregistered) != dead or delivered != n - len(dead):
+            raise CommandError("per-token results do not match the backend")
+        self.stdout.write(self.style.SUCCESS("unregistered tokens all reported"))
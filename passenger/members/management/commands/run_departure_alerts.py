@@ -0,0 +1,34 @@
+import signal
+import threading
+
+from django.core.management.base import BaseCommand
+
+from members.alerts import DepartureAlertScheduler
+from passenger.mongo import close_client
+
+
+class Command(BaseCommand):
+    help = (
+        "Send departure alerts at DEPARTURE_ALERT_OFFSETS minutes before each "
+        "trip starts. Runs until stopped, or makes one pass with --once."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--once", action="store_true",
+                            help="Scan, send whatever is due now and exit.")
+
+    def handle(self, *args, **options):
+        scheduler = DepartureAlertScheduler()
+        try:
+            if options["once"]:
+                sent = scheduler.run_once()
+                self.stdout.write(f"{sent} departure alerts queued")
+                return
+
+            stop = threading.Event()
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                signal.signal(sig, lambda *_: stop.set())
+            self.stdout.write(f"Departure alerts at {scheduler.offsets} minutes before start")
+            scheduler.run_forever(stop)
+        finally:
+            close_client()
@@ -0,0 +1,50 @@
+import logging
+import signal
+import threading
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from prometheus_client import start_http_server
+
+from members.outbox import pending_count, start_workers
+from passenger.metrics import OUTBOX_PENDING
+from passenger.mongo import close_client
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Deliver queued push notifications from NotificationOutbox with a pool of worker threads."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--threads", type=int, default=settings.OUTBOX_WORKER_THREADS)
+        parser.add_argument("--metrics-port", type=int, default=settings.OUTBOX_METRICS_PORT)
+
+    def handle(self, *args, **options):
+        if options["metrics_port"]:
+            start_http_server(options["metrics_port"])
+
+        stop = threading.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, lambda *_: stop.set())
+
+        workers = start_workers(options["threads"], stop)
+        self.stdout.write(f"Outbox: {len(workers)} workers")
+        try:
+            while not stop.is_set():
+                try:
+                    OUTBOX_PENDING.set(pending_count())
+                except Exception:
+                    logger.exception("Outbox backlog check failed")
+                dead = sum(1 for worker in workers if not worker.is_alive())
+                if dead and not stop.is_set():
+                    # exit so the container restarts with a full pool
+                    raise CommandError(f"{dead} outbox worker(s) died")
+                stop.wait(15)
+        finally:
+            stop.set()
+            # a worker stopped mid-send leaves its message leased; it is retried after the lease
+            for worker in workers:
+                worker.join(timeout=30)
+            close_client()
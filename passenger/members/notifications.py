@@ -0,0 +1,257 @@
+"""
+Push notifications for passengers.
+
+Views and background jobs call these helpers directly instead of POSTing
+to /members/send-notification/. Delivery goes through a pluggable
+transport chosen by settings.NOTIFICATION_TRANSPORT: FCMTransport in
+production, RecordingTransport in tests and local runs.
+
+Messages to many users (`notify_users`) go out as multicasts of up to
+FCM_BATCH_SIZE tokens per call, and tokens FCM reports as UNREGISTERED
+are removed from FCMTokens.
+"""
+import logging
+import threading
+import time
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from passenger.mongo import get_collection
+
+
+logger = logging.getLogger(__name__)
+
+FCM_TOKEN_collection = get_collection("FCMTokens")
+
+BOOKING_MESSAGES = {
+    'BOOKED': (
+        'Booking Confirmed',
+        'Your booking was successful.'),
+    'RESCHEDULED': (
+        'Booking Rescheduled',
+        'Your booking has been rescheduled. Please check the new time.'),
+    'CANCELED': (
+        'Booking Canceled',
+        'Your booking has been canceled. We apologize for the inconvenience.'),
+    'ERROR': (
+        'Booking Error',
+        'There was an error occurred when booking your seat. Please contact us on the 0122345566.'),
+}
+
+
+# FCM accepts at most this many tokens per multicast
+FCM_BATCH_SIZE = 500
+
+# error code of a token whose app was uninstalled or whose registration expired
+UNREGISTERED = "UNREGISTERED"
+
+
+class FCMTransport:
+    """Sends through firebase_admin (initialised in MembersConfig.ready)."""
+
+    def send(self, token, title, body):
+        from firebase_admin import messaging
+
+        message = messaging.Message(
+            notification=messaging.Notification(title=title, body=body),
+            token=token,
+        )
+        return messaging.send(message)
+
+    def send_multicast(self, tokens, title, body):
+        """
+        One message to up to FCM_BATCH_SIZE tokens in a single call. Returns
+        one {"success", "message_id" | "error"} per token, in token order.
+        """
+        from firebase_admin import messaging
+
+        batch = messaging.send_each_for_multicast(messaging.MulticastMessage(
+            notification=messaging.Notification(title=title, body=body),
+            tokens=list(tokens),
+        ))
+        results = []
+        for response in batch.responses:
+            if response.success:
+                results.append({"success": True, "message_id": response.message_id})
+            elif isinstance(response.exception, messaging.UnregisteredError):
+                results.append({"success": False, "error": UNREGISTERED})
+            else:
+                results.append({"success": False, "error": str(
+                    getattr(response.exception, "code", None) or response.exception)})
+        return results
+
+
+class RecordingTransport:
+    """
+    Keeps every message in memory instead of delivering it. Tokens in
+    `unregistered` fail the way FCM reports uninstalled apps, and `latency`
+    (seconds per call) stands in for the HTTPS round trip.
+    """
+
+    def __init__(self, unregistered=(), latency=0.0):
+        self.sent = []
+        self.calls = 0
+        self.unregistered = set(unregistered)
+        self.latency = latency
+        self._lock = threading.Lock()
+
+    def _call(self):
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.calls += 1
+
+    def send(self, token, title, body):
+        self._call()
+        if token in self.unregistered:
+            raise RuntimeError(UNREGISTERED)
+        with self._lock:
+            self.sent.append({"token": token, "title": title, "body": body})
+            return f"recorded-{len(self.sent)}"
+
+    def send_multicast(self, tokens, title, body):
+        self._call()
+        results = []
+        with self._lock:
+            for token in tokens:
+                if token in self.unregistered:
+                    results.append({"success": False, "error": UNREGISTERED})
+                    continue
+                self.sent.append({"token": token, "title": title, "body": body})
+                results.append({"success": True, "message_id": f"recorded-{len(self.sent)}"})
+        return results
+
+
+_transport = None
+
+
+def get_transport():
+    global _transport
+    if _transport is None:
+        _transport = import_string(settings.NOTIFICATION_TRANSPORT)()
+    return _transport
+
+
+def set_transport(transport):
+    """Swap the transport (tests); pass None to go back to the configured one."""
+    global _transport
+    _transport = transport
+
+
+def get_fcm_token(user_id):
+    try:
+        uid = ObjectId(user_id)
+    except (InvalidId, TypeError):
+        return None
+    token_doc = FCM_TOKEN_collection.find_one({'_id': uid}, {'fcm_token': 1})
+    if not token_doc:
+        return None
+    return token_doc.get('fcm_token')
+
+
+def get_fcm_tokens(user_ids):
+    """{user_id: token} for the users that have one, in one query."""
+    uids = []
+    for user_id in user_ids:
+        try:
+            uids.append(ObjectId(user_id))
+        except (InvalidId, TypeError):
+            continue
+    tokens = {}
+    for doc in FCM_TOKEN_collection.find({'_id': {'$in': uids}}, {'fcm_token': 1}):
+        if doc.get('fcm_token'):
+            tokens[str(doc['_id'])] = doc['fcm_token']
+    return tokens
+
+
+def send_to_tokens(tokens, title, body):
+    """
+    Deliver one message to many tokens, FCM_BATCH_SIZE per call. Returns
+    ({token: result}, unregistered tokens). A chunk whose call fails
+    outright is reported as failed for each of its tokens.
+    """
+    transport = get_transport()
+    tokens = list(dict.fromkeys(tokens))
+    results, dead = {}, []
+    for start in range(0, len(tokens), FCM_BATCH_SIZE):
+        chunk = tokens[start:start + FCM_BATCH_SIZE]
+        try:
+            chunk_results = transport.send_multicast(chunk, title, body)
+        except Exception as e:
+            logger.warning("FCM multicast of %s tokens failed: %s", len(chunk), e)
+            chunk_results = [{"success": False, "error": str(e)}] * len(chunk)
+        for token, result in zip(chunk, chunk_results):
+            results[token] = result
+            if result.get("error") == UNREGISTERED:
+                dead.append(token)
+    return results, dead
+
+
+def prune_tokens(tokens):
+    """Forget tokens FCM reported as unregistered; returns how many went."""
+    if not tokens:
+        return 0
+    return FCM_TOKEN_collection.delete_many({'fcm_token': {'$in': list(tokens)}}).deleted_count
+
+
+def notify_users(user_ids, title, body):
+    """
+    Send one notification to many users' devices with one token lookup and
+    one FCM call per FCM_BATCH_SIZE devices; dead tokens are pruned.
+
+    Returns {"success", "failure", "no_token", "pruned"} counts plus
+    "retry", the users whose delivery failed for a reason other than a dead
+    token; like notify_user it never raises for delivery problems.
+    """
+    user_ids = list(dict.fromkeys(str(u) for u in user_ids))
+    tokens = get_fcm_tokens(user_ids)
+    results, dead = send_to_tokens(tokens.values(), title, body)
+
+    success = sum(1 for token in tokens.values() if results[token]["success"])
+    return {
+        "success": success,
+        "failure": len(tokens) - success,
+        "no_token": len(user_ids) - len(tokens),
+        "pruned": prune_tokens(dead),
+        "retry": [user_id for user_id, token in tokens.items()
+                  if not results[token]["success"] and results[token].get("error") != UNREGISTERED],
+    }
+
+
+def notify_user(user_id, title, body):
+    """
+    Send one notification to a user's registered device.
+
+    Returns {"status": "success" | "no_token" | "error", ...}; delivery
+    failures are reported, never raised, so callers on a request path
+    cannot be broken by FCM.
+    """
+    fcm_token = get_fcm_token(user_id)
+    if not fcm_token:
+        return {"status": "no_token"}
+
+    results, dead = send_to_tokens([fcm_token], title, body)
+    result = results[fcm_token]
+    if dead:
+        prune_tokens(dead)
+    if not result["success"]:
+        return {"status": "error", "message": result["error"]}
+
+    return {"status": "success", "message_id": result["message_id"]}
+
+
+def send_booking_notification(user_id, category):
+    title, body = BOOKING_MESSAGES[category]
+    return notify_user(str(user_id), title, body)
+
+
+def departure_alert_message(minutes):
+    return ('Bus Departure Reminder',
+            f'In {minutes} minutes your bus will be departing. Please be ready at your start point.')
+
+
+def send_departure_alert(user_id, minutes):
+    return notify_user(str(user_id), *departure_alert_message(minutes))
@@ -0,0 +1,177 @@
+"""
+Persistent outbox for push notifications.
+
+Request handlers and jobs `enqueue` a message (one insert, optionally
+keyed so a retried request does not queue it twice) instead of calling
+FCM inline; `manage.py run_notification_outbox` delivers it.
+
+A worker claims a message by pushing its `available_at` OUTBOX_LEASE_SECONDS
+into the future with find_one_and_update, so a worker that dies mid-send
+only delays the message until the lease runs out, and no two workers send
+it at once. Users whose delivery failed are retried with exponential
+backoff; after OUTBOX_MAX_ATTEMPTS the message is dead-lettered
+(`status: "dead"`) with its last error for someone to look at.
+"""
+import datetime
+import logging
+import random
+import socket
+import threading
+import uuid
+
+from bson import ObjectId
+from django.conf import settings
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from members.notifications import BOOKING_MESSAGES, departure_alert_message, notify_users
+from passenger.metrics import OUTBOX_DELIVERIES, OUTBOX_DELIVERY_LAG
+from passenger.mongo import get_collection
+
+
+logger = logging.getLogger(__name__)
+
+outbox_collection = get_collection('NotificationOutbox')
+
+PENDING, SENT, DEAD = "pending", "sent", "dead"
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def enqueue(user_ids, title, body, key=None):
+    """
+    Queue one notification for `user_ids`. With `key`, queuing the same
+    notification again is a no-op. Returns the message _id.
+    """
+    now = _now()
+    doc = {
+        "_id": key or ObjectId(),
+        "user_ids": [str(u) for u in user_ids],
+        "title": title,
+        "body": body,
+        "status": PENDING,
+        "attempts": 0,
+        "available_at": now,
+        "created_at": now,
+    }
+    try:
+        outbox_collection.insert_one(doc)
+    except DuplicateKeyError:
+        pass  # already queued by an earlier attempt of the same request
+    return doc["_id"]
+
+
+def enqueue_booking_notification(user_id, category, booking_id):
+    title, body = BOOKING_MESSAGES[category]
+    return enqueue([user_id], title, body, key=f"booking:{booking_id}:{category}")
+
+
+def enqueue_departure_alert(user_ids, minutes):
+    title, body = departure_alert_message(minutes)
+    # the AlertLedger already keeps a passenger from being queued twice
+    return enqueue(user_ids, title, body)
+
+
+def backoff_seconds(attempts):
+    """Delay before attempt `attempts + 1`: exponential, capped, with jitter."""
+    delay = min(settings.OUTBOX_BACKOFF_BASE_SECONDS * 2 ** (attempts - 1),
+                settings.OUTBOX_BACKOFF_MAX_SECONDS)
+    return delay * random.uniform(0.5, 1.0)
+
+
+class OutboxWorker:
+
+    def __init__(self, name=None):
+        self.name = name or f"{socket.gethostname()}:{uuid.uuid4().hex[:6]}"
+
+    def claim(self):
+        """Lease the oldest due message; None when nothing is due."""
+        now = _now()
+        return outbox_collection.find_one_and_update(
+            {"status": PENDING, "available_at": {"$lte": now}},
+            {
+                "$set": {
+                    "available_at": now + datetime.timedelta(seconds=settings.OUTBOX_LEASE_SECONDS),
+                    "leased_by": self.name,
+                },
+                "$inc": {"attempts": 1},
+            },
+            sort=[("available_at", 1)],
+            return_document=ReturnDocument.AFTER,
+        )
+
+    def deliver(self, message):
+        """Send a claimed message and record the outcome; returns it."""
+        try:
+            report = notify_users(message["user_ids"], message["title"], message["body"])
+            retry, error = report["retry"], "delivery failed" if report["retry"] else None
+        except Exception as e:
+            # lookup or pruning failed: the whole message goes again
+            retry, error = message["user_ids"], str(e)
+
+        lease = {"_id": message["_id"], "leased_by": self.name}
+        now = _now()
+        if not retry:
+            outbox_collection.update_one(lease, {"$set": {"status": SENT, "sent_at": now}})
+            OUTBOX_DELIVERIES.labels(SENT).inc()
+            OUTBOX_DELIVERY_LAG.observe(
+                (now - message["created_at"].replace(tzinfo=datetime.timezone.utc)).total_seconds())
+            return SENT
+
+        if message["attempts"] >= settings.OUTBOX_MAX_ATTEMPTS:
+            outbox_collection.update_one(lease, {"$set": {
+                "status": DEAD, "user_ids": retry, "last_error": error, "dead_at": now}})
+            OUTBOX_DELIVERIES.labels(DEAD).inc()
+            logger.error("Notification %s dead after %s attempts: %s",
+                         message["_id"], message["attempts"], error)
+            return DEAD
+
+        # only the users that did not get it are tried again
+        outbox_collection.update_one(lease, {"$set": {
+            "user_ids": retry,
+            "last_error": error,
+            "available_at": now + datetime.timedelta(seconds=backoff_seconds(message["attempts"])),
+        }})
+        OUTBOX_DELIVERIES.labels("retry").inc()
+        return "retry"
+
+    def run(self, stop):
+        """Claim and deliver until `stop` is set, sleeping while the outbox is empty."""
+        while not stop.is_set():
+            message = None
+            try:
+                message = self.claim()
+                if message is not None:
+                    self.deliver(message)
+                    continue
+            except Exception as e:
+                # the message stays leased and is claimed again once the
+                # lease runs out; one that keeps failing is dead-lettered
+                logger.exception("Outbox worker %s failed", self.name)
+                if message is not None and message.get("attempts", 0) >= settings.OUTBOX_MAX_ATTEMPTS:
+                    self.bury(message, str(e))
+            stop.wait(settings.OUTBOX_POLL_SECONDS)
+
+    def bury(self, message, error):
+        try:
+            outbox_collection.update_one(
+                {"_id": message["_id"], "leased_by": self.name},
+                {"$set": {"status": DEAD, "last_error": error, "dead_at": _now()}})
+            OUTBOX_DELIVERIES.labels(DEAD).inc()
+        except Exception:
+            logger.exception("Could not dead-letter notification %s", message.get("_id"))
+
+
+def pending_count():
+    return outbox_collection.count_documents({"status": PENDING})
+
+
+def start_workers(threads, stop):
+    """Start `threads` workers that run until `stop` is set; returns their threads."""
+    workers = [threading.Thread(target=OutboxWorker().run, args=(stop,), daemon=True)
+               for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    return workers
@@ -0,0 +1,142 @@
+"""
+Cached trip search results (members.views.find_route_by_points).
+
+A result is stored in the 'search' cache under
+(start_point_id, end_point_id, time bucket, route generations) for
+SEARCH_CACHE_TTL seconds. The time bucket is SEARCH_CACHE_BUCKET_SECONDS
+wide; a hit drops the trips that have left the search window since the
+entry was built, so a bucket never shows a trip a fresh query would not.
+
+Every route has a generation number in the same cache. Creating a trip,
+booking or freeing a seat sets its route's generation to a new value,
+which changes the key of every search that includes the route, so the old
+entries are simply never read again and expire on their own. The cache
+backend is whatever CACHES['search'] is: local memory per process in
+development, a shared Redis in production so one worker's invalidation
+reaches every other one.
+"""
+import datetime
+import hashlib
+import logging
+import time
+
+from bson import ObjectId
+from django.conf import settings
+from django.core.cache import caches
+
+from passenger.metrics import SEARCH_CACHE_INVALIDATIONS, SEARCH_CACHE_REQUESTS
+from passenger.mongo import get_collection
+
+
+logger = logging.getLogger(__name__)
+
+bustrips_collection = get_collection('BusTrips')
+
+
+def _cache():
+    return caches['search']
+
+
+def _aware(ts):
+    # stored datetimes come back naive (UTC)
+    return ts.replace(tzinfo=datetime.timezone.utc) if ts.tzinfo is None else ts
+
+
+def _generation_key(route_id):
+    return f"search:route:{route_id}"
+
+
+def _trip_route_key(trip_id):
+    return f"search:trip-route:{trip_id}"
+
+
+def _generations(cache, route_ids):
+    """
+    {route_id: generation}. A route without one (never invalidated, or its
+    counter was evicted) is seeded with a new value rather than read as a
+    default, so entries stored under an earlier generation stay unreachable.
+    """
+    keys = {r: _generation_key(r) for r in route_ids}
+    stored = cache.get_many(list(keys.values()))
+    generations = {}
+    for route_id, key in keys.items():
+        generation = stored.get(key)
+        if generation is None:
+            generation = time.time_ns()
+            if not cache.add(key, generation, None):
+                # another request seeded it first
+                generation = cache.get(key, generation)
+        generations[route_id] = generation
+    return generations
+
+
+def _result_key(cache, start_point_id, end_point_id, route_ids, now):
+    bucket = int(now.timestamp() // settings.SEARCH_CACHE_BUCKET_SECONDS)
+    generations = _generations(cache, route_ids)
+    digest = hashlib.sha1(",".join(
+        f"{r}={generations[r]}" for r in sorted(route_ids)
+    ).encode()).hexdigest()
+    return f"search:{start_point_id}:{end_point_id}:{bucket}:{digest}"
+
+
+def cached_search(start_point_id, end_point_id, route_ids, now, threshold, search):
+    """
+    The search payload ({"trips": [...], ...}) for a point pair, from the
+    cache or from `search()`, without trips starting by `threshold`. The
+    generations are read before `search()` runs, so a write that lands
+    during it leaves the result under a key nobody will read.
+    """
+    cache = _cache()
+    try:
+        key = _result_key(cache, start_point_id, end_point_id, route_ids, now)
+        payload = cache.get(key)
+    except Exception as e:
+        # a cache outage must not take search down with it
+        logger.warning("Search cache read failed: %s", e)
+        SEARCH_CACHE_REQUESTS.labels("error").inc()
+        return search()
+
+    if payload is not None:
+        SEARCH_CACHE_REQUESTS.labels("hit").inc()
+        return {**payload, "trips": [
+            t for t in payload["trips"] if _aware(t["trip_start_time"]) > threshold]}
+
+    SEARCH_CACHE_REQUESTS.labels("miss").inc()
+    payload = search()
+    try:
+        cache.set(key, payload, settings.SEARCH_CACHE_TTL)
+        # lets a booking find the route to invalidate without reading the trip
+        cache.set_many({_trip_route_key(t["_id"]): t["route_id"]
+                        for t in payload["trips"] if t.get("route_id")},
+                       settings.SEARCH_CACHE_TTL * 2)
+    except Exception as e:
+        logger.warning("Search cache write failed: %s", e)
+        SEARCH_CACHE_REQUESTS.labels("error").inc()
+    return payload
+
+
+def invalidate_route(route_id):
+    """Make every cached search that includes `route_id` unreachable."""
+    if not route_id:
+        return
+    try:
+        # a new value rather than +1; see _generations for eviction
+        _cache().set(_generation_key(route_id), time.time_ns(), None)
+        SEARCH_CACHE_INVALIDATIONS.inc()
+    except Exception as e:
+        logger.warning("Search cache invalidation failed for route %s: %s", route_id, e)
+        SEARCH_CACHE_REQUESTS.labels("error").inc()
+
+
+def invalidate_trip(trip_id):
+    """Invalidate the searches showing `trip_id` (its seats or times changed)."""
+    try:
+        route_id = _cache().get(_trip_route_key(str(trip_id)))
+        if route_id is None:
+            trip = bustrips_collection.find_one({"_id": ObjectId(trip_id)}, {"route_id": 1})
+            route_id = trip and trip.get("route_id")
+    except Exception as e:
+        logger.warning("Search cache invalidation failed for trip %s: %s", trip_id, e)
+        SEARCH_CACHE_REQUESTS.labels("error").inc()
+        return
+    invalidate_route(route_id)
@@ -0,0 +1,159 @@
+"""
+Compact per-trip seat occupancy.
+
+Next to the embedded `bookings` array every trip keeps `seat_count` and an
+`occupancy` bitmap, one bit per seat packed into 32-bit words
+(`occupancy.w0` holds seats 1-32, `occupancy.w1` seats 33-64, ...). The
+booking engine flips a seat's bit with `$bit` in the same update that
+books or releases the seat, so the bitmap never drifts from the array and
+"is seat N free" can be answered without reading the seat documents.
+
+Trips created before this existed have no `seat_count`; they are read
+from the bookings array until `manage.py backfill_occupancy` has run.
+
+Seats are sold per leg. A booking from a point in route section `a` to one
+in section `b` occupies legs a..b-1, kept as a bitmask (bit 0 = section 1)
+in the seat's `legs` field and in the booking's `legs` field; each booking
+on the seat is also listed in the seat's `segments`. A seat is free for a
+journey when its `legs` and the journey's mask share no bit, so the
+Colombo->Kadawatha half of a seat sold for Kadawatha->Kandy can still be
+sold. The occupancy bitmap above means "some leg of this seat is sold".
+Seats booked before legs existed have no `legs` field and count as taken
+for the whole trip, as does any journey whose sections cannot be resolved.
+"""
+from bson import Int64, ObjectId
+
+from core.route_index import route_index
+from passenger.mongo import get_collection
+
+
+bustrips_collection = get_collection('BusTrips')
+
+WORD_BITS = 32
+
+FREE, BOOKED, HELD = "0", "1", "2"
+
+# every leg of the trip (sections 1-62); also the mask of legacy bookings
+FULL_TRIP = (1 << 62) - 1
+
+
+def empty_occupancy(seat_count):
+    words = (int(seat_count) + WORD_BITS - 1) // WORD_BITS
+    return {f"w{i}": Int64(0) for i in range(words)}
+
+
+def _bit(seat_number):
+    """(word key, mask) of a seat inside `occupancy`."""
+    index = int(seat_number) - 1
+    return f"w{index // WORD_BITS}", 1 << (index % WORD_BITS)
+
+
+def occupancy_from_bookings(bookings):
+    occupancy = empty_occupancy(len(bookings))
+    for seat in bookings:
+        if seat.get("booked"):
+            word, mask = _bit(seat["seat_number"])
+            occupancy[word] = Int64(occupancy.get(word, 0) | mask)
+    return occupancy
+
+
+def mark_booked(seat_number):
+    """`$bit` clause that sets a seat's bit; merge into the seat update."""
+    word, mask = _bit(seat_number)
+    return {f"occupancy.{word}": {"or": Int64(mask)}}
+
+
+def mark_free(seat_number):
+    word, mask = _bit(seat_number)
+    return {f"occupancy.{word}": {"and": Int64(~mask)}}
+
+
+def is_booked(occupancy, seat_number):
+    word, mask = _bit(seat_number)
+    return bool(int((occupancy or {}).get(word, 0)) & mask)
+
+
+TRIP_PROJECTION = {"seat_count": 1, "occupancy": 1}
+
+
+def booked_seat_numbers(trip):
+    """
+    Booked seat numbers from a trip read with TRIP_PROJECTION (plus
+    `bookings` for trips that predate the bitmap).
+    """
+    if "seat_count" not in trip:
+        return {b["seat_number"] for b in trip.get("bookings", []) if b.get("booked")}
+    occupancy = trip.get("occupancy")
+    return {n for n in range(1, trip["seat_count"] + 1) if is_booked(occupancy, n)}
+
+
+def read_trip(trip_id):
+    """The trip's occupancy fields only; None if there is no such trip."""
+    trip = bustrips_collection.find_one({"_id": ObjectId(trip_id)}, TRIP_PROJECTION)
+    if trip is not None and "seat_count" not in trip:
+        # predates the bitmap: fall back to the seat documents
+        trip = bustrips_collection.find_one({"_id": ObjectId(trip_id)}, {"bookings": 1})
+    return trip
+
+
+def legs_between(start_section, end_section):
+    """Mask of legs start_section..end_section-1; None if not a forward journey."""
+    if not 1 <= start_section < end_section <= 63:
+        return None
+    return (1 << (end_section - 1)) - (1 << (start_section - 1))
+
+
+def journey_legs(route_id, start_point_id, end_point_id):
+    """Leg mask for a journey on `route_id`; FULL_TRIP if it cannot be placed."""
+    start_sec = route_index.routes_for_point(start_point_id).get(route_id)
+    end_sec = route_index.routes_for_point(end_point_id).get(route_id)
+    if start_sec is None or end_sec is None:
+        return FULL_TRIP
+    return legs_between(start_sec, end_sec) or FULL_TRIP
+
+
+def trip_journey_legs(trip_id, start_point_id, end_point_id):
+    trip = bustrips_collection.find_one({"_id": ObjectId(trip_id)}, {"route_id": 1})
+    if not trip:
+        return FULL_TRIP
+    return journey_legs(trip.get("route_id"), start_point_id, end_point_id)
+
+
+def seat_free_for(seat, legs):
+    """Whether a seat document can take a journey with mask `legs`."""
+    if "legs" in seat:
+        return not (int(seat["legs"]) & legs)
+    return not seat.get("booked")
+
+
+def free_seat_filter(legs):
+    """$elemMatch clause matching a seat that can take `legs`."""
+    return {"$or": [
+        {"legs": {"$bitsAllClear": Int64(legs)}},
+        {"legs": {"$exists": False}, "booked": False},
+    ]}
+
+
+LEGS_PROJECTION = {"route_id": 1, "bookings.seat_number": 1,
+                   "bookings.booked": 1, "bookings.legs": 1}
+
+
+def free_seats(trip, legs):
+    """Seat numbers of a trip (read with LEGS_PROJECTION) free for `legs`."""
+    return [seat["seat_number"] for seat in trip.get("bookings", [])
+            if seat_free_for(seat, legs)]
+
+
+def seat_count(trip):
+    if "seat_count" in trip:
+        return trip["seat_count"]
+    return len(trip.get("bookings", []))
+
+
+def seat_map(trip, held):
+    """One character per seat: '0' free, '1' booked, '2' held for a checkout."""
+    booked = booked_seat_numbers(trip)
+    return "".join(
+        BOOKED if n in booked else HELD if n in held else FREE
+        for n in range(1, seat_count(trip) + 1)
+    )
@@ -11,6 +11,10 @@ urlpatterns = [
     path('verify-email-otp/', views.verify_email_otp, name='verify_email_otp'),
     path("check-seats/", views.validate_seats_empty_points,
          name="validate_seats_empty_points"),
+    path("seat-availability/", views.seat_availability,
+         name="seat_availability"),
+    path("free-seats/", views.free_seats_for_journey,
+         name="free_seats_for_journey"),
     path("initialize-booking/", views.initialize_booking,
          name="initialize_booking"),
     path("create-booking/", views.create_booking, name="create-booking"),
@@ -32,6 +36,7 @@ urlpatterns = [
          name='register_FCM_token'),
     path('webhooks/payments/', views.genie_webhook, name='payment-webhook'),
     path('map-data/<str:booking_id>/', views.map_data,  name='map_data'),
+    path('live-position/<str:trip_id>/', views.live_position, name='live_position'),
     path('send-departure-alerts/', views.send_departure_alerts,
          name='send_departure_alerts'),
     path('send-notification/', views.send_notification, name='send_notification'),
@@ -1,14 +1,12 @@
 import random
 import math
 import datetime
-import re
 import hmac
 import hashlib
 import json
 import requests
 import pytz
 from dateutil import parser
-from firebase_admin import messaging
 from bson.objectid import ObjectId
 from bson import ObjectId
 from bson.errors import InvalidId
@@ -19,30 +17,27 @@ from rest_framework import status
 from django.conf import settings
 from django.http import HttpResponse, HttpResponseForbidden, HttpResponseBadRequest, JsonResponse
 from django.views.decorators.csrf import csrf_exempt
-from pymongo import MongoClient
 from pymongo.errors import PyMongoError
-from passenger.settings import create_access_token, create_refresh_token, get_access_token_from_request, validate_token, generate_qr_code_base64
+from passenger.mongo import get_client, get_collection
+from passenger.settings import create_access_token, create_refresh_token, get_access_token_from_request, get_request_principal, validate_token
+from bus_owners.live_positions import live_positions
+from bus_owners.tickets import TRIP_WITHOUT_TICKETS
+from core import boarding_search, eta
+from core.route_index import matching_route_ids
+from members import booking_engine, outbox, search_cache, seat_inventory
+from members.booking_engine import SeatUnavailable
+from members.notifications import BOOKING_MESSAGES, send_booking_notification, send_departure_alert
 
 tz = pytz.timezone("Asia/Colombo")
 utc_timezone = pytz.utc
-# Access MongoDB URI from settings
-# Access the URI from settings
-mongodb_uri = settings.DATABASE
-
-# MongoDB client setup using the URI
-client = MongoClient(mongodb_uri)
-# Access your database (assuming the name is 'Passenger')
-db = client['Passenger']
-# Access the 'users' collection (or your actual collection name)
-user_collection = db['Users']
-bookings_collection = db['Bookings']
-bustrips_collection = db['BusTrips']
-routes_collection = db['Routes']
-app_version_collection = db["AppVersion"]
-boarding_points_collection = db["BoardingPoints"]
-FCM_TOKEN_collection = db["FCMTokens"]
-
-NOTIFICATION_URL = "https://www.passenger.lk/members/send-notification/"
+
+user_collection = get_collection('Users')
+bookings_collection = get_collection('Bookings')
+bustrips_collection = get_collection('BusTrips')
+routes_collection = get_collection('Routes')
+app_version_collection = get_collection("AppVersion")
+boarding_points_collection = get_collection("BoardingPoints")
+FCM_TOKEN_collection = get_collection("FCMTokens")
 
 
 @api_view(['POST'])
@@ -231,21 +226,17 @@ def user_details(request):
     if not access_token:
         return Response({"error": "Access token required"}, status=status.HTTP_401_UNAUTHORIZED)
 
-    # Call validate_token with only the access token (no refresh token)
-    validation_result = validate_token(access_token)
+    # Resolve the caller from the access token (no refresh token)
+    principal = get_request_principal(request)
 
-    if validation_result is None:
+    if principal is None:
         return Response({"error": "Invalid or expired access token"}, status=status.HTTP_401_UNAUTHORIZED)
 
-    # validation_result is the decoded payload (or user details, if your validate_token returns that)
-    # Assuming it returns payload with 'user_id' or 'phone_number'
-    # Adjust this depending on what validate_token returns
-
-    user_id = validation_result
+    user_id = principal.user_id
     if not user_id:
         return Response({"error": "Invalid token payload"}, status=status.HTTP_401_UNAUTHORIZED)
 
-    user = user_collection.find_one({"_id": ObjectId(user_id)})
+    user = principal.document_as("USER")
     if not user:
         return Response({"error": "User not found"}, status=status.HTTP_404_NOT_FOUND)
 
@@ -330,12 +321,12 @@ def user_partial_update(request):
     if not access_token:
         return Response({"error": "Access token required"}, status=status.HTTP_401_UNAUTHORIZED)
 
-    validation_result = validate_token(access_token)
-    if validation_result is None:
+    principal = get_request_principal(request)
+    if principal is None:
         return Response({"error": "Invalid or expired access token"}, status=status.HTTP_401_UNAUTHORIZED)
 
-    user_id = validation_result
-    user = user_collection.find_one({"_id": ObjectId(user_id)})
+    user_id = principal.user_id
+    user = principal.document_as("USER")
     if not user:
         return Response({"error": "User not found"}, status=status.HTTP_404_NOT_FOUND)
 
@@ -426,21 +417,21 @@ def verify_email_otp(request):
         return Response({"error": "Access token required"}, status=status.HTTP_401_UNAUTHORIZED)
 
     # Validate the access token
-    validation_result = validate_token(access_token)
+    principal = get_request_principal(request)
 
-    if validation_result is None:
+    if principal is None:
         return Response({"error": "Invalid or expired access token"}, status=status.HTTP_401_UNAUTHORIZED)
 
     # Extract the user data from the validated token
-    user_id = validation_result
+    user_id = principal.user_id
     local_time = datetime.datetime.now(tz)
     now = local_time.astimezone(utc_timezone)
 
     if not user_id:
         return Response({"error": "Invalid token payload"}, status=status.HTTP_401_UNAUTHORIZED)
 
-    # Lookup the user by phone number in MongoDB
-    user = user_collection.find_one({"_id": ObjectId(user_id)})
+    # The principal already carries the user document
+    user = principal.document_as("USER")
 
     if not user:
         return Response({"error": "User with this phone number not found."}, status=status.HTTP_404_NOT_FOUND)
@@ -459,7 +450,7 @@ def verify_email_otp(request):
 
     # Update the user's email verification status and clear OTP fields
 
-    with client.start_session() as session:
+    with get_client().start_session() as session:
         try:
             with session.start_transaction():
 
@@ -494,12 +485,17 @@ def validate_seats_empty_points(request):
     Input JSON:
     {
       "trip_id": "<mongo_id>",
-      "seat_numbers": [1,2,3]  # REQUIRED: JSON array of integers
+      "seat_numbers": [1,2,3],  # REQUIRED: JSON array of integers
+      "start_point_id": "<mongo_id>",  # optional, with end_point_id
+      "end_point_id": "<mongo_id>"
     }
 
     Rule:
-      - Respond "ok" only if, for ALL requested seats, BOTH start_point and end_point are empty/null.
-      - If ANY requested seat has a value in start_point or end_point, respond "seats are booked".
+      - Respond "ok" only if ALL requested seats are neither booked nor under a
+        live checkout hold (SeatHolds).
+      - With start/end points, a seat only counts as booked if one of the
+        journey's route sections is already sold on it.
+      - Otherwise respond "seats are booked" with the booked and held seats.
     """
     data = request.data or {}
     trip_id = data.get("trip_id")
@@ -522,21 +518,18 @@ def validate_seats_empty_points(request):
             status=status.HTTP_400_BAD_REQUEST
         )
 
-    # Fetch trip with bookings
+    # Fetch the trip's occupancy bitmap (not the seat documents)
     try:
-        trip = bustrips_collection.find_one(
-            {"_id": ObjectId(trip_id)}, {"bookings": 1, "_id": 0})
+        trip = seat_inventory.read_trip(trip_id)
     except Exception as e:
         return Response({"detail": f"Invalid trip_id format: {e}"}, status=status.HTTP_400_BAD_REQUEST)
 
     if not trip:
         return Response({"detail": "Trip not found"}, status=status.HTTP_404_NOT_FOUND)
 
-    bookings = trip.get("bookings") or []
-    seat_map = {b.get("seat_number")                : b for b in bookings if "seat_number" in b}
-
     # Ensure all seats exist for the trip
-    missing = [s for s in seat_numbers if s not in seat_map]
+    seat_count = seat_inventory.seat_count(trip)
+    missing = [s for s in seat_numbers if not 1 <= s <= seat_count]
     if missing:
         return Response(
             {"detail": "One or more seats not found on this trip",
@@ -544,29 +537,100 @@ def validate_seats_empty_points(request):
             status=status.HTTP_404_NOT_FOUND
         )
 
-    # Any seat with a value in start_point OR end_point counts as "booked"
-    booked_seats = []
-    for s in seat_numbers:
-        seat_doc = seat_map[s]
-        sp = seat_doc.get("start_point")
-        ep = seat_doc.get("end_point")
-        if not (_is_empty(sp) and _is_empty(ep)):
-            booked_seats.append(s)
+    # Confirmed bookings live on the trip, checkouts in progress in SeatHolds
+    start_point_id = data.get("start_point_id")
+    end_point_id = data.get("end_point_id")
+    if start_point_id and end_point_id:
+        leg_trip = bustrips_collection.find_one(
+            {"_id": ObjectId(trip_id)}, seat_inventory.LEGS_PROJECTION)
+        legs = seat_inventory.journey_legs(
+            leg_trip.get("route_id"), start_point_id, end_point_id)
+        free = set(seat_inventory.free_seats(leg_trip, legs))
+        booked_seats = [s for s in seat_numbers if s not in free]
+    else:
+        booked = seat_inventory.booked_seat_numbers(trip)
+        booked_seats = [s for s in seat_numbers if s in booked]
+    holds = booking_engine.held_seats(trip_id)
+    held_seats = [s for s in seat_numbers if s in holds and s not in booked_seats]
 
-    if booked_seats:
+    if booked_seats or held_seats:
         return Response(
-            {"detail": "seats are booked", "booked_seats": booked_seats},
+            {"detail": "seats are booked",
+             "booked_seats": booked_seats + held_seats,
+             "held_seats": held_seats},
             status=status.HTTP_409_CONFLICT
         )
 
     return Response({"detail": "ok"}, status=status.HTTP_200_OK)
 
 
+@api_view(["GET"])
+def seat_availability(request):
+    """
+    GET ?trip_id=<mongo_id>
+    Seat map for rendering: one character per seat, seat 1 first,
+    '0' free, '1' booked, '2' held by a checkout in progress.
+    """
+    trip_id = request.GET.get("trip_id")
+    if not trip_id:
+        return Response({"detail": "trip_id is required"}, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        trip = seat_inventory.read_trip(trip_id)
+    except Exception as e:
+        return Response({"detail": f"Invalid trip_id format: {e}"}, status=status.HTTP_400_BAD_REQUEST)
+
+    if not trip:
+        return Response({"detail": "Trip not found"}, status=status.HTTP_404_NOT_FOUND)
+
+    return Response({
+        "trip_id": trip_id,
+        "seat_count": seat_inventory.seat_count(trip),
+        "seats": seat_inventory.seat_map(trip, booking_engine.held_seats(trip_id)),
+    }, status=status.HTTP_200_OK)
+
+
+@api_view(["GET"])
+def free_seats_for_journey(request):
+    """
+    GET ?trip_id=<mongo_id>&start_point_id=<mongo_id>&end_point_id=<mongo_id>
+    Seat numbers that can still be sold for that journey, including seats
+    already sold for legs of the route that do not overlap it.
+    """
+    trip_id = request.GET.get("trip_id")
+    start_point_id = request.GET.get("start_point_id")
+    end_point_id = request.GET.get("end_point_id")
+    if not trip_id or not start_point_id or not end_point_id:
+        return Response(
+            {"detail": "trip_id, start_point_id and end_point_id are required"},
+            status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        trip = bustrips_collection.find_one(
+            {"_id": ObjectId(trip_id)}, seat_inventory.LEGS_PROJECTION)
+    except Exception as e:
+        return Response({"detail": f"Invalid trip_id format: {e}"}, status=status.HTTP_400_BAD_REQUEST)
+
+    if not trip:
+        return Response({"detail": "Trip not found"}, status=status.HTTP_404_NOT_FOUND)
+
+    legs = seat_inventory.journey_legs(trip.get("route_id"), start_point_id, end_point_id)
+    holds = booking_engine.held_seats(trip_id)
+    free = [n for n in seat_inventory.free_seats(trip, legs) if n not in holds]
+
+    return Response({
+        "trip_id": trip_id,
+        "whole_trip": legs == seat_inventory.FULL_TRIP,
+        "free_seats": free,
+    }, status=status.HTTP_200_OK)
+
+
 @api_view(["POST"])
 def initialize_booking(request):
     """
-    1) Inserts the booking doc into bookings_collection (with qr_code_base64=None)
-    2) Generates a QR code and updates that same booking doc
+    Holds the seat for the payment window and inserts the Pending booking
+    (with its QR code) through members.booking_engine. A seat somebody else
+    is holding or has booked answers 409.
     """
     data = request.data
     required_fields = [
@@ -584,11 +648,12 @@ def initialize_booking(request):
     access_token = get_access_token_from_request(request)
     if not access_token:
         return Response({"error": "Access token required"}, status=status.HTTP_401_UNAUTHORIZED)
-    user_id = validate_token(access_token)
-    if not user_id:
+    principal = get_request_principal(request)
+    if not principal:
         return Response({"error": "Invalid or expired access token"}, status=status.HTTP_401_UNAUTHORIZED)
 
-    user = user_collection.find_one({"_id": ObjectId(user_id)})
+    user_id = principal.user_id
+    user = principal.document_as("USER")
     if not user:
         return Response({"error": "User not found."}, status=status.HTTP_404_NOT_FOUND)
 
@@ -598,6 +663,11 @@ def initialize_booking(request):
     except ValueError:
         return Response({"detail": "Fee must be a number"}, status=status.HTTP_400_BAD_REQUEST)
 
+    try:
+        int(data["seat_number"])
+    except (TypeError, ValueError):
+        return Response({"detail": "seat_number must be an integer"}, status=status.HTTP_400_BAD_REQUEST)
+
     try:
         start_pt = boarding_points_collection.find_one(
             {"_id": ObjectId(data["start_point_id"])})
@@ -639,58 +709,23 @@ def initialize_booking(request):
         "user_id": user_id,
         "status": "Pending",
         "booked_at": now_utc,
-        "qr_code_base64": None,  # placeholder
+        "legs": seat_inventory.trip_journey_legs(
+            data["trip_id"], data["start_point_id"], data["end_point_id"]),
     }
 
-    # — 1) Insert booking doc —
+    # — Hold the seat and insert the booking (with its QR code) —
     try:
-        res = bookings_collection.insert_one(booking_doc)
-        booking_id = res.inserted_id
-    except Exception as e:
-        return Response({"detail": f"DB insert error: {e}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-
-    try:
-        trip_update = bustrips_collection.update_one(
-            {
-                "_id": ObjectId(data["trip_id"]),
-                "bookings.seat_number": int(data["seat_number"])
-            },
-            {
-                "$set": {
-                    "bookings.$.start_point": start_pt["name"],
-                    "bookings.$.end_point": end_pt["name"]
-                }
-            }
-        )
-        if trip_update.matched_count == 0:
-            return Response(
-                {"detail": "Trip or seat not found (or already booked)"},
-                status=status.HTTP_404_NOT_FOUND
-            )
-    except Exception as e:
+        booking_doc = booking_engine.start_booking(booking_doc)
+    except SeatUnavailable:
         return Response(
-            {"detail": f"Failed to update bus trip: {str(e)}"},
-            status=status.HTTP_500_INTERNAL_SERVER_ERROR
-        )
-    # — 2) Generate & save QR code in the same booking —
-    qr_payload = {
-        "booking_id": str(booking_id),
-        "user_id": user_id
-    }
-    qr_data = json.dumps(qr_payload)
-    qr_b64 = generate_qr_code_base64(qr_data)
-
-    try:
-        bookings_collection.update_one(
-            {"_id": booking_id},
-            {"$set": {"qr_code_base64": qr_b64}}
+            {"detail": "Trip or seat not found (or already booked)"},
+            status=status.HTTP_409_CONFLICT
         )
     except Exception as e:
-        return Response({"detail": f"Failed to save QR code: {e}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        return Response({"detail": f"Failed to book seat: {e}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
     # — Prepare response —
-    booking_doc["_id"] = str(booking_id)
-    booking_doc["qr_code_base64"] = qr_b64
+    booking_doc["_id"] = str(booking_doc["_id"])
     booking_doc["booked_at"] = booking_doc["booked_at"].isoformat() + "Z"
     return Response(booking_doc, status=status.HTTP_201_CREATED)
 
@@ -723,125 +758,72 @@ def create_booking(request):
         )
     customer_id = str(data["customer_id"])
 
-    # 1) Look up the booking
+    payload, http_status = confirm_booking(txn_id, customer_id)
+    return Response(payload, status=http_status)
+
+
+def confirm_booking(txn_id, customer_id):
+    """
+    Does the work behind create_booking and returns (payload, http_status).
+    The Genie webhook calls this directly, so a confirmed payment no longer
+    makes an HTTP round trip back into our own workers.
+    """
+    # 1) Look up the booking and its user
     booking = bookings_collection.find_one({"transaction_id": txn_id})
     if not booking:
         print(txn_id)
-        return Response(
-            {"detail": "Booking not found for transaction_id"},
-            status=status.HTTP_404_NOT_FOUND
-        )
+        return {"detail": "Booking not found for transaction_id"}, status.HTTP_404_NOT_FOUND
     if booking.get("status") != "Pending":
-        return Response(
-            {"detail": "Booking already confirmed"},
-            status=status.HTTP_400_BAD_REQUEST
-        )
+        return {"detail": "Booking already confirmed"}, status.HTTP_400_BAD_REQUEST
+
+    user_id = booking.get("user_id")
+    user_doc = user_collection.find_one(
+        {"_id": ObjectId(user_id)}, {"customer_id": 1})
+    if not user_doc:
+        return {"detail": "User not found."}, status.HTTP_404_NOT_FOUND
+    if "customer_id" in user_doc and user_doc["customer_id"] != customer_id:
+        return {"detail": "Customer ID does not match."}, status.HTTP_400_BAD_REQUEST
+
+    # 2) Claim the booking so a repeated callback cannot confirm it twice
+    booking = booking_engine.claim_pending_booking(txn_id)
+    if booking is None:
+        return {"detail": "Booking already confirmed"}, status.HTTP_400_BAD_REQUEST
 
-    # Extract needed fields
     try:
-        trip_id = booking["trip_id"]
-        seat_num = int(booking["seat_number"])
         fee = float(booking["fee"])
-        user_id = booking["user_id"]
-        start_pt = booking.get("start_point")
-        end_pt = booking.get("end_point")
     except (KeyError, ValueError) as e:
-        return Response(
-            {"detail": f"Malformed booking document: {e}"},
-            status=status.HTTP_500_INTERNAL_SERVER_ERROR
-        )
+        booking_engine.fail_booking(booking)
+        return {"detail": f"Malformed booking document: {e}"}, status.HTTP_500_INTERNAL_SERVER_ERROR
 
-    # 2) Update the bus_trips_collection
+    # 3) Turn the seat hold into a booked seat
     try:
-        trip_update = bustrips_collection.update_one(
-            {
-                "_id": ObjectId(trip_id),
-                "bookings.seat_number": seat_num,
-                "bookings.booked": False  # prevent double-booking
-            },
-            {
-                "$inc": {"booked_seats": 1, "booked_revenue": fee},
-                "$set": {
-                    "bookings.$.booked": True,
-                    "bookings.$.start_point": start_pt,
-                    "bookings.$.end_point": end_pt
-                }
-            }
-        )
-        if trip_update.matched_count == 0:
-            # send ERROR notification for booked/invalid seat
-            try:
-                requests.post(
-                    NOTIFICATION_URL,
-                    json={"user_id": str(user_id),
-                          "notification_category": "ERROR"},
-                    timeout=5
-                )
-            except Exception as ex:
-                print(f"Error sending ERROR notification: {ex}")
-            return Response(
-                {"detail": "Trip or seat not found (or already booked)"},
-                status=status.HTTP_404_NOT_FOUND
-            )
+        booking_engine.book_seat(
+            booking["trip_id"], booking["seat_number"], booking["_id"],
+            booking.get("start_point"), booking.get("end_point"), fee,
+            legs=booking.get("legs", seat_inventory.FULL_TRIP))
+    except SeatUnavailable:
+        booking_engine.fail_booking(booking)
+        outbox.enqueue_booking_notification(user_id, "ERROR", booking["_id"])
+        return {"detail": "Trip or seat not found (or already booked)"}, status.HTTP_404_NOT_FOUND
     except Exception as e:
-        # send ERROR notification on failure
-        try:
-            requests.post(
-                NOTIFICATION_URL,
-                json={"user_id": str(user_id),
-                      "notification_category": "ERROR"},
-                timeout=5
-            )
-        except Exception as ex:
-            print(f"Error sending ERROR notification: {ex}")
-        return Response(
-            {"detail": f"Failed to update bus trip: {str(e)}"},
-            status=status.HTTP_500_INTERNAL_SERVER_ERROR
-        )
-
-    # 3) Update the user_collection and booking status
-    user_doc = user_collection.find_one({"_id": ObjectId(user_id)})
-    if not user_doc:
-        return Response(
-            {"detail": "User not found."},
-            status=status.HTTP_404_NOT_FOUND
-        )
-    if "customer_id" in user_doc and user_doc["customer_id"] != customer_id:
-        return Response(
-            {"detail": "Customer ID does not match."},
-            status=status.HTTP_400_BAD_REQUEST
-        )
+        booking_engine.fail_booking(booking)
+        outbox.enqueue_booking_notification(user_id, "ERROR", booking["_id"])
+        return {"detail": f"Failed to update bus trip: {str(e)}"}, status.HTTP_500_INTERNAL_SERVER_ERROR
 
+    # 4) Attach the booking to the user
     update_ops = {"$addToSet": {"bookings": booking["_id"]}}
     if "customer_id" not in user_doc:
         update_ops["$set"] = {"customer_id": customer_id}
     try:
         user_collection.update_one({"_id": ObjectId(user_id)}, update_ops)
-        bookings_collection.update_one(
-            {"_id": booking["_id"]},
-            {"$set": {"status": "Booked"}}
-        )
     except Exception as e:
-        return Response(
-            {"detail": f"Failed to update user document: {str(e)}"},
-            status=status.HTTP_500_INTERNAL_SERVER_ERROR
-        )
+        return {"detail": f"Failed to update user document: {str(e)}"}, status.HTTP_500_INTERNAL_SERVER_ERROR
 
-    # 4) Signal success and send BOOKED notification
+    # 5) Signal success and queue the BOOKED notification
     print("Transaction successful")
-    try:
-        requests.post(
-            NOTIFICATION_URL,
-            json={"user_id": str(user_id), "notification_category": "BOOKED"},
-            timeout=5
-        )
-    except Exception as e:
-        print(f"Error sending booking notification: {e}")
+    outbox.enqueue_booking_notification(user_id, "BOOKED", booking["_id"])
 
-    return Response(
-        {"detail": "Transaction successful"},
-        status=status.HTTP_200_OK
-    )
+    return {"detail": "Transaction successful"}, status.HTTP_200_OK
 
 
 @api_view(["POST"])
@@ -877,12 +859,12 @@ def reschedule_booking(request):
     access_token = get_access_token_from_request(request)
     if not access_token:
         return Response({"error": "Access token required"}, status=status.HTTP_401_UNAUTHORIZED)
-    validation = validate_token(access_token)
-    if validation is None:
+    principal = get_request_principal(request)
+    if principal is None:
         return Response({"error": "Invalid or expired access token"}, status=status.HTTP_401_UNAUTHORIZED)
-    user_id = validation
+    user_id = principal.user_id
 
-    user = user_collection.find_one({"_id": ObjectId(user_id)})
+    user = principal.document_as("USER")
     if not user:
         return Response({"error": "User not found."}, status=status.HTTP_404_NOT_FOUND)
 
@@ -923,47 +905,11 @@ def reschedule_booking(request):
             status=status.HTTP_403_FORBIDDEN
         )
 
-    # Revert bus trip seat and revenue
-    try:
-        old_trip_id = old_booking["trip_id"]
-        old_seat = int(old_booking["seat_number"])
-        old_fee = float(old_booking["fee"])
-
-        reverse_update = bustrips_collection.update_one(
-            {"_id": ObjectId(old_trip_id), "bookings.seat_number": old_seat},
-            {
-                "$inc": {"booked_seats": -1, "booked_revenue": -old_fee},
-                "$set": {"bookings.$.booked": False,
-                         "bookings.$.start_point": "",
-                         "bookings.$.end_point": ""}
-            }
-        )
-        if reverse_update.matched_count == 0:
-            return Response({"detail": "Failed to revert bus trip booking info."}, status=status.HTTP_404_NOT_FOUND)
-    except Exception as e:
-        return Response({"detail": f"Error updating bus trip: {str(e)}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-
-    # Remove booking reference from user
-    try:
-        user_collection.update_one(
-            {"_id": ObjectId(user_id)},
-            {"$pull": {"bookings": ObjectId(data["old_booking_id"])}}
-        )
-    except Exception as e:
-        return Response({"detail": f"Error updating user bookings: {str(e)}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-
-    # Delete old booking document
-    try:
-        bookings_collection.delete_one(
-            {"_id": ObjectId(data["old_booking_id"])})
-    except Exception as e:
-        return Response({"detail": f"Error deleting old booking: {str(e)}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-
-    # Now proceed to create the new booking (same as create_booking)
     try:
         fee = float(data["fee"])
-    except ValueError:
-        return Response({"detail": "Fee must be a number"}, status=status.HTTP_400_BAD_REQUEST)
+        int(data["seat_number"])
+    except (TypeError, ValueError):
+        return Response({"detail": "Fee and seat_number must be numbers"}, status=status.HTTP_400_BAD_REQUEST)
 
     now_local = datetime.datetime.now(tz)
     now_utc = now_local.astimezone(utc_timezone)
@@ -977,7 +923,7 @@ def reschedule_booking(request):
     else:
         dt = dt.astimezone(utc_timezone)
 
-    new_booking = {
+    new_booking = booking_engine.build_booking({
         "trip_id": data["trip_id"],
         "trip_start_time": dt,
         "start_point_id": data["start_point_id"],
@@ -995,51 +941,81 @@ def reschedule_booking(request):
         "user_id": user_id,
         "status": "Rescedule_1",
         "booked_at": now_utc,
-        "qr_code_base64": None,
-    }
+        "legs": seat_inventory.trip_journey_legs(
+            data["trip_id"], data["start_point_id"], data["end_point_id"]),
+    })
+    new_id = new_booking["_id"]
+
+    if not booking_engine.can_change(old_booking):
+        return Response({"detail": "This booking can no longer be rescheduled."}, status=status.HTTP_400_BAD_REQUEST)
 
+    # Claim the old booking (status Rescheduling); a concurrent
+    # cancel/reschedule makes this a no-op. It is only removed once the new
+    # booking exists, and sweep_trips recovers a reschedule that died half way.
     try:
-        insert_res = bookings_collection.insert_one(new_booking)
-        new_id = insert_res.inserted_id
+        old_fee = float(old_booking["fee"])
+        claimed = booking_engine.begin_reschedule(old_booking, new_booking)
     except Exception as e:
-        return Response({"detail": f"Error creating new booking: {str(e)}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        return Response({"detail": f"Error claiming old booking: {str(e)}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+    if not claimed:
+        return Response({"detail": "Original booking was changed, please retry."}, status=status.HTTP_409_CONFLICT)
 
-    # Generate and save QR code
-    qr_content = f'{{"booking_id":"{str(new_id)}","user_id":"{user_id}"}}'
-    qr_b64 = generate_qr_code_base64(qr_content)
-    bookings_collection.update_one(
-        {"_id": new_id}, {"$set": {"qr_code_base64": qr_b64}})
+    old_booked = old_booking.get("status") in booking_engine.BOOKED_STATUSES
+
+    def put_back_old_booking():
+        # undo the claim: the old seat and booking status come back
+        try:
+            booking_engine.restore_seat(old_booking)
+        except Exception:
+            print(f"Could not restore seat for booking {old_booking['_id']}")
+        booking_engine.abort_transition(old_booking)
 
-    # Update new trip info
+    # Free the old seat, then take the new one; put things back on conflict
     try:
-        seat_num = int(data["seat_number"])
-        trip_update = bustrips_collection.update_one(
-            {"_id": ObjectId(data["trip_id"]),
-             "bookings.seat_number": seat_num},
-            {
-                "$inc": {"booked_seats": 1, "booked_revenue": fee},
-                "$set": {"bookings.$.booked": True,
-                         "bookings.$.start_point": start_point_obj.get('name'),
-                         "bookings.$.end_point": end_point_obj.get('name')}
-            }
-        )
-        if trip_update.matched_count == 0:
-            return Response({"detail": "Failed to book seat on new trip."}, status=status.HTTP_404_NOT_FOUND)
+        booking_engine.release_seat(
+            old_booking["trip_id"], old_booking["seat_number"], old_booking["_id"],
+            old_fee, booked=old_booked, legs=old_booking.get("legs"))
+    except SeatUnavailable:
+        booking_engine.abort_transition(old_booking)
+        return Response({"detail": "Failed to revert bus trip booking info."}, status=status.HTTP_404_NOT_FOUND)
     except Exception as e:
+        booking_engine.abort_transition(old_booking)
+        return Response({"detail": f"Error releasing old seat: {str(e)}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    try:
+        booking_engine.book_seat(
+            data["trip_id"], data["seat_number"], new_id,
+            new_booking["start_point"], new_booking["end_point"], fee,
+            legs=new_booking["legs"], operation="reserve")
+    except SeatUnavailable:
+        put_back_old_booking()
+        return Response({"detail": "Failed to book seat on new trip."}, status=status.HTTP_409_CONFLICT)
+    except Exception as e:
+        put_back_old_booking()
         return Response({"detail": f"Error updating new trip: {str(e)}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-    # Update user bookings
     try:
-        user_collection.update_one(
-            {"_id": ObjectId(user_id)},
-            {"$addToSet": {"bookings": new_id}}
-        )
+        bookings_collection.insert_one(new_booking)
     except Exception as e:
-        return Response({"detail": f"Error adding new booking to user: {str(e)}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        # the new seat is sold to a booking that does not exist; give it back
+        try:
+            booking_engine.release_seat(
+                data["trip_id"], data["seat_number"], new_id, fee,
+                booked=True, legs=new_booking["legs"])
+        except Exception:
+            print(f"Could not release seat for booking {new_id}")
+        put_back_old_booking()
+        return Response({"detail": f"Error creating new booking: {str(e)}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    # The new booking exists: drop the old one and swap the user's reference
+    try:
+        booking_engine.finish_reschedule(old_booking, new_id)
+    except Exception as e:
+        # the new booking stands; sweep_trips finishes the clean-up
+        return Response({"detail": f"Error updating user bookings: {str(e)}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
     # Prepare response
     new_booking["_id"] = str(new_id)
-    new_booking["qr_code_base64"] = qr_b64
     new_booking["booked_at"] = now_utc.isoformat() + "Z"
 
     return Response(new_booking, status=status.HTTP_201_CREATED)
@@ -1080,41 +1056,23 @@ def cancel_booking(request):
     except Exception as e:
         return Response({"detail": f"Error fetching booking: {str(e)}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-    # Revert bus trip seat and revenue
     try:
-        trip_id = booking["trip_id"]
-        seat_num = int(booking["seat_number"])
         fee = float(booking["fee"])
-        revert_result = bustrips_collection.update_one(
-            {"_id": ObjectId(trip_id), "bookings.seat_number": seat_num},
-            {
-                "$inc": {"booked_seats": -1, "booked_revenue": -fee},
-                "$set": {
-                    "bookings.$.booked": False,
-                    "bookings.$.start_point": "",
-                    "bookings.$.end_point": ""
-                }
-            }
-        )
-        if revert_result.matched_count == 0:
-            return Response({"detail": "Failed to revert bus trip booking info."}, status=status.HTTP_404_NOT_FOUND)
-    except Exception as e:
-        return Response({"detail": f"Error updating bus trip: {str(e)}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+    except (KeyError, ValueError) as e:
+        return Response({"detail": f"Malformed booking document: {e}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
     refund_amount = round(fee * 0.85, 2)
 
-    # Update booking status
+    # Update booking status and free the seat
     try:
-        bookings_collection.update_one(
-            {"_id": ObjectId(data["booking_id"])},
-            {"$set": {
-                "status":         "Canceled_by_user",
-                "refund_amount": refund_amount,
-                "refund_resolved": False
-            }}
-        )
+        booking_engine.cancel_booking(booking, "Canceled_by_user", {
+            "refund_amount": refund_amount,
+            "refund_resolved": False
+        })
+    except SeatUnavailable:
+        return Response({"detail": "Booking was already changed or canceled."}, status=status.HTTP_409_CONFLICT)
     except Exception as e:
-        return Response({"detail": f"Error updating booking status: {str(e)}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        return Response({"detail": f"Error canceling booking: {str(e)}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
     return Response({"booking_id": data["booking_id"], "status": "Booking_canceled"}, status=status.HTTP_200_OK)
 
@@ -1125,14 +1083,13 @@ def get_card_info(request):
     access_token = get_access_token_from_request(request)
     if not access_token:
         return Response({"error": "Access token required"}, status=status.HTTP_401_UNAUTHORIZED)
-    validation = validate_token(access_token)
-    if validation is None:
+    principal = get_request_principal(request)
+    if principal is None:
         return Response({"error": "Invalid or expired access token"}, status=status.HTTP_401_UNAUTHORIZED)
-    user_id = validation
 
     # 3) Look up the user document
     try:
-        user_doc = user_collection.find_one({'_id': ObjectId(user_id)})
+        user_doc = principal.document_as("USER")
     except Exception:
         return Response(
             {'detail': 'Error querying user.'},
@@ -1155,42 +1112,16 @@ def find_route_by_points(request):
     start_point_id = request.GET.get('start_point_id')
     end_point_id = request.GET.get('end_point_id')
 
-    start_point_doc = boarding_points_collection.find_one(
-        {"_id": ObjectId(start_point_id)})
-    end_point_doc = boarding_points_collection.find_one(
-        {"_id": ObjectId(end_point_id)})
-
-    start_point = start_point_doc.get('name')
-    end_point = end_point_doc.get('name')
-
     if not start_point_id or not end_point_id:
         return Response(
             {"error": "start_point_id and end_point_id are required"},
             status=400
         )
 
-    # 1) Gather ALL matching route_ids first
-    matching_route_ids = []
-    for route in routes_collection.find({}):
-        sections = route.get('sections', [])
-        start_sec = end_sec = None
-
-        for section in sections:
-            try:
-                sec_num = int(section.get('section_name', '').split()[-1])
-            except ValueError:
-                continue
+    # 1) Gather ALL matching route_ids first (from the in-memory route index)
+    route_ids = matching_route_ids(start_point_id, end_point_id)
 
-            for bp in section.get('boarding_points', []):
-                if bp.get('boarding_id') == start_point_id:
-                    start_sec = sec_num
-                if bp.get('boarding_id') == end_point_id:
-                    end_sec = sec_num
-
-        if start_sec is not None and end_sec is not None and start_sec < end_sec:
-            matching_route_ids.append(str(route['_id']))
-
-    if not matching_route_ids:
+    if not route_ids:
         return Response(
             {"error": "No route found matching the criteria"},
             status=404
@@ -1202,22 +1133,32 @@ def find_route_by_points(request):
 
     threshold = now_utc + datetime.timedelta(minutes=30)
 
-    # 3) Query for any upcoming trips on **any** of those routes
-    cursor = bustrips_collection.find({
-        "route_id":      {"$in": matching_route_ids},
-        "trip_start_time": {"$gt": threshold}
-    })
+    def search():
+        start_point_doc = boarding_points_collection.find_one(
+            {"_id": ObjectId(start_point_id)}, {"name": 1})
+        end_point_doc = boarding_points_collection.find_one(
+            {"_id": ObjectId(end_point_id)}, {"name": 1})
 
-    # 4) Serialize results
-    upcoming_trips = []
-    for trip in cursor:
-        trip['_id'] = str(trip['_id'])
-        upcoming_trips.append(trip)
+        # 3) Query for any upcoming trips on **any** of those routes
+        cursor = bustrips_collection.find({
+            "route_id":      {"$in": route_ids},
+            "trip_start_time": {"$gt": threshold}
+        }, TRIP_WITHOUT_TICKETS)
 
-    return Response({"start_point": start_point,
-                     "end_point": end_point,
-                     "trips": upcoming_trips,
-                     "routes": matching_route_ids})
+        # 4) Serialize results
+        upcoming_trips = []
+        for trip in cursor:
+            trip['_id'] = str(trip['_id'])
+            upcoming_trips.append(trip)
+
+        return {"start_point": start_point_doc.get('name'),
+                "end_point": end_point_doc.get('name'),
+                "trips": upcoming_trips,
+                "routes": route_ids}
+
+    # popular pairs are served from the search cache (members/search_cache.py)
+    return Response(search_cache.cached_search(
+        start_point_id, end_point_id, route_ids, now_utc, threshold, search))
 
 
 @api_view(['GET'])
@@ -1287,13 +1228,18 @@ def get_bus_trip(request):
     except Exception:
         return Response({"error": "Invalid trip id"}, status=400)
 
-    trip = bustrips_collection.find_one({"_id": obj_id})
+    trip = bustrips_collection.find_one({"_id": obj_id}, TRIP_WITHOUT_TICKETS)
     if not trip:
         return Response({"error": "Bus trip not found"}, status=404)
 
     # Convert ObjectId to string for JSON serialization
     trip['_id'] = str(trip['_id'])
 
+    # Seats in somebody's checkout are not free either
+    holds = booking_engine.held_seats(trip_id)
+    for seat in trip.get('bookings', []):
+        seat['held'] = seat.get('seat_number') in holds
+
     return Response(trip)
 
 
@@ -1361,35 +1307,14 @@ def search_boarding_points(request):
     if not q:
         return Response({"error": "q (query) parameter is required"}, status=400)
 
-    # build our two regexes
-    prefix_re = re.compile(rf'^{re.escape(q)}', re.IGNORECASE)
-    contains_re = re.compile(re.escape(q),      re.IGNORECASE)
-
-    # 1) prefix matches
-    prefix_cursor = boarding_points_collection.find({
-        'name': {'$regex': prefix_re}
-    })
-
-    # collect prefix docs and track their IDs
-    results = []
-    seen_ids = set()
-    for doc in prefix_cursor:
-        doc['_id'] = str(doc['_id'])
-        results.append(doc)
-        seen_ids.add(doc['_id'])
+    try:
+        limit = int(request.GET.get('limit', settings.BOARDING_SEARCH_LIMIT))
+    except ValueError:
+        return Response({"error": "limit must be an integer"}, status=400)
+    limit = max(1, min(limit, settings.BOARDING_SEARCH_MAX_LIMIT))
 
-    # 2) all‐over substring matches
-    substr_cursor = boarding_points_collection.find({
-        'name': {'$regex': contains_re}
-    })
-
-    # only keep those we didn’t already add
-    for doc in substr_cursor:
-        sid = str(doc['_id'])
-        if sid in seen_ids:
-            continue
-        doc['_id'] = sid
-        results.append(doc)
+    # prefix matches on name / si_name / ta_name first, then substring matches
+    results = boarding_search.search_boarding_points(q, limit)
 
     return Response(results)
 
@@ -1402,25 +1327,21 @@ def get_ongoing_bookings(request):
         return Response({"error": "Access token required"}, status=status.HTTP_401_UNAUTHORIZED)
 
     # Validate the access token
-    validation_result = validate_token(access_token)
+    principal = get_request_principal(request)
 
-    if validation_result is None:
+    if principal is None:
         return Response({"error": "Invalid or expired access token"}, status=status.HTTP_401_UNAUTHORIZED)
 
     # Extract the user data from the validated token
-    user_id = validation_result
+    user_id = principal.user_id
     if not user_id:
         return Response({'error': 'user_id is required'}, status=400)
-    try:
-        uid = ObjectId(user_id)
-    except Exception:
-        return Response({'error': 'invalid user_id'}, status=400)
 
-    # 2) Pull the user's bookings array (only that field)
-    user_doc = user_collection.find_one({'_id': uid}, {'bookings': 1})
-    bookings_list = user_doc.get('bookings', [])
+    # 2) The user's bookings array comes with the principal's document
+    user_doc = principal.document_as("USER")
     if not user_doc or not user_doc.get('bookings'):
         return Response({'bookings': []})
+    bookings_list = user_doc['bookings']
 
     # 3) Slice off the last five booking‐IDs
     last_five_ids = user_doc['bookings'][-5:]
@@ -1456,6 +1377,16 @@ def get_ongoing_bookings(request):
             b['trip_start_time'] = trip_dt.isoformat()
             out.append(b)
 
+    # one trip lookup for the routes the estimates need
+    if out:
+        trip_ids = {ObjectId(b['trip_id']) for b in out}
+        routes_by_trip = {
+            str(t['_id']): t.get('route_id')
+            for t in bustrips_collection.find({'_id': {'$in': list(trip_ids)}}, {'route_id': 1})
+        }
+    for b in out:
+        b['eta'] = eta.eta_for(b['trip_id'], routes_by_trip.get(b['trip_id']), b.get('start_point_id'))
+
     debug = {
         'all_bookings_from_user_doc': [str(x) for x in bookings_list],
         'last_five_ids': [str(x) for x in last_five_ids],
@@ -1482,23 +1413,13 @@ def booking_history(request):
                         status=status.HTTP_401_UNAUTHORIZED)
 
     # Validate the access token
-    validation_result = validate_token(access_token)
+    principal = get_request_principal(request)
 
-    if validation_result is None:
+    if principal is None:
         return Response({"error": "Invalid or expired access token"}, status=status.HTTP_401_UNAUTHORIZED)
 
-    # Extract the user data from the validated token
-    user_id = validation_result
-
-    if not user_id:
-        return Response({'error': 'user_id is required'}, status=status.HTTP_400_BAD_REQUEST)
-    try:
-        uid = ObjectId(user_id)
-    except Exception:
-        return Response({'error': 'invalid user_id format'}, status=status.HTTP_400_BAD_REQUEST)
-
-    # 2) Get the user’s bookings array
-    user = user_collection.find_one({'_id': uid}, {'bookings': 1})
+    # 2) Get the user’s bookings array from the principal's document
+    user = principal.document_as("USER")
     if not user or not user.get('bookings'):
         return Response({'upcoming': [], 'completed': [], 'failed': []})
 
@@ -1700,20 +1621,15 @@ def genie_webhook(request):
             customer_id = payload.get("customerId")
 
             if transaction_id and customer_id:
-                post_url = "https://www.passenger.lk/members/create-booking/"
-                post_data = {
-                    "transaction_id": str(transaction_id),
-                    "customer_id": str(customer_id)
-                }
                 try:
-                    response = requests.post(
-                        post_url, json=post_data, timeout=10)
-                    print(f"✅ Booking POST status: {response.status_code}")
-                    print(f"Response: {response.text}")
+                    result, result_status = confirm_booking(
+                        str(transaction_id), str(customer_id))
+                    print(f"✅ Booking confirmation status: {result_status}")
+                    print(f"Response: {result}")
                     print(payload)
                     print(str(transaction_id), customer_id)
-                except requests.RequestException as e:
-                    print(f"❌ Failed to post booking: {e}")
+                except Exception as e:
+                    print(f"❌ Failed to confirm booking: {e}")
                     print(str(transaction_id), customer_id)
                     print(payload)
 
@@ -1770,7 +1686,7 @@ def map_data(request, booking_id):
         return Response({'error': "what the fuck are you doing here"}, status=status.HTTP_401_UNAUTHORIZED)
 
     # —– fetch trip —–
-    trip = bustrips_collection.find_one({'_id': ObjectId(trip_id)})
+    trip = bustrips_collection.find_one({'_id': ObjectId(trip_id)}, TRIP_WITHOUT_TICKETS)
     if not trip:
         return Response({'detail': 'Trip not found.'}, status=404)
 
@@ -1811,6 +1727,10 @@ def map_data(request, booking_id):
                 end_coords = {'latitude': lat, 'longitude': lon}
                 end_point_name = bp.get('point_name')
 
+    # the stored road polyline replaces the raw point list; routes that do
+    # not have one yet keep sending the points
+    route_polyline = (route.get('geometry') or {}).get('polyline')
+
     # —– build response —–
     data = {
         'booking_id': booking_id,
@@ -1835,12 +1755,64 @@ def map_data(request, booking_id):
             'bus_name':  bus_name,
             'bus_number': bus_number,
         },
-        'boarding_points': boarding_points,
+        'route_polyline': route_polyline,
+        'boarding_points': None if route_polyline else boarding_points,
+        'eta': eta.eta_for(trip_id, route_id, start_point_id, route),
     }
 
     return Response(data)
 
 
+@api_view(['GET'])
+def live_position(request, trip_id):
+    """
+    GET /live-position/<trip_id>/?wait=20
+    Headers: Authorization: Bearer <jwt>, optionally If-None-Match: <etag>
+
+    Latest known position of the trip's bus from the per-worker cache. With
+    If-None-Match set to the current ETag the answer is an empty 304; with
+    `wait` (seconds, capped at LIVE_POSITION_MAX_WAIT) the request is held
+    until the position changes or the wait runs out, unless the worker is
+    already holding LIVE_POSITION_MAX_WAITERS of them: then it gets a 200
+    with the current position and a Retry-After.
+    """
+    if get_request_principal(request) is None:
+        return Response({"error": "Invalid or expired access token"}, status=status.HTTP_401_UNAUTHORIZED)
+    if not ObjectId.is_valid(trip_id):
+        return Response({"error": "Invalid trip_id format"}, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        wait = float(request.query_params.get("wait", 0))
+    except ValueError:
+        return Response({"error": "wait must be a number of seconds"}, status=status.HTTP_400_BAD_REQUEST)
+    wait = min(max(wait, 0), settings.LIVE_POSITION_MAX_WAIT)
+
+    known = request.headers.get("If-None-Match")
+    result = None
+    if known and wait:
+        result = live_positions.wait_for_change(trip_id, known, wait)
+    busy = known and wait and result is None
+    fix, etag = result or live_positions.get(trip_id)
+
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if busy:
+        # too many long-polls on this worker: answer now with the current
+        # position (not a 304, which clients re-poll at once) and ask the
+        # client to come back after a cache period
+        headers["Retry-After"] = str(max(1, int(settings.LIVE_POSITION_CACHE_TTL)))
+    elif known == etag:
+        return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    return Response({
+        "trip_id": trip_id,
+        "position": fix and {
+            "latitude": fix["latitude"],
+            "longitude": fix["longitude"],
+            "timestamp": fix["timestamp"].isoformat(),
+        },
+    }, headers=headers)
+
+
 @api_view(['POST'])
 def send_departure_alerts(request):
     # 1. Extract user_id and remaining_minutes from request data
@@ -1854,46 +1826,26 @@ def send_departure_alerts(request):
 
     # 3. Convert to ObjectId
     try:
-        uid = ObjectId(user_id)
+        ObjectId(user_id)
     except Exception:
         return Response({'error': 'invalid user_id format'}, status=status.HTTP_400_BAD_REQUEST)
 
-    # 4. Lookup the FCM token document
-    token_doc = FCM_TOKEN_collection.find_one({'_id': uid})
-    if not token_doc or 'fcm_token' not in token_doc:
-        return Response({'error': 'FCM token not found for this user'},
-                        status=status.HTTP_404_NOT_FOUND)
-
-    fcm_token = token_doc['fcm_token']
-    print(fcm_token)
-
-    # 5. Parse and validate remaining_minutes
+    # 4. Parse and validate remaining_minutes
     try:
         minutes = int(remaining_minutes)
     except (ValueError, TypeError):
         return Response({'error': 'remaining_minutes must be an integer'},
                         status=status.HTTP_400_BAD_REQUEST)
 
-    # 6. Prepare departure reminder notification
-    title = 'Bus Departure Reminder'
-    body = f'In {minutes} minutes your bus will be departing. Please be ready at your start point.'
-
-    # 7. Send notification via FCM
-    message = messaging.Message(
-        notification=messaging.Notification(
-            title=title,
-            body=body,
-        ),
-        token=fcm_token,
-    )
-
-    try:
-        response = messaging.send(message)
-        print('Successfully sent message:', response)
+    # 5. Send the departure reminder through the notification service
+    result = send_departure_alert(user_id, minutes)
+    if result["status"] == "no_token":
+        return Response({'error': 'FCM token not found for this user'},
+                        status=status.HTTP_404_NOT_FOUND)
+    if result["status"] == "success":
+        print('Successfully sent message:', result["message_id"])
         return JsonResponse({"status": "success"})
-    except Exception as e:
-        print('Error sending message:', e)
-        return JsonResponse({"status": "error", "message": str(e)})
+    return JsonResponse({"status": "error", "message": result.get("message", result["status"])})
 
 
 @api_view(['POST'])
@@ -1908,59 +1860,30 @@ def send_notification(request):
                         status=status.HTTP_400_BAD_REQUEST)
 
     # 3. Validate category value
-    if category not in ('BOOKED', 'RESCHEDULED', 'CANCELED', 'ERROR'):
+    if category not in BOOKING_MESSAGES:
         return Response({'error': 'invalid notification_category'}, status=status.HTTP_400_BAD_REQUEST)
 
     # 4. Convert to ObjectId
     try:
-        uid = ObjectId(user_id)
+        ObjectId(user_id)
     except Exception:
         return Response({'error': 'invalid user_id format'}, status=status.HTTP_400_BAD_REQUEST)
 
-    # 5. Lookup the FCM token document
-    token_doc = FCM_TOKEN_collection.find_one({'_id': uid})
-    if not token_doc or 'fcm_token' not in token_doc:
+    # 5. Send through the notification service
+    result = send_booking_notification(user_id, category)
+    if result["status"] == "no_token":
         return Response({'error': 'FCM token not found for this user'},
                         status=status.HTTP_404_NOT_FOUND)
-    fcm_token = token_doc['fcm_token']
-    print(fcm_token)
-
-    # 6. Prepare notification content based on category
-    if category == 'BOOKED':
-        title = 'Booking Confirmed'
-        body = 'Your booking was successful.'
-    elif category == 'RESCHEDULED':
-        title = 'Booking Rescheduled'
-        body = 'Your booking has been rescheduled. Please check the new time.'
-    elif category == 'CANCELED':
-        title = 'Booking Canceled'
-        body = 'Your booking has been canceled. We apologize for the inconvenience.'
-    else:  # ERROR
-        title = 'Booking Error'
-        body = 'There was an error occurred when booking your seat. Please contact us on the 0122345566.'
-
-    # 7. Send notification via FCM
-    message = messaging.Message(
-        notification=messaging.Notification(
-            title=title,
-            body=body,
-        ),
-        token=fcm_token,
-    )
-
-    try:
-        response = messaging.send(message)
-        print('Successfully sent message:', response)
+    if result["status"] == "success":
+        print('Successfully sent message:', result["message_id"])
         return JsonResponse({
             'status': 'success',
             'user_id': user_id,
             'notification_category': category
         })
-    except Exception as e:
-        print('Error sending message:', e)
-        return JsonResponse({
-            'status': 'error',
-            'user_id': user_id,
-            'notification_category': category,
-            'message': str(e)
-        })
+    return JsonResponse({
+        'status': 'error',
+        'user_id': user_id,
+        'notification_category': category,
+        'message': result.get("message", result["status"])
+    })
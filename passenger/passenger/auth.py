@@ -0,0 +1,189 @@
+# passenger/auth.py
+
+"""
+Token-version cache and the request principal behind `validate_token`.
+
+Access tokens carry the `tokenVersion` that was current when they were
+issued. Checking it used to cost a Mongo round trip on every request, so
+versions are now kept in a short-TTL, per-process cache that `logout`,
+`refresh_tokens` and the machine `tokenVersion` increments update
+explicitly. Other workers pick the change up when their entry expires,
+or at once when a token newer than their cached version shows up.
+"""
+import threading
+import time
+
+import jwt
+from bson import ObjectId
+from bson.errors import InvalidId
+from django.conf import settings
+
+from passenger.mongo import get_collection
+
+
+ROLE_COLLECTIONS = {
+    "USER": get_collection('Users'),
+    "OWNER": get_collection('BusOwners'),
+    "MACHINE": get_collection('Buses'),
+}
+
+_MISSING = object()
+
+
+class TokenVersionCache:
+    """Thread-safe {(role, id): tokenVersion} map with per-entry expiry."""
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, role, subject_id):
+        entry = self._entries.get((role, subject_id))
+        if entry is None:
+            return _MISSING
+        version, expires_at = entry
+        if expires_at < time.monotonic():
+            with self._lock:
+                self._entries.pop((role, subject_id), None)
+            return _MISSING
+        return version
+
+    def set(self, role, subject_id, version):
+        expires_at = time.monotonic() + settings.TOKEN_VERSION_CACHE_TTL
+        with self._lock:
+            self._entries[(role, subject_id)] = (version, expires_at)
+
+    def invalidate(self, role, subject_id):
+        with self._lock:
+            self._entries.pop((role, subject_id), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+token_versions = TokenVersionCache()
+
+
+def remember_token_version(role, subject_id, version):
+    token_versions.set(role, str(subject_id), version)
+
+
+def invalidate_token_version(role, subject_id):
+    token_versions.invalidate(role, str(subject_id))
+
+
+def cached_token_version(role, subject_id, at_least=None):
+    """
+    Return (tokenVersion, document) for `subject_id`.
+
+    `document` is only set when the cache missed and the full document had
+    to be read; it is None when the subject does not exist. A cached
+    version older than `at_least` is re-read: another worker has bumped it
+    (logout, refresh) and this one has not seen that yet.
+    """
+    version = token_versions.get(role, subject_id)
+    if version is not _MISSING and (at_least is None or version >= at_least):
+        return version, None
+
+    try:
+        oid = ObjectId(subject_id)
+    except (InvalidId, TypeError):
+        return None, None
+
+    document = ROLE_COLLECTIONS[role].find_one({"_id": oid})
+    if document is None:
+        return None, None
+
+    version = document.get('tokenVersion', 0)
+    token_versions.set(role, subject_id, version)
+    return version, document
+
+
+class Principal:
+    """
+    The authenticated caller of one request.
+
+    `document` is the caller's Users/BusOwners document. It is reused when
+    token validation already had to read it and loaded at most once
+    otherwise, so views do not query it a second time.
+    """
+
+    def __init__(self, user_id, role, document=None):
+        self.user_id = user_id
+        self.role = role
+        self._document = document
+        self._loaded = document is not None
+
+    def __str__(self):
+        return self.user_id
+
+    @property
+    def object_id(self):
+        return ObjectId(self.user_id)
+
+    @property
+    def document(self):
+        if not self._loaded:
+            self._document = ROLE_COLLECTIONS[self.role].find_one(
+                {"_id": self.object_id})
+            self._loaded = True
+        return self._document
+
+    def document_as(self, role):
+        """The caller's document, or None if the token is for another role."""
+        if self.role != role:
+            return None
+        return self.document
+
+
+def resolve_principal(access_token):
+    """Decode an access token and check its version; None if it is not valid."""
+    try:
+        payload = jwt.decode(
+            access_token, settings.SECRET_KEY, algorithms=['HS256'])
+    except (jwt.ExpiredSignatureError, jwt.InvalidTokenError):
+        return None
+
+    if payload.get('type') != 'access':
+        return None
+
+    user_id_str = payload.get('user_id')
+    role = payload.get('role')
+    if not user_id_str or role not in ('USER', 'OWNER'):
+        return None
+
+    token_version = payload.get('tokenVersion', 0)
+    version, document = cached_token_version(role, user_id_str, at_least=token_version)
+    if version is None or version != token_version:
+        return None
+
+    return Principal(user_id_str, role, document)
+
+
+def validate_machine_token(token):
+    """
+    Check a conductor-machine JWT in-process.
+
+    Returns (bus_id, None, None) when the token is good, otherwise
+    (None, error_message, http_status) matching what /validate-machine/
+    has always answered.
+    """
+    try:
+        payload = jwt.decode(token, settings.SECRET_KEY, algorithms=['HS256'])
+    except jwt.InvalidTokenError:
+        return None, "Invalid token", 400
+
+    bus_id = payload.get("bus_id")
+    token_version = payload.get("tokenVersion")
+    if not bus_id or not token_version:
+        return None, "Invalid token payload", 400
+
+    db_token_version, _ = cached_token_version("MACHINE", bus_id)
+    if db_token_version is None:
+        return None, "Bus not found", 404
+
+    if db_token_version and db_token_version > token_version:
+        return None, "Authentication failed. Token version is higher than the provided token version.", 403
+
+    return bus_id, None, None
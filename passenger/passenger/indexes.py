@@ -0,0 +1,103 @@
+# passenger/indexes.py
+
+"""
+Single registry of the MongoDB indexes the views rely on.
+
+`INDEXES` is what `manage.py ensure_indexes` creates; `CANONICAL_QUERIES`
+are trimmed-down copies of the hot view queries that the same command runs
+through explain() to make sure none of them fall back to a COLLSCAN.
+"""
+import datetime
+
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING
+
+
+# (collection, keys, options)
+INDEXES = [
+    ("Users", [("phone_number", ASCENDING)], {}),
+    ("BusOwners", [("phone_number", ASCENDING)], {}),
+    ("Buses", [("bus_number", ASCENDING)], {}),
+    ("Bookings", [("transaction_id", ASCENDING)], {}),
+    ("Bookings", [("trip_id", ASCENDING), ("bus_id", ASCENDING),
+                  ("status", ASCENDING)], {}),
+    ("BusTrips", [("route_id", ASCENDING), ("trip_start_time", ASCENDING)], {}),
+    ("BusTrips", [("bus_id", ASCENDING), ("trip_start_time", ASCENDING)], {}),
+    ("TripLocation", [("trip_id", ASCENDING), ("start_ts", ASCENDING)], {}),
+    # checkout holds expire on their own (members/booking_engine.py)
+    ("SeatHolds", [("expires_at", ASCENDING)], {"expireAfterSeconds": 0}),
+    ("SeatHolds", [("trip_id", ASCENDING), ("expires_at", ASCENDING)], {}),
+    ("TicketBuckets", [("trip_id", ASCENDING), ("first_at", ASCENDING)], {}),
+    ("BusTrips", [("trip_start_time", ASCENDING)], {}),
+    # dead tokens are pruned by value (members/notifications.py)
+    ("FCMTokens", [("fcm_token", ASCENDING)], {}),
+    # one departure alert per booking and offset (members/alerts.py)
+    ("AlertLedger", [("created_at", ASCENDING)], {"expireAfterSeconds": 30 * 24 * 3600}),
+    # outbox claims, and sent messages cleared after a week (members/outbox.py)
+    ("NotificationOutbox", [("status", ASCENDING), ("available_at", ASCENDING)], {}),
+    ("NotificationOutbox", [("sent_at", ASCENDING)], {"expireAfterSeconds": 7 * 24 * 3600}),
+    ("TripEvents", [("trip_id", ASCENDING), ("at", ASCENDING)], {}),
+    ("TripEvents", [("notified", ASCENDING), ("created_at", ASCENDING)], {}),
+    # interrupted cancels/reschedules (members/booking_engine.py); only
+    # bookings in transition carry transition_at
+    ("Bookings", [("status", ASCENDING), ("transition_at", ASCENDING)],
+     {"partialFilterExpression": {"transition_at": {"$exists": True}}}),
+    # trip sweeper batches (core/trip_lifecycle.py) and archived trip lookups
+    ("BusTrips", [("completed", ASCENDING), ("trip_start_time", ASCENDING)], {}),
+    ("BusTripsArchive", [("bus_id", ASCENDING), ("trip_start_time", ASCENDING)], {}),
+]
+
+
+_SAMPLE_ID = "000000000000000000000000"
+_SAMPLE_TIME = datetime.datetime(2025, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+# name -> (collection, filter, sort); names point at the view they mirror
+CANONICAL_QUERIES = {
+    "members.verify_otp": (
+        "Users", {"phone_number": "0770000000"}, None),
+    "bus_owners.verify_otp": (
+        "BusOwners", {"phone_number": "0770000000"}, None),
+    "bus_owners.machine_login": (
+        "Buses", {"bus_number": "NB - 0000"}, None),
+    "members.create_booking": (
+        "Bookings", {"transaction_id": "txn"}, None),
+    "members.departure_alert_trips": (
+        "BusTrips", {"trip_start_time": {"$gt": _SAMPLE_TIME, "$lte": _SAMPLE_TIME},
+                     "completed": False}, None),
+    "members.departure_alert_bookings": (
+        "Bookings", {"trip_id": _SAMPLE_ID, "status": {"$in": ["Booked"]}}, None),
+    "bus_owners.complete_bookings": (
+        "Bookings", {"trip_id": _SAMPLE_ID, "bus_id": _SAMPLE_ID,
+                     "status": "Verified"}, None),
+    "members.find_route_by_points": (
+        "BusTrips", {"route_id": {"$in": [_SAMPLE_ID]},
+                     "trip_start_time": {"$gt": _SAMPLE_TIME}}, None),
+    "bus_owners.get_trips_by_bus": (
+        "BusTrips", {"bus_id": _SAMPLE_ID},
+        [("trip_start_time", ASCENDING)]),
+    "bus_owners.get_started_bus_trip": (
+        "BusTrips", {"bus_id": _SAMPLE_ID,
+                     "trip_start_time": {"$lte": _SAMPLE_TIME}},
+        [("trip_start_time", DESCENDING)]),
+    "bus_owners.record_trip_locations": (
+        "TripLocation", {"trip_id": _SAMPLE_ID, "count": {"$lte": 499}}, None),
+    "bus_owners.trip_location_history": (
+        "TripLocation", {"trip_id": _SAMPLE_ID}, [("start_ts", ASCENDING)]),
+    "members.validate_seats_empty_points": (
+        "SeatHolds", {"trip_id": _SAMPLE_ID,
+                      "expires_at": {"$gt": _SAMPLE_TIME}}, None),
+    "bus_owners.trip_tickets": (
+        "TicketBuckets", {"trip_id": _SAMPLE_ID}, [("first_at", ASCENDING)]),
+    "members.outbox_claim": (
+        "NotificationOutbox", {"status": "pending", "available_at": {"$lte": _SAMPLE_TIME}},
+        [("available_at", ASCENDING)]),
+    "core.sweep_finished_trips": (
+        "BusTrips", {"completed": False, "trip_start_time": {"$lt": _SAMPLE_TIME}},
+        [("trip_start_time", ASCENDING)]),
+    "core.archive_old_trips": (
+        "BusTrips", {"completed": True, "trip_start_time": {"$lt": _SAMPLE_TIME}},
+        [("trip_start_time", ASCENDING)]),
+    "members.send_notification": (
+        "FCMTokens", {"_id": ObjectId(_SAMPLE_ID)}, None),
+}
@@ -1,6 +1,6 @@
 # myproject/metrics.py
 
-from prometheus_client import Counter, Histogram
+from prometheus_client import Counter, Gauge, Histogram
 
 # Define your metrics
 REQUEST_COUNT = Counter(
@@ -42,3 +42,92 @@ class PrometheusMiddleware:
         REQUEST_COUNT.labels(method, endpoint, response.status_code).inc()
 
         return response
+
+
+# MongoDB connection pool (fed by passenger.mongo.PoolMetricsListener)
+MONGO_POOL_CHECKOUTS = Counter(
+    'mongo_pool_checkouts_total',
+    'MongoDB connection checkouts by outcome',
+    ['address', 'outcome']
+)
+MONGO_POOL_CHECKOUT_WAIT = Histogram(
+    'mongo_pool_checkout_wait_seconds',
+    'Time spent waiting for a pooled MongoDB connection',
+    ['address'],
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+)
+MONGO_POOL_IN_USE = Gauge(
+    'mongo_pool_connections_in_use',
+    'MongoDB connections currently checked out',
+    ['address']
+)
+MONGO_POOL_CONNECTIONS = Gauge(
+    'mongo_pool_connections_open',
+    'MongoDB connections currently open',
+    ['address']
+)
+
+
+# Seat reservations (fed by members.booking_engine)
+SEAT_OPERATIONS = Counter(
+    'seat_operations_total',
+    'Seat hold/confirm/reserve/release attempts by outcome',
+    ['operation', 'outcome']
+)
+
+
+# Vehicle position ingest (fed by bus_owners mqtt_ingest)
+MQTT_MESSAGES = Counter(
+    'mqtt_vehicle_messages_total',
+    'Vehicle position messages received, by outcome',
+    ['outcome']
+)
+MQTT_FLUSHES = Counter(
+    'mqtt_vehicle_flushes_total',
+    'Buffered fix batches written to TripLocation, by trigger and outcome',
+    ['trigger', 'outcome']
+)
+MQTT_FLUSH_BATCH = Histogram(
+    'mqtt_vehicle_flush_batch_size',
+    'Fixes written per TripLocation flush',
+    buckets=(1, 5, 10, 25, 50, 100, 250, 500)
+)
+MQTT_INGEST_LAG = Histogram(
+    'mqtt_vehicle_ingest_lag_seconds',
+    'Time from receiving a fix to it being stored',
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+)
+MQTT_BUFFERED = Gauge(
+    'mqtt_vehicle_buffered_fixes',
+    'Fixes received but not yet written'
+)
+
+
+# Notification outbox (fed by members.outbox)
+OUTBOX_DELIVERIES = Counter(
+    'notification_outbox_deliveries_total',
+    'Outbox delivery attempts by outcome (sent, retry, dead)',
+    ['outcome']
+)
+OUTBOX_DELIVERY_LAG = Histogram(
+    'notification_outbox_delivery_lag_seconds',
+    'Time from a notification being queued to it being sent',
+    buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900)
+)
+OUTBOX_PENDING = Gauge(
+    'notification_outbox_pending',
+    'Notifications waiting in the outbox'
+)
+
+
+# Trip search result cache (fed by members.search_cache); hit ratio is
+# hit / (hit + miss)
+SEARCH_CACHE_REQUESTS = Counter(
+    'trip_search_cache_requests_total',
+    'Trip search cache outcomes (hit, miss; error for failed reads, writes and invalidations)',
+    ['outcome']
+)
+SEARCH_CACHE_INVALIDATIONS = Counter(
+    'trip_search_cache_invalidations_total',
+    'Routes whose cached searches were invalidated by a trip or seat change'
+)
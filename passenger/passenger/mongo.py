@@ -0,0 +1,191 @@
+# passenger/mongo.py
+
+"""
+Shared MongoDB access for every app.
+
+Each process owns exactly one MongoClient. It is created lazily on first use
+and thrown away in the child after a fork, so gunicorn's pre-forked workers
+each build their own pool instead of inheriting sockets from the master.
+"""
+import os
+import threading
+
+from django.conf import settings
+from pymongo import MongoClient, monitoring
+
+from passenger.metrics import (
+    MONGO_POOL_CHECKOUTS,
+    MONGO_POOL_CHECKOUT_WAIT,
+    MONGO_POOL_CONNECTIONS,
+    MONGO_POOL_IN_USE,
+)
+
+
+_lock = threading.Lock()
+_client = None
+_client_pid = None
+_collections = {}
+
+
+class PoolMetricsListener(monitoring.ConnectionPoolListener):
+    """
+    Feeds connection-pool events into Prometheus so the pool can be sized
+    from real checkout numbers.
+    """
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        MONGO_POOL_CONNECTIONS.labels(_address(event)).inc()
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        MONGO_POOL_CONNECTIONS.labels(_address(event)).dec()
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        MONGO_POOL_CHECKOUTS.labels(_address(event), str(event.reason)).inc()
+        duration = getattr(event, "duration", None)
+        if duration is not None:
+            MONGO_POOL_CHECKOUT_WAIT.labels(_address(event)).observe(duration)
+
+    def connection_checked_out(self, event):
+        MONGO_POOL_CHECKOUTS.labels(_address(event), "ok").inc()
+        MONGO_POOL_IN_USE.labels(_address(event)).inc()
+        duration = getattr(event, "duration", None)
+        if duration is not None:
+            MONGO_POOL_CHECKOUT_WAIT.labels(_address(event)).observe(duration)
+
+    def connection_checked_in(self, event):
+        MONGO_POOL_IN_USE.labels(_address(event)).dec()
+
+
+def _address(event):
+    host, port = event.address
+    return f"{host}:{port}"
+
+
+def _write_concern_w(value):
+    # "majority" stays a string, "1" / "2" become ints
+    if value is None or value == "":
+        return None
+    return int(value) if str(value).isdigit() else value
+
+
+def _build_client():
+    options = {
+        "maxPoolSize": settings.MONGO_MAX_POOL_SIZE,
+        "minPoolSize": settings.MONGO_MIN_POOL_SIZE,
+        "maxIdleTimeMS": settings.MONGO_MAX_IDLE_TIME_MS,
+        "waitQueueTimeoutMS": settings.MONGO_WAIT_QUEUE_TIMEOUT_MS,
+        "connectTimeoutMS": settings.MONGO_CONNECT_TIMEOUT_MS,
+        "socketTimeoutMS": settings.MONGO_SOCKET_TIMEOUT_MS,
+        "serverSelectionTimeoutMS": settings.MONGO_SERVER_SELECTION_TIMEOUT_MS,
+        "event_listeners": [PoolMetricsListener()],
+    }
+
+    w = _write_concern_w(settings.MONGO_WRITE_CONCERN)
+    if w is not None:
+        options["w"] = w
+        if settings.MONGO_WRITE_TIMEOUT_MS:
+            options["wTimeoutMS"] = settings.MONGO_WRITE_TIMEOUT_MS
+
+    if settings.MONGO_READ_CONCERN:
+        options["readConcernLevel"] = settings.MONGO_READ_CONCERN
+
+    return MongoClient(settings.DATABASE, **options)
+
+
+def get_client():
+    """Return this process's MongoClient, creating it on first use."""
+    global _client, _client_pid
+
+    pid = os.getpid()
+    if _client is not None and _client_pid == pid:
+        return _client
+
+    with _lock:
+        if _client is None or _client_pid != pid:
+            # A client inherited from the parent must not be closed here:
+            # its sockets still belong to the parent process.
+            _client = _build_client()
+            _client_pid = pid
+            _collections.clear()
+    return _client
+
+
+def get_db():
+    return get_client()[settings.MONGO_DB_NAME]
+
+
+class LazyCollection:
+    """
+    Module-level stand-in for a pymongo Collection.
+
+    Views keep their `x_collection = ...` globals, but nothing touches the
+    network (or the client) until the first real call, which always goes
+    through the current process's client.
+    """
+
+    def __init__(self, name):
+        self._name = name
+
+    @property
+    def name(self):
+        return self._name
+
+    def _resolve(self):
+        get_client()
+        collection = _collections.get(self._name)
+        if collection is None:
+            collection = get_db()[self._name]
+            _collections[self._name] = collection
+        return collection
+
+    def __getattr__(self, attr):
+        return getattr(self._resolve(), attr)
+
+    def __repr__(self):
+        return f"LazyCollection({self._name!r})"
+
+
+def get_collection(name):
+    return LazyCollection(name)
+
+
+def close_client():
+    """Close the pool owned by this process (used by management commands)."""
+    global _client, _client_pid
+    with _lock:
+        if _client is not None and _client_pid == os.getpid():
+            _client.close()
+        _client = None
+        _client_pid = None
+        _collections.clear()
+
+
+def _forget_client_after_fork():
+    global _lock, _client, _client_pid
+    # the parent's lock may have been held at fork time
+    _lock = threading.Lock()
+    _client = None
+    _client_pid = None
+    _collections.clear()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_forget_client_after_fork)
@@ -24,7 +24,8 @@ from rest_framework.decorators import api_view
 from rest_framework.response import Response
 from rest_framework import status
 from rest_framework.authentication import get_authorization_header
-from pymongo import MongoClient
+from passenger.mongo import get_collection
+from passenger.auth import resolve_principal, remember_token_version, invalidate_token_version, validate_machine_token
 
 
 load_dotenv('.env.local')
@@ -54,7 +55,10 @@ SECRET_KEY = os.getenv("DJANGO_SECRET_KEY")
 DATABASE = os.getenv("DATABASE")
 GENIE_API_KEY = os.getenv("GENIE_API_KEY")
 FIREBASE_CREDENTIALS_JSON = os.getenv("FIREBASE_CREDENTIALS_JSON")
-NOTIFICATION_URL = os.getenv("NOTIFICATION_URL")
+GOOGLE_MAPS_API_KEY = os.getenv("GOOGLE_MAPS_API_KEY")
+# Dotted path of the push transport used by members/notifications.py
+NOTIFICATION_TRANSPORT = os.getenv(
+    "NOTIFICATION_TRANSPORT", "members.notifications.FCMTransport")
 
 
 DEBUG = os.getenv('DEBUG', 'False') == 'True'
@@ -118,21 +122,152 @@ WSGI_APPLICATION = 'passenger.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
-client = MongoClient(DATABASE)
-# Access your database (assuming the name is 'Passenger')
-db = client['Passenger']
-# Access the 'users' collection (or your actual collection name)
-user_collection = db['Users']
-bus_owner_collection = db['BusOwners']
-bus_collection = db['Buses']
-
-bookings_collection = db['Bookings']
-bustrips_collection = db['BusTrips']
-routes_collection = db['Routes']
-app_version_collection = db["AppVersion"]
-boarding_points_collection = db["BoardingPoints"]
-FCM_TOKEN_collection = db["FCMTokens"]
-admin_collection = db["Admin"]
+# One lazily created MongoClient per process, shared by every app
+# (see passenger/mongo.py). Pool sizing and concerns are tuned from the env.
+MONGO_DB_NAME = os.getenv("MONGO_DB_NAME", "Passenger")
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "20"))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "0"))
+MONGO_MAX_IDLE_TIME_MS = int(os.getenv("MONGO_MAX_IDLE_TIME_MS", "300000"))
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(
+    os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", "5000"))
+MONGO_CONNECT_TIMEOUT_MS = int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", "5000"))
+MONGO_SOCKET_TIMEOUT_MS = int(os.getenv("MONGO_SOCKET_TIMEOUT_MS", "20000"))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(
+    os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "5000"))
+MONGO_READ_CONCERN = os.getenv("MONGO_READ_CONCERN", "")  # e.g. "majority"
+MONGO_WRITE_CONCERN = os.getenv("MONGO_WRITE_CONCERN", "")  # e.g. "majority"
+MONGO_WRITE_TIMEOUT_MS = int(os.getenv("MONGO_WRITE_TIMEOUT_MS", "0"))
+
+# Seconds a tokenVersion stays cached per worker (see passenger/auth.py)
+TOKEN_VERSION_CACHE_TTL = int(os.getenv("TOKEN_VERSION_CACHE_TTL", "30"))
+
+# Seconds before each worker rebuilds its boarding point -> route index
+ROUTE_INDEX_TTL = int(os.getenv("ROUTE_INDEX_TTL", "300"))
+
+# Boarding point autocomplete (see core/boarding_search.py)
+BOARDING_SEARCH_TTL = int(os.getenv("BOARDING_SEARCH_TTL", "300"))
+BOARDING_SEARCH_LIMIT = 20
+BOARDING_SEARCH_MAX_LIMIT = 50
+
+# Trip search results (see members/search_cache.py) live in the 'search'
+# cache: per-process memory unless SEARCH_CACHE_URL points at a Redis shared
+# by every worker. Entries last TTL seconds and are keyed by a time bucket
+# of BUCKET seconds.
+SEARCH_CACHE_URL = os.getenv("SEARCH_CACHE_URL")
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    "search": {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": SEARCH_CACHE_URL,
+        "KEY_PREFIX": "passenger",
+    } if SEARCH_CACHE_URL else {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "trip-search",
+        "OPTIONS": {"MAX_ENTRIES": 10000},
+    },
+}
+SEARCH_CACHE_TTL = int(os.getenv("SEARCH_CACHE_TTL", "30"))
+SEARCH_CACHE_BUCKET_SECONDS = 30
+
+# How long a seat stays held for a checkout before the TTL index frees it
+SEAT_HOLD_SECONDS = int(os.getenv("SEAT_HOLD_SECONDS", "600"))
+
+# A cancel or reschedule still unfinished after this long was interrupted and
+# is completed or rolled back by sweep_trips (see members/booking_engine.py)
+BOOKING_TRANSITION_TIMEOUT_SECONDS = 300
+
+# Conductor tickets per TicketBuckets document (see bus_owners/tickets.py)
+TICKET_BUCKET_SIZE = 200
+# How long an upload owns the unapplied ticket receipts it wrote before a
+# retried upload may apply them instead
+TICKET_APPLY_LEASE_SECONDS = 60
+
+# GPS fixes per TripLocation document (see bus_owners/locations.py)
+TRIP_LOCATION_BUCKET_SIZE = 500
+
+# Directions client factory used to build route polylines (see
+# core/route_geometry.py; point it at a stub for local work) and the
+# number of evenly spaced points a stored polyline is resampled to
+ROUTE_DIRECTIONS_CLIENT = os.getenv(
+    "ROUTE_DIRECTIONS_CLIENT", "core.route_geometry.googlemaps_client")
+ROUTE_POLYLINE_POINTS = 500
+
+# assumed speed on route sections no bus has been observed on yet, and the
+# slowest speed an ETA will assume (so a bus waiting at a stop is not "never")
+ETA_DEFAULT_SPEED_KMH = 25
+ETA_MIN_SPEED_KMH = 5
+
+# departure alerts go out this many minutes before a trip starts; the
+# scheduler looks for new trips every SCAN seconds and still sends an
+# alert it finds up to GRACE seconds late (see members/alerts.py)
+DEPARTURE_ALERT_OFFSETS = (30, 10)
+DEPARTURE_ALERT_SCAN_SECONDS = 60
+DEPARTURE_ALERT_GRACE_SECONDS = 120
+
+# notification outbox workers (see members/outbox.py): how long a claimed
+# message is theirs, how often it is tried, backoff between tries, how
+# often an idle worker polls, and the run_notification_outbox defaults
+OUTBOX_LEASE_SECONDS = 60
+OUTBOX_MAX_ATTEMPTS = 8
+OUTBOX_BACKOFF_BASE_SECONDS = 5
+OUTBOX_BACKOFF_MAX_SECONDS = 900
+OUTBOX_POLL_SECONDS = 1.0
+OUTBOX_WORKER_THREADS = int(os.getenv("OUTBOX_WORKER_THREADS", "8"))
+OUTBOX_METRICS_PORT = int(os.getenv("OUTBOX_METRICS_PORT", "9103"))
+
+# trip sweeper (see core/trip_lifecycle.py): a trip still open this long
+# after it started is closed, completed trips move to BusTripsArchive after
+# this many days, and each pass touches at most BATCH_SIZE trips
+TRIP_END_WINDOW_HOURS = 12
+TRIP_ARCHIVE_AFTER_DAYS = int(os.getenv("TRIP_ARCHIVE_AFTER_DAYS", "30"))
+TRIP_SWEEP_BATCH_SIZE = 500
+
+# boarding-point fences along the route, in metres from the point (see
+# bus_owners/geofences.py)
+GEOFENCE_APPROACH_M = 1000
+GEOFENCE_ARRIVE_M = 75
+GEOFENCE_DEPART_M = 150
+
+# how long a worker serves a trip's cached live position before re-reading
+# TripLatestLocation, how many trips it keeps, the longest long-poll, and
+# how many long-polls one worker holds at once (each ties up a gunicorn
+# thread; keep it well under --threads so bookings and logins get served)
+LIVE_POSITION_CACHE_TTL = float(os.getenv("LIVE_POSITION_CACHE_TTL", "2"))
+LIVE_POSITION_CACHE_SIZE = 5000
+LIVE_POSITION_MAX_WAIT = 25
+LIVE_POSITION_MAX_WAITERS = int(os.getenv("LIVE_POSITION_MAX_WAITERS", "8"))
+
+# Mosquitto broker the mqtt_ingest worker subscribes to
+MQTT_HOST = os.getenv("MQTT_HOST", "mosquitto")
+MQTT_PORT = int(os.getenv("MQTT_PORT", "1883"))
+MQTT_USER = os.getenv("MQTT_USER", "")
+MQTT_PASS = os.getenv("MQTT_PASS", "")
+MQTT_VEHICLE_TOPIC = os.getenv("MQTT_VEHICLE_TOPIC", "vehicle/+")
+# mqtt_ingest writes a trip's buffered fixes once this many are waiting
+# or the oldest has waited this long, whichever comes first
+MQTT_FLUSH_SIZE = int(os.getenv("MQTT_FLUSH_SIZE", "50"))
+MQTT_FLUSH_SECONDS = float(os.getenv("MQTT_FLUSH_SECONDS", "5"))
+# how long mqtt_ingest trusts its bus -> active trip lookup
+MQTT_TRIP_CACHE_TTL = int(os.getenv("MQTT_TRIP_CACHE_TTL", "60"))
+# ...and that a bus has no running trip, kept short so a trip that has
+# just started gets its fixes almost at once
+MQTT_NO_TRIP_CACHE_TTL = int(os.getenv("MQTT_NO_TRIP_CACHE_TTL", "5"))
+# port of the worker's own Prometheus endpoint (0 disables it)
+MQTT_METRICS_PORT = int(os.getenv("MQTT_METRICS_PORT", "9102"))
+
+user_collection = get_collection('Users')
+bus_owner_collection = get_collection('BusOwners')
+bus_collection = get_collection('Buses')
+
+bookings_collection = get_collection('Bookings')
+bustrips_collection = get_collection('BusTrips')
+routes_collection = get_collection('Routes')
+app_version_collection = get_collection("AppVersion")
+boarding_points_collection = get_collection("BoardingPoints")
+FCM_TOKEN_collection = get_collection("FCMTokens")
+admin_collection = get_collection("Admin")
 
 
 # Password validation
@@ -473,6 +608,9 @@ def refresh_tokens(request):
             status=status.HTTP_401_UNAUTHORIZED
         )
 
+    # keep this worker's cached version in step with the document
+    remember_token_version(role, user_id, user.get("tokenVersion", 0))
+
     # 7) issue new tokens
     phone_number = user.get('phone_number')
     new_access = create_access_token(phone_number, role)
@@ -485,34 +623,23 @@ def refresh_tokens(request):
 
 
 def validate_token(access_token):
-    try:
-        payload = jwt.decode(access_token, SECRET_KEY, algorithms=['HS256'])
-        if payload.get('type') != 'access':
-            return None  # Not an access token
-
-        user_id_str = payload.get('user_id')
-        if not user_id_str:
-            return None
-
-        if payload.get('role') == 'USER':
-
-            user = user_collection.find_one({"_id": ObjectId(user_id_str)})
-            if user is None or user.get('tokenVersion', 0) != payload.get('tokenVersion', 0):
-                return None  # User not found or token version mismatch
-
-            return user_id_str  # Return user details instead of just payload
-
-        if payload.get('role') == 'OWNER':
-
-            user = bus_owner_collection.find_one(
-                {"_id": ObjectId(user_id_str)})
-            if user is None or user.get('tokenVersion', 0) != payload.get('tokenVersion', 0):
-                return None  # User not found or token version mismatch
+    principal = resolve_principal(access_token)
+    if principal is None:
+        return None  # Token invalid, expired or version mismatch
+    return principal.user_id
 
-            return user_id_str  # Return user details instead of just payload
 
-    except (jwt.ExpiredSignatureError, jwt.InvalidTokenError):
-        return None  # Token expired or invalid
+def get_request_principal(request):
+    """
+    Authenticate the request's bearer token once and keep the resulting
+    Principal on the request, so the caller's document is read at most once.
+    """
+    principal = getattr(request, 'principal', None)
+    if principal is None:
+        access_token = get_access_token_from_request(request)
+        principal = resolve_principal(access_token) if access_token else None
+        request.principal = principal
+    return principal
 
 
 @api_view(["POST"])
@@ -539,6 +666,7 @@ def logout(request):
             {"_id": ObjectId(user_id_str)},
             {"$set": {"tokenVersion": int(new_version)}}
         )
+        invalidate_token_version(role, user_id_str)
         return Response(
             {"successfully Logged Out"},
             status=status.HTTP_200_OK
@@ -588,33 +716,11 @@ def validate_machine(request):
     if not token:
         return Response({"error": "Token is required"}, status=400)
 
-    try:
-        # Decode the JWT to get the payload
-        payload = jwt.decode(token, SECRET_KEY, algorithms=['HS256'])
-
-        # Extract bus_id and tokenVersion from the payload
-        bus_id_from_key = payload.get("bus_id")
-        token_version_from_key = payload.get("tokenVersion")
+    bus_id, error, error_status = validate_machine_token(token)
+    if error:
+        return Response({"error": error}, status=error_status)
 
-        if not bus_id_from_key or not token_version_from_key:
-            return Response({"error": "Invalid token payload"}, status=400)
-
-        # Get the bus from the database by bus_id
-        bus = bus_collection.find_one({"_id": ObjectId(bus_id_from_key)})
-        if not bus:
-            return Response({"error": "Bus not found"}, status=404)
-
-        # Check the tokenVersion in the database
-        db_token_version = bus.get('tokenVersion')
-
-        # Compare tokenVersion
-        if db_token_version and db_token_version > token_version_from_key:
-            return Response({"error": "Authentication failed. Token version is higher than the provided token version."}, status=403)
-
-        return Response({
-            "message": "Authentication successful",
-            "bus_id": bus_id_from_key  # added field
-        })
-
-    except jwt.InvalidTokenError:
-        return Response({"error": "Invalid token"}, status=400)
+    return Response({
+        "message": "Authentication successful",
+        "bus_id": bus_id  # added field
+    })
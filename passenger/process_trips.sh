@@ -1,10 +1,9 @@
 #!/usr/bin/env bash
-# run_process_trips.sh
-# Navigate to your app directory
+# process_trips.sh
+# Cron fallback for the departure-alerts service: one scheduler pass.
+# Alerts already sent are in the AlertLedger, so overlapping runs are safe.
+# Runs every minute: a pass only sends alerts that are already due, and
+# DEPARTURE_ALERT_GRACE_SECONDS (120) must cover the gap between passes.
 cd /app
 
-# Execute the Python function
-/usr/local/bin/python3 - <<'PYCODE'
-from apps.members.utils import process_trips
-process_trips()
-PYCODE
+exec /usr/local/bin/python3 manage.py run_departure_alerts --once
@@ -1,9 +1,10 @@
+import os
 import time
 import json
 import paho.mqtt.client as mqtt
 
 # MQTT setup
-MQTT_BROKER = "www.passenger.lk"
+MQTT_BROKER = os.getenv("MQTT_BROKER", "www.passenger.lk")  # localhost to benchmark mqtt_ingest
 CLIENT_ID = "6870c4c70c3a861560238224"
 USERNAME = "user"
 PASSWORD = "passengerbus"